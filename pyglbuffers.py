@@ -26,7 +26,17 @@ SOFTWARE.
 from pyglet.gl import (glGenBuffers, glBindBuffer, GLuint, glBufferData,
   glIsBuffer, glDeleteBuffers, GLfloat, GLdouble, GLbyte, GLubyte, GLint,
   GLshort, GLushort, glGetBufferParameteriv, glGetBufferSubData, glBufferSubData,
-  glMapBuffer, glUnmapBuffer, glGetBufferPointerv)
+  glMapBuffer, glUnmapBuffer, glGetBufferPointerv, glCopyBufferSubData, glDeleteSync, gl_info)
+
+try:
+    from pyglet.gl import (glNamedBufferData, glNamedBufferSubData, glGetNamedBufferSubData,
+      glGetNamedBufferParameteriv, glMapNamedBuffer, glUnmapNamedBuffer, glGetNamedBufferPointerv,
+      glCopyNamedBufferSubData)
+    NO_NAMED_BUFFERS = False
+except ImportError:
+    NO_NAMED_BUFFERS = True
+
+import pyglet.gl
 
 from pyglet.gl import (GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER, GL_PIXEL_PACK_BUFFER,
   GL_PIXEL_UNPACK_BUFFER, GL_STATIC_COPY, GL_STATIC_DRAW, GL_STATIC_READ,
@@ -34,7 +44,7 @@ from pyglet.gl import (GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER, GL_PIXEL_PACK_B
   GL_STREAM_READ, GL_TRUE, GL_BUFFER_SIZE, GL_READ_ONLY, GL_WRITE_ONLY, GL_READ_WRITE,
   GL_BUFFER_MAPPED, GL_BUFFER_ACCESS, GL_BUFFER_USAGE, GL_BUFFER_MAP_POINTER, 
   GL_FLOAT, GL_DOUBLE, GL_BYTE, GL_UNSIGNED_BYTE, GL_INT, GL_UNSIGNED_INT,
-  GL_SHORT, GL_UNSIGNED_SHORT)
+  GL_SHORT, GL_UNSIGNED_SHORT, GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER)
 
 try:
     import pyglbuffers_extensions
@@ -43,8 +53,27 @@ try:
 except:
     NO_EXTENSIONS = True
 
+try:
+    from pickle import PickleBuffer, dumps as pickle_dumps, loads as pickle_loads
+except ImportError:
+    PickleBuffer = None
+
+try:
+    from multiprocessing import shared_memory, cpu_count, get_all_start_methods, get_context
+    from concurrent.futures import ProcessPoolExecutor
+    import pyglbuffers_pack
+except ImportError:
+    shared_memory = None
+
 import re
-from ctypes import byref, Structure, cast, POINTER, sizeof, c_void_p
+from array import array
+from collections import deque
+from weakref import WeakKeyDictionary
+from threading import local
+from itertools import islice
+from operator import mul, index as int_index
+from ctypes import (byref, Structure, cast, POINTER, sizeof, c_void_p, c_char,
+  addressof, Array, string_at, memmove)
 from functools import lru_cache, namedtuple
 from collections.abc import Sequence
 from sys import modules
@@ -52,6 +81,22 @@ from sys import modules
 #Loaded extensions name are added in here
 LOADED_EXTENSIONS = []
 
+#Estimated cost, in bytes, of a single glBufferSubData/glGetBufferSubData call.
+#Used to choose how strided writes are uploaded on unmapped buffers.
+SUBDATA_CALL_COST = 4096
+
+#Number of values from which pack_parallel uses worker processes. Smaller inputs are packed by pack.
+PARALLEL_PACK_THRESHOLD = 200000
+
+#Default size, in bytes, of the chunks compared by diff uploads
+DIFF_CHUNK_SIZE = 4096
+
+#Number of buffer names generated at once by glGenBuffers
+NAMES_BLOCK_SIZE = 64
+
+#Timeout, in nanoseconds, of a single fence wait
+FENCE_TIMEOUT = 1000000000
+
 BUFFER_FORMAT_TYPES_MAP = { 'f': (GLfloat, GL_FLOAT), 'd': (GLdouble, GL_DOUBLE),
                             'b': (GLbyte, GL_BYTE), 'B': (GLubyte, GL_UNSIGNED_BYTE),
                             'i': (GLint, GL_INT), 'I': (GLuint, GL_UNSIGNED_INT),
@@ -60,6 +105,11 @@ BUFFER_FORMAT_TYPES_MAP = { 'f': (GLfloat, GL_FLOAT), 'd': (GLdouble, GL_DOUBLE)
 pyvars = re.compile('[_a-zA-Z][_\w]+')
 
 map_info = namedtuple('MappingInformation', ['access', 'target', 'ptr', 'size'])
+field_stats = namedtuple('FieldStats', ['min', 'max', 'sum', 'count'])
+vertex_attribute = namedtuple('VertexAttribute', ['location', 'size', 'gl_type', 'normalized', 'stride', 'offset'])
+
+#Memoryview format of the unsigned integers used to copy bytes, by size
+UNIT_CODES = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}
 
 def ptr_array(arr):
     " Cast an array in a pointer "
@@ -105,6 +155,143 @@ def eval_slice(slice, length):
 
     return start, stop, step
 
+def is_index_sequence(key):
+    """
+        Check if a key is a sequence of indices (list, tuple, range, array or one dimensional 
+        NumPy array). NumPy scalars and 0-d arrays are not sequences.
+    """
+    if isinstance(key, (list, tuple, range, array)):
+        return True
+        
+    return hasattr(key, '__array__') and getattr(key, 'ndim', 0) == 1
+    
+def as_index(value):
+    " Convert an integer (ex: a NumPy integer) to an int. Return None if value is not an integer or is a bool "
+    if isinstance(value, bool):
+        return None
+    try:
+        return int_index(value)
+    except TypeError:
+        return None
+
+def eval_key(key):
+    """
+        Check the key of an item access. Return a slice or a sequence of indices as is and 
+        convert integers to int. Raise a KeyError for other keys.
+    """
+    if isinstance(key, slice) or is_index_sequence(key):
+        return key
+        
+    index = as_index(key)
+    if index is None:
+        raise KeyError('Key must be an integer, a slice or a sequence of integers, got {}'.format(type(key).__qualname__))
+        
+    return index
+
+def eval_indices(indices, length):
+    " Evaluate every index of a sequence of indices. Return the indices as a list "
+    if hasattr(indices, 'tolist'):
+        indices = indices.tolist()
+        
+    evaluated = []
+    for value in indices:
+        index = as_index(value)
+        if index is None:
+            raise KeyError('Indices must be integers, got {}'.format(type(value).__qualname__))
+        evaluated.append(eval_index(index, length))
+        
+    return evaluated
+
+def index_runs(indices):
+    """
+        Split sorted unique indices into runs of contiguous indices. Return the runs
+        as (start, stop) positions in the indices list.
+    """
+    runs, start = [], 0
+    for i in range(1, len(indices)+1):
+        if i == len(indices) or indices[i] != indices[i-1]+1:
+            runs.append((start, i))
+            start = i
+            
+    return runs
+
+def token_code(token):
+    " Return the memoryview format character of the components of a token "
+    return token.type._type_._type_
+
+def token_components(raw, token, struct_size):
+    " Return the values of every component of a token in raw packed data as lists "
+    if len(raw) == 0:
+        return [[] for i in range(token.size)]
+        
+    view = memoryview(raw).cast('B').cast(token_code(token))
+    offset, stride = token.offset//view.itemsize, struct_size//view.itemsize
+    
+    return [view[offset+k::stride].tolist() for k in range(token.size)]
+
+def merge_ranges(ranges):
+    " Sort and merge overlapping or adjacent (start, stop) ranges "
+    merged = []
+    for start, stop in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+            
+    return [tuple(r) for r in merged]
+
+def packed_stats(raw, token, struct_size):
+    """
+        Compute the statistics of a token from raw packed data. The statistics match the
+        values held by the buffer (ex: values wrapped by the integer types, floats rounded to 32 bits).
+    """
+    components = token_components(raw, token, struct_size)
+    return field_stats(min=tuple(map(min, components)), max=tuple(map(max, components)),
+                       sum=tuple(map(sum, components)), count=len(components[0]))
+                       
+def merge_stats(stats, other):
+    """
+        Merge the statistics of values written over a part of a buffer. The old values
+        are unknown, so min and max become bounds and the sum is lost (None).
+    """
+    return field_stats(min=tuple(map(min, stats.min, other.min)), max=tuple(map(max, stats.max, other.max)),
+                       sum=None, count=stats.count)
+
+def combine_stats(stats, other):
+    " Combine the statistics of two disjoint sets of values "
+    return field_stats(min=tuple(map(min, stats.min, other.min)), max=tuple(map(max, stats.max, other.max)),
+                       sum=tuple(map(sum, zip(stats.sum, other.sum))), count=stats.count+other.count)
+
+def cast_values(values, src_code, dst_type):
+    """
+        Convert the values of a token component to another type, like a C cast on the GPU. 
+        Narrowed integers wrap around, floats converted to integers are truncated toward zero and 
+        clamped to the range of the integer type (NaN becomes 0) and doubles out of the range 
+        of floats become infinities. Return the converted values as a memoryview.
+    """
+    dst_code = dst_type._type_
+    if src_code in 'fd' and dst_code not in 'fd':
+        bits = 8*sizeof(dst_type)
+        low, high = (-(1 << bits-1), (1 << bits-1)-1) if dst_code.islower() else (0, (1 << bits)-1)
+        values = [low if v <= low else high if v >= high else int(v) if v == v else 0 for v in values]
+        
+    converted = (dst_type*len(values))(*values)
+    return memoryview(converted).cast('B').cast(dst_code)
+
+def _unpickle_packed(format_str, data):
+    """
+        Rebuild packed data sent to another process. Writable buffers (ex: the out of band 
+        buffers of pickle protocol 5) are used without copy.
+    """
+    bformat = BufferFormat.from_string(format_str)
+    view = memoryview(data).cast('B')
+    if len(view) % sizeof(bformat.struct) != 0:
+        raise ValueError('Packed data size is not a multiple of the format size')
+        
+    array_type = bformat.struct*(len(view)//sizeof(bformat.struct))
+    packed = array_type.from_buffer_copy(view) if view.readonly else array_type.from_buffer(view)
+    return PackedData(bformat, packed)
+
 class BufferFormatError(Exception):
     def __init__(self, *args):
         super().__init__(*args)
@@ -128,8 +315,8 @@ class GetBufferObject(GLGetObject):
     __slots__ = []
 
     def __get__(self, instance, cls):
-        instance.bind()
-        glGetBufferParameteriv(instance.target, self.pname, byref(self.buffer))
+        ops = instance._Buffer__edit()
+        ops.parameter(instance.bid, instance.target, self.pname, byref(self.buffer))
         return self.buffer.value
 
 class BufferFormat(object):
@@ -142,9 +329,10 @@ class BufferFormat(object):
             struct: ctypes struct representing this format
             item: named tuple representing this format
             tokens: Information on the formatted values fields
+            format_str: Format string used to create this format
     """
     
-    __fields__ = ['struct', 'item', 'tokens']
+    __fields__ = ['struct', 'item', 'tokens', 'format_str']
     
     pattern = re.compile(r'\((\d)+([fdbBsSiI])\)\[(\w+)\]')
     token = namedtuple('FormatToken', ('offset', 'gl_type', 'size', 'type', 'name', ))
@@ -172,6 +360,19 @@ class BufferFormat(object):
         return format
     
     
+    @staticmethod
+    def converter(src_format, dst_format, mapping=None):
+        """
+            Compile a conversion from a format to another. See FormatConverter.
+            
+            Parameters:
+                src_format: Format of the converted data
+                dst_format: Format of the converted data
+                mapping: Optional dictionary. Keys are names of dst_format tokens. Values are 
+                         either the name of a src_format token or default values.
+        """
+        return FormatConverter(src_format, dst_format, mapping)
+    
     @classmethod
     @lru_cache(maxsize=16)
     def from_string(cls, format_str):
@@ -226,30 +427,172 @@ class BufferFormat(object):
                 
         bformat = super().__new__(cls)
         
-        # Save the tokens
-        bformat.tokens = tokens        
-        
-        # Build the item
-        bformat.item = namedtuple('V', [t.name for t in tokens])
-        
         # Build the structure
         struct_fields = [(t.name, t.type) for t in tokens]
         bformat.struct = type('BufferStruct', (Structure,), {'_fields_': struct_fields})
         
+        # Save the tokens. The offsets include the padding added by ctypes to align the fields
+        bformat.tokens = [t._replace(offset=getattr(bformat.struct, t.name).offset) for t in tokens]
+        bformat.format_str = format_str
+        
+        # Build the item
+        bformat.item = namedtuple('V', [t.name for t in tokens])
+        
         return bformat
         
-    def pack(self, data):
+    def attribute_layout(self, locations=None, normalized=()):
+        """
+            Return the vertex attributes of the format as a tuple of VertexAttribute 
+            (location, size, gl_type, normalized, stride, offset). The values can be passed 
+            as is to glVertexAttribPointer. Layouts are cached, so this function is not expensive to call.
+            
+            Parameters:
+                locations: Dictionary of attribute locations by token name (ex: the attribute locations 
+                           of a shader program). Tokens without a location are skipped. If None, 
+                           the location of a token is its index in the format.
+                normalized: Names of the tokens whose values are normalized.
+        """
+        if locations is not None:
+            locations = tuple(sorted(locations.items()))
+            
+        return BufferFormat._layout(self.format_str, locations, tuple(sorted(normalized)))
+        
+    @classmethod
+    @lru_cache(maxsize=64)
+    def _layout(cls, format_str, locations, normalized):
+        " Build the vertex attributes of a format. Used internally by attribute_layout "
+        bformat = BufferFormat.from_string(format_str)
+        stride = sizeof(bformat.struct)
+        locations = dict(locations) if locations is not None else {t.name: i for i, t in enumerate(bformat.tokens)}
+        
+        layout = []
+        for token in bformat.tokens:
+            location = locations.get(token.name, -1)
+            if location < 0:
+                continue
+            offset = getattr(bformat.struct, token.name).offset
+            layout.append(vertex_attribute(location=location, size=token.size, gl_type=token.gl_type,
+                          normalized=token.name in normalized, stride=stride, offset=offset))
+            
+        return tuple(layout)
+        
+    def pack(self, data, stats=None):
         """
             Pack python sequence into a c struct. The data must match the
             BufferFormat format.
             
+            If stats is a dictionary, the statistics (min, max, sum and count) of 
+            every token are computed while packing and saved in it by token name.
+            
+            If data is an array of c struct that was already packed by the format,
+            a copy of the array is returned.
+            
             Argument:
                 data: Sequence of python data. 
+                stats: Optional dictionary that receives the tokens statistics
         """
         if len(data) == 0:
             raise ValueError('No data to pack')
+            
+        if self.is_packed(data):
+            buffers = (self.struct*len(data)).from_buffer_copy(data)
+            if stats is not None:
+                self.packed_stats(buffers, stats)
+            return buffers
         
         buffers = (self.struct*len(data))()
+        self._pack_into(buffers, data, stats)
+        
+        return buffers
+        
+    def is_packed(self, data):
+        " Return True if data is an array of c struct packed by the format "
+        return isinstance(data, Array) and data._type_ is self.struct
+        
+    def packed_stats(self, buffers, stats, length=None):
+        """
+            Compute the statistics of every token of packed data and save them 
+            in stats by token name.
+            
+            Argument:
+                buffers: Array of c struct packed by the format
+                stats: Dictionary that receives the tokens statistics
+                length: Number of packed values. Default to the length of buffers.
+        """
+        struct_size = sizeof(self.struct)
+        length = length if length is not None else len(buffers)
+        raw = memoryview(buffers).cast('B')[:length*struct_size]
+        for token in self.tokens:
+            stats[token.name] = packed_stats(raw, token, struct_size)
+        
+    def pack_parallel(self, data, workers=None, threshold=PARALLEL_PACK_THRESHOLD):
+        """
+            Pack python sequence into a c struct using a pool of processes. The
+            data is split in chunks and each worker writes its chunk directly into
+            a shared memory block, so no packed data is sent back to the caller.
+            
+            The workers only import the standard library (see pyglbuffers_pack). When the 
+            fork start method is available, the workers inherit the data and only the chunk 
+            bounds are sent to them. Otherwise every chunk is pickled, which usually costs more 
+            than packing it: the function only helps for large inputs with fork. Inputs smaller 
+            than threshold, or all the inputs if multiprocessing.shared_memory is not available,
+            are packed by pack, without worker processes.
+            
+            The returned value is an array of c struct, like the one returned by
+            pack, that can be passed to Buffer.init. The shared memory is released
+            when the array is garbage collected.
+            
+            Argument:
+                data: Sequence of python data. 
+                workers: Number of worker processes. Default to the number of cpu.
+                threshold: Number of values from which worker processes are used. Default to 200000.
+        """
+        length = len(data)
+        if length == 0:
+            raise ValueError('No data to pack')
+        if length < threshold or shared_memory is None:
+            return self.pack(data)
+            
+        workers = workers or cpu_count()
+        chunk = -(-length // workers)
+        forked = 'fork' in get_all_start_methods()
+        
+        shm = shared_memory.SharedMemory(create=True, size=sizeof(self.struct)*length)
+        try:
+            if forked:
+                pool = ProcessPoolExecutor(workers, get_context('fork'), pyglbuffers_pack.init_worker, 
+                                           (self.format_str, shm.name, data))
+            else:
+                pool = ProcessPoolExecutor(workers)
+                
+            with pool:
+                if forked:
+                    jobs = [pool.submit(pyglbuffers_pack.pack_range, start, start+chunk) for start in range(0, length, chunk)]
+                else:
+                    jobs = [pool.submit(pyglbuffers_pack.pack_chunk, self.format_str, shm.name, start, data[start:start+chunk]) 
+                            for start in range(0, length, chunk)]
+                for job in jobs:
+                    job.result()
+        except BaseException:
+            shm.close()
+            raise
+        finally:
+            shm.unlink()
+        
+        # Map the block without exporting the shared memory buffer so that 
+        # the shared memory can be closed when the array is collected
+        base = c_char.from_buffer(shm.buf)
+        address = addressof(base)
+        del base
+        
+        buffers = (self.struct*length).from_address(address)
+        buffers._shm = shm
+        
+        return buffers
+        
+    def _pack_into(self, buffers, data, stats=None):
+        " Pack python sequence into an existing array of c struct "
+        length = min(len(buffers), len(data))
         
         # Allow single tuple when there is only one token
         # Ex: ((1,2,3), (4,5,6)) is accepted instead of (((1,2,3),), ((4,5,6),))
@@ -275,8 +618,10 @@ class BufferFormat(object):
                     format_str = str(token.size)+k
     
             raise ValueError(msg.format(format_str, subdata))
-        
-        return buffers
+            
+        if stats is not None:
+            # The statistics are computed from the packed values, buffers can be longer than data
+            self.packed_stats(buffers, stats, length)
         
     def pack_single(self, data):
         """
@@ -349,7 +694,548 @@ class BufferFormat(object):
             data_dict[t.name] = tuple(getattr(data, t.name))
         
         return self.item(**data_dict)
+        
+    def __reduce__(self):
+        # struct and item are created dynamically, the format is rebuilt from its string
+        return (BufferFormat.from_string, (self.format_str,))
+            
+class FormatConverter(object):
+    """
+        Conversion of packed data from a format to another. Each token of the destination
+        format is either copied from a token of the source format (with a type cast if the
+        types do not match) or filled with default values. Tokens of the source format that 
+        are not used are dropped. Missing components are filled with zeros.
+        
+        By default, tokens are mapped by name. The mapping dictionary can map a destination
+        token to a source token with a different name or to default values.
+        
+        Conversions are compiled into bulk strided copies, so no python object is created 
+        for every element (except for type casts, where each component is converted in a single pass).
+        Type casts behave like C casts on the GPU, see cast_values: narrowed integers wrap around and
+        floats converted to integers are clamped to the range of the integer type.
+        
+        Example:
+            BufferFormat.converter('(3d)[position](3f)[normal]', '(3f)[normal](3f)[pos](4B)[color]', 
+                                   {'pos': 'position', 'color': (255, 255, 255, 255)})
+        
+        Slots:
+            src: Source format
+            dst: Destination format
+            ops: Compiled operations
+    """
+    
+    __slots__ = ['src', 'dst', 'ops']
+    
+    def __init__(self, src_format, dst_format, mapping=None):
+        self.src = BufferFormat.new(src_format)
+        self.dst = BufferFormat.new(dst_format)
+        self.ops = []
+        
+        mapping = mapping or {}
+        src_tokens = {t.name: t for t in self.src.tokens}
+        for name in mapping:
+            if name not in self.dst.item._fields:
+                raise KeyError('No token named "{}" in the destination format'.format(name))
+        
+        for token in self.dst.tokens:
+            source = mapping.get(token.name, token.name)
+            if isinstance(source, str):
+                if source not in src_tokens:
+                    if token.name in mapping:
+                        raise KeyError('No token named "{}" in the source format'.format(source))
+                    continue
+                self.__compile_copy(token, src_tokens[source])
+            else:
+                values = tuple(source) if isinstance(source, Sequence) else (source,)
+                values = tuple(cast_values([v], 'd' if isinstance(v, float) else 'q', token.type._type_)[0] 
+                               for v in values[:token.size])
+                self.ops.append(('fill', token_code(token), token.offset, values))
+                
+    def __compile_copy(self, dst_token, src_token):
+        " Compile the copy of a source token into a destination token "
+        dst_code, src_code = token_code(dst_token), token_code(src_token)
+        size = min(dst_token.size, src_token.size)
+        if dst_code == src_code:
+            width = sizeof(src_token.type._type_)*size
+            self.ops.append(('bytes', dst_token.offset, src_token.offset, width))
+        else:
+            self.ops.append(('cast', dst_token.type._type_, dst_token.offset, src_code, src_token.offset, size))
+            
+    def identity(self):
+        " Return True if the source and destination data have the same bytes "
+        return (sizeof(self.src.struct) == sizeof(self.dst.struct) and 
+                sum(op[3] for op in self.ops if op[0] == 'bytes' and op[1] == op[2]) == sizeof(self.dst.struct))
+    
+    def __call__(self, data):
+        """
+            Convert data. Return an array of c struct packed with the destination format.
+            
+            Parameters:
+                data: Data packed with the source format or python data matching the source format
+        """
+        src_data = data if self.src.is_packed(data) else self.src.pack(data)
+        length = len(src_data)
+        dst_data = (self.dst.struct*length)()
+        
+        src_stride, dst_stride = sizeof(self.src.struct), sizeof(self.dst.struct)
+        src_bytes, dst_bytes = memoryview(src_data).cast('B'), memoryview(dst_data).cast('B')
+        
+        for op in self.ops:
+            if op[0] == 'bytes':
+                _, dst_offset, src_offset, width = op
+                
+                # Copy with the largest unit that keeps the copies aligned
+                unit = next(u for u in (8, 4, 2, 1) if (dst_offset|src_offset|width|src_stride|dst_stride) % u == 0)
+                src_view, dst_view = src_bytes.cast(UNIT_CODES[unit]), dst_bytes.cast(UNIT_CODES[unit])
+                for k in range(width//unit):
+                    dst_view[dst_offset//unit+k::dst_stride//unit] = src_view[src_offset//unit+k::src_stride//unit]
+                    
+            elif op[0] == 'cast':
+                _, dst_type, dst_offset, src_code, src_offset, size = op
+                src_view, dst_view = src_bytes.cast(src_code), dst_bytes.cast(dst_type._type_)
+                src_item, dst_item = src_view.itemsize, dst_view.itemsize
+                for k in range(size):
+                    values = src_view[src_offset//src_item+k::src_stride//src_item].tolist()
+                    dst_view[dst_offset//dst_item+k::dst_stride//dst_item] = cast_values(values, src_code, dst_type)
+                    
+            else:
+                _, dst_code, dst_offset, values = op
+                dst_view = dst_bytes.cast(dst_code)
+                dst_item = dst_view.itemsize
+                for k, value in enumerate(values):
+                    dst_view[dst_offset//dst_item+k::dst_stride//dst_item] = memoryview(array(dst_code, [value])*length)
+                    
+        return dst_data
+        
+    def convert_buffer(self, buffer, usage=None):
+        """
+            Convert the content of a buffer into a new buffer with the destination format 
+            and the same target. If both formats have the same bytes (see identity) and the client 
+            supports it, the data is copied on the GPU with glCopyBufferSubData. Otherwise 
+            (including conversions that only reorder the tokens) the data is read back once, 
+            converted and uploaded.
+            
+            Parameters:
+                buffer: Buffer using the source format
+                usage: Usage of the new buffer. If None, use the usage of the source buffer.
+        """
+        usage = usage if usage is not None else buffer._usage
+        length = len(buffer)
+        converted = Buffer._Buffer__alloc(type(buffer), buffer.target, self.dst, usage)
+        
+        if length == 0:
+            return converted
+        
+        if self.identity() and capabilities().copy_buffer:
+            converted.reserve(length)
+            converted._Buffer__copy(buffer, 0, 0, sizeof(self.src.struct)*length)
+        else:
+            data = (self.src.struct*length)()
+            ops = buffer._Buffer__edit()
+            ops.get_sub_data(buffer.bid, buffer.target, 0, sizeof(data), byref(data))
+            converted.init(self(data))
+            
+        return converted
+
+class PackedData(object):
+    """
+        Data packed by a buffer format, ready to be sent to another process and uploaded
+        as is. Packed data can be pickled: with pickle protocol 5, the packed bytes are serialized 
+        as a PickleBuffer, so a pickler with a buffer_callback (out of band buffers) never copies them.
+        In band picklers (ex: Connection.send, multiprocessing queues) copy them in their stream,
+        send_packed and recv_packed send them over a multiprocessing connection without these copies.
+        The format is rebuilt from its format string. Buffer.init accepts packed data without repacking it.
+        
+        Slots:
+            format: Buffer format of the data
+            data: Array of format.struct
+    """
+    
+    __slots__ = ['format', 'data']
+    
+    def __init__(self, format, data):
+        """
+            Parameters:
+                format: Buffer format (or format string) of the data
+                data: Python data to pack, or data that was already packed by the format (used without copy)
+        """
+        self.format = format if isinstance(format, BufferFormat) else BufferFormat.from_string(format)
+        self.data = data if self.format.is_packed(data) else self.format.pack(data)
+        
+    def view(self, format):
+        """
+            Return the data as an array of format.struct, without copy. Raise a BufferFormatError
+            if the data was packed by another format.
+            
+            Parameters:
+                format: Buffer format
+        """
+        if self.data._type_ is format.struct:
+            return self.data
+        if self.format.format_str != format.format_str:
+            raise BufferFormatError('Packed data format "{}" do not match "{}"'.format(self.format.format_str, format.format_str))
+            
+        return (format.struct*len(self.data)).from_buffer(self.data)
+        
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5 and PickleBuffer is not None:
+            return (_unpickle_packed, (self.format.format_str, PickleBuffer(self.data)))
+        return (_unpickle_packed, (self.format.format_str, bytes(self.data)))
+        
+    def __len__(self):
+        return len(self.data)
+
+def send_packed(connection, obj):
+    """
+        Send an object holding packed data over a multiprocessing connection. The packed bytes are
+        written to the connection directly from their memory (out of band buffers), instead of 
+        being copied in the pickle stream. The object must be received with recv_packed.
+        
+        Parameters:
+            connection: multiprocessing Connection (ex: an end of multiprocessing.Pipe)
+            obj: Picklable object (ex: PackedData, or a list of PackedData)
+    """
+    if PickleBuffer is None:
+        connection.send((obj, ()))
+        return
+        
+    buffers = []
+    header = pickle_dumps(obj, protocol=5, buffer_callback=buffers.append)
+    views = [buffer.raw() for buffer in buffers]
+    connection.send((header, tuple(view.nbytes for view in views)))
+    for view in views:
+        connection.send_bytes(view)
+        
+def recv_packed(connection):
+    """
+        Receive an object sent by send_packed. The packed bytes are read from the connection 
+        directly into the memory of the received packed data.
+        
+        Parameters:
+            connection: multiprocessing Connection
+    """
+    header, sizes = connection.recv()
+    if PickleBuffer is None:
+        return header
+        
+    buffers = []
+    for size in sizes:
+        buffer = bytearray(size)
+        connection.recv_bytes_into(buffer)
+        buffers.append(buffer)
+        
+    return pickle_loads(header, buffers=buffers)
+
+class BufferNames(object):
+    """
+        Pool of buffer names of an opengl context. Names are generated in blocks
+        with a single glGenBuffers call. Released names are queued and deleted 
+        with a single glDeleteBuffers call by collect, which is called automatically 
+        when a name is generated or when a buffer is bound in the context. Fences released 
+        by objects collected from the garbage collector are deleted the same way.
+        
+        Releasing a name or a fence is safe from any thread (ex: from a finalizer), generate 
+        and collect must be called from the thread that owns the context.
+        
+        Slots:
+            block_size: Number of names generated at once
+            free: Names generated but not yet used
+            released: Names waiting to be deleted
+            fences: Fences waiting to be deleted
+    """
+    
+    __slots__ = ['block_size', 'free', 'released', 'fences', '__weakref__']
+    
+    def __init__(self, block_size=NAMES_BLOCK_SIZE):
+        self.block_size = block_size
+        self.free = []
+        self.released = deque()
+        self.fences = deque()
+        
+    def generate(self):
+        " Return an unused buffer name. The released names are deleted first "
+        if self.released or self.fences:
+            self.collect()
+            
+        if len(self.free) == 0:
+            names = (GLuint*self.block_size)()
+            glGenBuffers(self.block_size, names)
+            self.free.extend(reversed(names))
+            
+        return self.free.pop()
+        
+    def release(self, name):
+        " Queue a buffer name for deletion "
+        self.released.append(name)
+        
+    def release_fence(self, fence):
+        " Queue a fence for deletion "
+        self.fences.append(fence)
+        
+    def collect(self):
+        " Delete the released names and fences. Return the number of deleted names "
+        names = []
+        while self.released:
+            names.append(self.released.popleft())
+        
+        if len(names) > 0:
+            glDeleteBuffers(len(names), (GLuint*len(names))(*names))
+            
+        while self.fences:
+            glDeleteSync(self.fences.popleft())
+            
+        return len(names)
+
+#Upload context made current on each thread (see UploadContext)
+THREAD_STATE = local()
+
+#Owner of the buffers released by an upload context that were not acquired yet
+IN_TRANSIT = object()
+
+#Functions called with the buffers, registered by the extensions (ex: registry).
+#    track: Called with each buffer created by the class methods (ex: Buffer.array)
+#    adopt: Called with each buffer acquired from an upload context, in the render context
+#    collect: Called with the names pool of a context by collect
+BUFFER_HOOKS = {'track': [], 'adopt': [], 'collect': []}
+
+#Optional features of the buffers, by name, and the buffer slot that holds their state.
+#A feature is enabled by Buffer.enable_<name> and disabled by Buffer.disable(name), the slot is None when it is disabled.
+BUFFER_FEATURES = {'diff': 'diff', 'stats': 'fieldstats', 'spatial_index': 'spatial', 'profile': 'profile'}
+
+def current_upload():
+    " Return the upload context current on the calling thread, or None "
+    return getattr(THREAD_STATE, 'upload', None)
+
+def current_context():
+    """
+        Return the opengl context current on the calling thread: the context of the current
+        upload context (see UploadContext) or the pyglet current context.
+    """
+    upload = getattr(THREAD_STATE, 'upload', None)
+    return upload.context if upload is not None else pyglet.gl.current_context
+
+#Buffer names pool of each opengl context
+CONTEXT_NAMES = WeakKeyDictionary()
+DEFAULT_NAMES = BufferNames()
+
+def buffer_names(context=None):
+    """
+        Return the buffer names pool of an opengl context.
+        
+        Arguments:
+            context: Pyglet context. If None, use the current context.
+    """
+    context = context if context is not None else current_context()
+    if context is None:
+        return DEFAULT_NAMES
+        
+    names = CONTEXT_NAMES.get(context)
+    if names is None:
+        names = CONTEXT_NAMES[context] = BufferNames()
+        
+    return names
+    
+class GLCapabilities(object):
+    """
+        Capabilities of an opengl context used by pyglbuffers. Probed once by context,
+        see capabilities.
+        
+        Slots:
+            version: Opengl version of the context
+            named: Direct state access on buffers (OpenGL 4.5 or GL_ARB_direct_state_access)
+            copy_buffer: Copies between buffers (OpenGL 3.1 or GL_ARB_copy_buffer)
+            sync: Fences (OpenGL 3.2 or GL_ARB_sync)
+    """
+    
+    __slots__ = ['version', 'named', 'copy_buffer', 'sync']
+    
+    def __init__(self, info=gl_info):
+        have = lambda version, extension: info.have_version(*version) or info.have_extension(extension)
+        self.version = info.get_version()
+        self.named = have((4, 5), 'GL_ARB_direct_state_access') and not NO_NAMED_BUFFERS
+        self.copy_buffer = have((3, 1), 'GL_ARB_copy_buffer')
+        self.sync = have((3, 2), 'GL_ARB_sync')
+        
+    def __repr__(self):
+        return 'GLCapabilities(version={}, named={}, copy_buffer={}, sync={})'.format(
+                self.version, self.named, self.copy_buffer, self.sync)
+
+#Capabilities of each opengl context
+CONTEXT_CAPABILITIES = WeakKeyDictionary()
+
+def capabilities(context=None):
+    """
+        Return the capabilities (GLCapabilities) of an opengl context. The context
+        is probed the first time this function is called with it.
+        
+        Arguments:
+            context: Pyglet context. If None, use the current context.
+    """
+    context = context if context is not None else current_context()
+    if context is None:
+        return GLCapabilities()
+        
+    caps = CONTEXT_CAPABILITIES.get(context)
+    if caps is None:
+        # Contexts never made current by pyglet (ex: upload contexts) have no info
+        info = context.get_info() if hasattr(context, 'get_info') else None
+        caps = CONTEXT_CAPABILITIES[context] = GLCapabilities(info or gl_info)
+        
+    return caps
+
+class BoundBufferOps(object):
+    """
+        Buffer operations that bind the buffer to a target first (bind-to-edit). 
+        Used when the context do not support direct state access. See buffer_ops.
+    """
+    
+    __slots__ = []
+    
+    #Name of the path, for diagnostics
+    path = 'bound'
+    
+    @staticmethod
+    def prepare(bid, target):
+        " Called once before a group of operations on a buffer "
+        glBindBuffer(target, bid)
+        
+    @staticmethod
+    def data(bid, target, size, data, usage):
+        glBufferData(target, size, data, usage)
+        
+    @staticmethod
+    def sub_data(bid, target, offset, size, data):
+        glBufferSubData(target, offset, size, data)
+        
+    @staticmethod
+    def get_sub_data(bid, target, offset, size, data):
+        glGetBufferSubData(target, offset, size, data)
+        
+    @staticmethod
+    def parameter(bid, target, pname, value):
+        glGetBufferParameteriv(target, pname, value)
+        
+    @staticmethod
+    def map(bid, target, access):
+        " Map a buffer and return the mapped pointer "
+        ptr = c_void_p()
+        glMapBuffer(target, access)
+        glGetBufferPointerv(target, GL_BUFFER_MAP_POINTER, byref(ptr))
+        return ptr
+        
+    @staticmethod
+    def unmap(bid, target):
+        glUnmapBuffer(target)
+        
+    @staticmethod
+    def copy(src, dst, read_offset, write_offset, size):
+        glBindBuffer(GL_COPY_READ_BUFFER, src)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, dst)
+        glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, read_offset, write_offset, size)
+        
+class NamedBufferOps(BoundBufferOps):
+    """
+        Buffer operations that use the named buffer entry points (direct state access).
+        The buffers are never bound, so the binding state of the caller is not modified.
+    """
+    
+    __slots__ = []
+    
+    path = 'named'
+    
+    @staticmethod
+    def prepare(bid, target):
+        pass
+        
+    @staticmethod
+    def data(bid, target, size, data, usage):
+        glNamedBufferData(bid, size, data, usage)
+        
+    @staticmethod
+    def sub_data(bid, target, offset, size, data):
+        glNamedBufferSubData(bid, offset, size, data)
+        
+    @staticmethod
+    def get_sub_data(bid, target, offset, size, data):
+        glGetNamedBufferSubData(bid, offset, size, data)
+        
+    @staticmethod
+    def parameter(bid, target, pname, value):
+        glGetNamedBufferParameteriv(bid, pname, value)
+        
+    @staticmethod
+    def map(bid, target, access):
+        ptr = c_void_p()
+        glMapNamedBuffer(bid, access)
+        glGetNamedBufferPointerv(bid, GL_BUFFER_MAP_POINTER, byref(ptr))
+        return ptr
+        
+    @staticmethod
+    def unmap(bid, target):
+        glUnmapNamedBuffer(bid)
+        
+    @staticmethod
+    def copy(src, dst, read_offset, write_offset, size):
+        glCopyNamedBufferSubData(src, dst, read_offset, write_offset, size)
+        
+BOUND_OPS = BoundBufferOps()
+NAMED_OPS = NamedBufferOps()
+
+def buffer_ops(context=None):
+    """
+        Return the buffer operations used with an opengl context: NAMED_OPS if the 
+        context supports direct state access, BOUND_OPS otherwise. The "path" attribute
+        of the returned value tells which one was chosen.
+        
+        Arguments:
+            context: Pyglet context. If None, use the current context.
+    """
+    return NAMED_OPS if capabilities(context).named else BOUND_OPS
+    
+def collect(context=None):
+    """
+        Delete the buffers that were freed since the last call. Owned buffers
+        are not deleted when they are garbage collected, instead their name is 
+        queued and deleted by the next buffer created or bound in the context, or 
+        when this function is called. It can be called at a safe point, for example 
+        once per frame, to delete them without waiting.
+        
+        The functions of BUFFER_HOOKS['collect'] are called first (ex: the profiling 
+        extension moves the buffers with an automatic usage migration to their recommended usage).
+        
+        Return the number of deleted buffers.
+        
+        Arguments:
+            context: Pyglet context. If None, use the current context.
+    """
+    names = buffer_names(context)
+    for hook in BUFFER_HOOKS['collect']:
+        hook(names)
             
+    return names.collect()
+
+class DiffState(object):
+    """
+        Diff upload state of a buffer. See Buffer.enable_diff.
+        
+        Slots:
+            chunk_size: Size in bytes of the compared chunks
+            data: Bytes uploaded by the last init, or None if the buffer was modified since
+            sent: Total number of bytes uploaded by init
+            skipped: Total number of bytes init did not upload because they did not change
+    """
+    
+    __slots__ = ['chunk_size', 'data', 'sent', 'skipped']
+    
+    def __init__(self, chunk_size=DIFF_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.data = None
+        self.sent = 0
+        self.skipped = 0
+        
+    def __repr__(self):
+        return 'DiffState(chunk_size={}, sent={}, skipped={})'.format(self.chunk_size, self.sent, self.skipped)
+
 class Buffer(object):
     """
         Wrapper over an opengl buffer.
@@ -359,10 +1245,19 @@ class Buffer(object):
             data: Object that allows pythonic access to the buffer data
             target: Buffer target (ex: GL_ARRAY_BUFFER)
             owned: If the object own the underlying data
+            diff: Diff upload state (see enable_diff) or None
+            names: Names pool of the context that owns the buffer
+            fieldstats: Statistics of each token (see enable_stats) or None
+            record: Memory information of the buffer in its registry (registry extension), or None if it is not tracked
+            spatial: Spatial index of a position token (spatial_index extension) or None
+            profile: Access profile (profiling extension) or None
+            ops: Buffer operations of the context that owns the buffer (see buffer_ops)
+            owner: Upload context that owns the buffer (see UploadContext), IN_TRANSIT if the buffer was
+                   released by its upload context and not acquired yet, or None if the buffer belongs to the render context
     """
 
     __slots__ = ['bid', 'format', 'target', '_usage', 'data', 'owned',
-                 '__weakref__', 'mapinfo']    
+                 '__weakref__', 'mapinfo', 'diff', 'names', 'fieldstats', 'record', 'spatial', 'profile', 'ops', 'owner']    
     
     size = GetBufferObject(GL_BUFFER_SIZE)    
     mapped = GetBufferObject(GL_BUFFER_MAPPED)
@@ -376,18 +1271,35 @@ class Buffer(object):
         self.format = BufferFormat.new(format)
         self.target = None
         self.mapinfo = None
+        self.names = buffer_names()
+        self.owner = current_upload()
+        self.record = None
+        self.__disable_features()
+        
+        # The named functions fail on names that were generated but never bound, 
+        # the object is only created by the first glBindBuffer
+        self.ops = buffer_ops() if self.valid() else BOUND_OPS
 
     @staticmethod
     def __alloc(cls, target, format, usage): 
         buf = super().__new__(cls)
+        names = buffer_names()
+        buf.bid = GLuint(names.generate())
+        buf.names = names
         buf.owned = True
-        buf.bid = GLuint()
-        glGenBuffers(1, byref(buf.bid))
+        buf.ops = buffer_ops()
+        buf.owner = current_upload()
         glBindBuffer(target, buf.bid)
+        if buf.owner is not None:
+            buf.owner.targets.add(target)
         buf._usage = usage
         buf.format = BufferFormat.new(format)
         buf.target = target
         buf.mapinfo = None
+        buf.record = None
+        buf.__disable_features()
+        for track in BUFFER_HOOKS['track']:
+            track(buf)
         
         return buf
         
@@ -433,8 +1345,60 @@ class Buffer(object):
             raise ValueError("Buffer target was not defined")
             
         target = target if target is not None else self.target
+        self.__own(target)
+            
+        if self.record is not None:
+            self.record.registry.touch(self)
+            
+        names = self.names
+        if (names.released or names.fences) and names is buffer_names():
+            names.collect()
+            
         glBindBuffer(target, self.bid)
         
+    def __edit(self, target=None):
+        """
+            Prepare the buffer for a group of operations and return the buffer operations
+            to use. On the bound path, the buffer is bound to the target (or its default target).
+            With direct state access, the binding state is not modified.
+        """
+        if self.target is None:
+            raise ValueError("Buffer target was not defined")
+            
+        target = target if target is not None else self.target
+        self.__own(target)
+            
+        if self.record is not None:
+            self.record.registry.touch(self)
+            
+        self.ops.prepare(self.bid, target)
+        return self.ops
+        
+    def __copy(self, src, read_offset, write_offset, size):
+        """
+            Copy bytes from another buffer on the GPU (glCopyBufferSubData). Every write made 
+            with a GPU copy goes through this function, so that the local data of diff uploads is discarded.
+        """
+        if self.diff is not None:
+            self.diff.data = None
+            
+        src.__edit()
+        self.__edit().copy(src.bid, self.bid, read_offset, write_offset, size)
+        
+    def __own(self, target):
+        """
+            Raise a BufferError if the buffer is not owned by the context current on the calling 
+            thread. Buffers created by an upload context can only be used by its thread until they are 
+            acquired by the render context (see UploadContext). Record the target bound in an upload context.
+        """
+        owner = self.owner
+        if owner is not getattr(THREAD_STATE, 'upload', None):
+            raise BufferError('Buffer is owned by another context' if owner is not IN_TRANSIT else 
+                              'Buffer was released by its upload context and was not acquired')
+            
+        if owner is not None:
+            owner.targets.add(target)
+        
     def map(self, access=GL_READ_WRITE, target=None):
         """
         Map the buffer locally. This increase the reading/writing speed.
@@ -447,14 +1411,16 @@ class Buffer(object):
         if self.mapped == GL_TRUE:
             raise BufferError("Buffer is already mapped")
         
+        if self.diff is not None and access != GL_READ_ONLY:
+            self.diff.data = None
+        
+        if self.profile is not None:
+            self.profile.record_map(access, self.size)
+        
         target = target if target is not None else self.target
-        glBindBuffer(target, self.bid)
-        glMapBuffer(target, access)
+        ptr = self.__edit(target).map(self.bid, target, access)
         
         ptr_type = POINTER(self.format.struct)
-        ptr = c_void_p()
-        glGetBufferPointerv(target, GL_BUFFER_MAP_POINTER, byref(ptr))        
-        
         self.mapinfo = map_info(target=target, access=access, ptr=cast(ptr,ptr_type),
                                 size=self.size//sizeof(self.format.struct))
         
@@ -466,7 +1432,7 @@ class Buffer(object):
         if self.mapped != GL_TRUE:
             raise BufferError("Buffer is not mapped")
             
-        glUnmapBuffer(self.mapinfo.target)
+        self.ops.unmap(self.bid, self.mapinfo.target)
         self.mapinfo = None
         
     def init(self, data, target=None):
@@ -478,15 +1444,215 @@ class Buffer(object):
             This method is called when assiging values to the data field of a buffer.
             Ex: buffer.data = ( (1.0, 2.0, 3.0, 4.0),  )
             
+            Data can also be an array of c struct that was already packed by
+            the buffer format (ex: the value returned by BufferFormat.pack_parallel)
+            or PackedData of the buffer format.
+            
+            If diff uploads are enabled (see enable_diff), only the chunks that
+            changed since the last init are uploaded. If statistics are enabled
+            (see enable_stats), they are computed from the packed data. Data that
+            was already packed is uploaded without copy.
+            
             Parameters:
                 data: Data to use to initialize the buffer.
         """
         if target is None:
             target = self.target
             
-        self.bind(target)
-        cdata = self.format.pack(data)
-        glBufferData(target, sizeof(cdata), ptr_array(cdata), self._usage)
+        if isinstance(data, PackedData):
+            data = data.view(self.format)
+            
+        if self.format.is_packed(data):
+            cdata = data
+            if self.fieldstats is not None:
+                self.fieldstats = {}
+                if len(cdata) > 0:
+                    self.format.packed_stats(cdata, self.fieldstats)
+        elif self.fieldstats is not None:
+            self.fieldstats = {}
+            cdata = self.format.pack(data, self.fieldstats)
+        else:
+            cdata = self.format.pack(data)
+            
+        if self.profile is not None:
+            self.profile.record_write(sizeof(cdata), True)
+            usage = self.profile.recommended(self._usage)
+            if self.profile.auto_migrate and usage is not None and usage != self._usage:
+                self.__retag(usage)
+                
+                # The storage must be allocated again with the new usage
+                if self.diff is not None:
+                    self.diff.data = None
+                
+        ops = self.__edit(target)
+        if self.diff is not None:
+            self.__init_diff(target, cdata)
+        else:
+            ops.data(self.bid, target, sizeof(cdata), ptr_array(cdata), self._usage)
+            
+        if self.spatial is not None:
+            self.spatial.assign(token_components(cdata, self.spatial.token, sizeof(self.format.struct)))
+            
+        if self.record is not None:
+            self.record.registry.resize(self, sizeof(cdata))
+        
+    def attribute_layout(self, locations=None, normalized=()):
+        """
+            Return the vertex attributes of the buffer format. See BufferFormat.attribute_layout.
+            
+            Parameters:
+                locations: Dictionary of attribute locations by token name, or None to use the tokens index.
+                normalized: Names of the tokens whose values are normalized.
+        """
+        return self.format.attribute_layout(locations, normalized)
+        
+    def enable_diff(self, chunk_size=DIFF_CHUNK_SIZE):
+        """
+            Enable diff uploads. The bytes uploaded by init are kept and the next
+            call to init (or a full slice assignment) compares the new data in chunks 
+            of "chunk_size" bytes. If the size did not change, only the changed chunks 
+            are uploaded with glBufferSubData, otherwise glBufferData is called.
+            
+            Upload statistics are available in the "diff" slot of the buffer. 
+            To disable diff uploads, call disable('diff').
+            
+            Parameters:
+                chunk_size: Size in bytes of the compared chunks. Default to 4096.
+        """
+        self.diff = DiffState(chunk_size)
+        
+    def enable_stats(self):
+        """
+            Enable the tokens statistics. The statistics are computed while packing
+            the data written to the buffer and can be read with stats. They are
+            available after the next call to init or reserve.
+            
+            To disable the statistics, call disable('stats').
+        """
+        self.fieldstats = {}
+        
+    def disable(self, feature):
+        """
+            Disable an optional feature of the buffer (see BUFFER_FEATURES). Disabling
+            a feature that is not enabled does nothing.
+            
+            Parameters:
+                feature: Name of the feature (ex: 'diff', 'stats')
+        """
+        slot = BUFFER_FEATURES.get(feature)
+        if slot is None:
+            raise ValueError('Unknown buffer feature "{}"'.format(feature))
+        setattr(self, slot, None)
+        
+    def __disable_features(self):
+        " Set the slots of the optional features to None "
+        for slot in BUFFER_FEATURES.values():
+            setattr(self, slot, None)
+        
+    def stats(self, name):
+        """
+            Return the statistics (FieldStats) of a token: the min, max and sum of each 
+            component and the number of values. Return None if the statistics 
+            are not known yet. 
+            
+            After a partial write, min and max are bounds of the buffer values and 
+            sum is None until the whole buffer is written again.
+            
+            Parameters:
+                name: Name of the token
+        """
+        if self.fieldstats is None:
+            raise BufferError('Statistics are not enabled for this buffer')
+        if name not in self.format.item._fields:
+            raise KeyError('No token named "{}" in the buffer format'.format(name))
+            
+        return self.fieldstats.get(name)
+        
+    def __retag(self, usage):
+        " Change the usage of the buffer in the registry and in the profile "
+        if self.record is not None:
+            self.record.registry.retag(self, usage)
+            
+        self._usage = usage
+        if self.profile is not None:
+            self.profile.migrations += 1
+            self.profile.reset()
+        
+    def __key_length(self, key):
+        " Return the number of elements addressed by a key "
+        if isinstance(key, int):
+            return 1
+        elif isinstance(key, slice):
+            start, stop, step = eval_slice(key, len(self))
+            return len(range(start, stop, abs(step)))
+        else:
+            return len(key)
+        
+    def __write_spatial(self, key, value):
+        " Called by __setitem__ to update the spatial index after a write "
+        length = len(self)
+        if is_index_sequence(key):
+            indices = eval_indices(key, length)
+        elif isinstance(key, int):
+            indices, value = [eval_index(key, length)], (value,)
+        else:
+            start, stop, step = eval_slice(key, length)
+            indices = range(start, stop)[::step]
+            
+        name = self.spatial.token.name
+        position = self.format.item._fields.index(name)
+        single = len(self.format.tokens) == 1
+        
+        points = []
+        for v in value:
+            if isinstance(v, Structure):
+                points.append(tuple(getattr(v, name)))
+            elif single and not isinstance(v[0], Sequence):
+                points.append(v)
+            else:
+                points.append(v[position])
+                
+        self.spatial.update(indices, points)
+        
+    def __write_stats(self, stats):
+        " Called by __setitem__ to update the statistics after a write "
+        length = len(self)
+        for name, value in stats.items():
+            old = self.fieldstats.get(name)
+            if value.count == length:
+                self.fieldstats[name] = value
+            elif old is not None:
+                self.fieldstats[name] = merge_stats(old, value)
+        
+    def __init_diff(self, target, cdata):
+        " Called by init if diff uploads are enabled "
+        diff, ops, bid = self.diff, self.ops, self.bid
+        size = sizeof(cdata)
+        old, data = diff.data, string_at(addressof(cdata), size)
+        
+        if old is None or len(old) != size:
+            ops.data(bid, target, size, ptr_array(cdata), self._usage)
+            diff.sent += size
+        elif old != data:
+            chunk, sent, run = diff.chunk_size, 0, None
+            for offset in range(0, size, chunk):
+                changed = old[offset:offset+chunk] != data[offset:offset+chunk]
+                if changed and run is None:
+                    run = offset
+                elif not changed and run is not None:
+                    ops.sub_data(bid, target, run, offset-run, byref(cdata, run))
+                    sent, run = sent+offset-run, None
+            
+            if run is not None:
+                ops.sub_data(bid, target, run, size-run, byref(cdata, run))
+                sent += size-run
+                
+            diff.sent += sent
+            diff.skipped += size-sent
+        else:
+            diff.skipped += size
+            
+        diff.data = data
         
     def reserve(self, length, target=None):
         """
@@ -498,8 +1664,219 @@ class Buffer(object):
         if target is None:
             target = self.target
             
-        self.bind()
-        glBufferData(target, sizeof(self.format.struct)*length, c_void_p(0), self._usage)
+        if self.diff is not None:
+            self.diff.data = None
+            
+        if self.fieldstats is not None:
+            self.fieldstats = {t.name: field_stats(min=(0,)*t.size, max=(0,)*t.size, sum=(0,)*t.size, count=length)
+                               for t in self.format.tokens}
+            
+        if self.profile is not None:
+            self.profile.record_write(sizeof(self.format.struct)*length, True)
+            
+        self.__edit(target).data(self.bid, target, sizeof(self.format.struct)*length, c_void_p(0), self._usage)
+        
+        if self.spatial is not None:
+            self.spatial.resize(length, 0)
+        
+        if self.record is not None:
+            self.record.registry.resize(self, sizeof(self.format.struct)*length)
+    
+    def init_stream(self, iterable, count=None, chunk=65536, target=None, trim=False):
+        """
+            Fill the buffer with the values of an iterable (ex: a generator). The values 
+            are packed by chunks in a staging array that is reused and each chunk is 
+            uploaded with glBufferSubData, so the memory used does not depend on the 
+            number of values.
+            
+            If count is known, the storage is reserved once. Otherwise the buffer grows
+            as needed. The buffer keeps its name when it grows: the data is copied to a
+            temporary buffer on the GPU (OpenGL 3.1 or GL_ARB_copy_buffer), or read back 
+            if copies are not supported.
+            
+            The storage can hold more elements than the number of values written (the extra
+            elements are zeroed). If trim is True, the storage is shrunk to the number of values.
+            
+            Return the number of values written.
+            
+            Parameters:
+                iterable: Values to write. Must match the buffer format.
+                count: Number of values, if known.
+                chunk: Number of values packed and uploaded at once. Default to 65536.
+                trim: If True, shrink the storage to the number of values written. Default to False.
+        """
+        if target is None:
+            target = self.target
+            
+        if self.diff is not None:
+            self.diff.data = None
+            
+        struct_size = sizeof(self.format.struct)
+        capacity = count if count is not None else chunk
+        staging = (self.format.struct*chunk)()
+        stats = None
+        
+        self.reserve(capacity, target)
+        
+        written, values = 0, iter(iterable)
+        while True:
+            items = list(islice(values, chunk))
+            if len(items) == 0:
+                break
+                
+            if written+len(items) > capacity:
+                capacity = max(capacity*2, written+len(items))
+                self.__resize(capacity, written, target)
+                
+            if self.fieldstats is not None:
+                chunk_stats = {}
+                self.format._pack_into(staging, items, chunk_stats)
+                stats = chunk_stats if stats is None else {name: combine_stats(stats[name], value) for name, value in chunk_stats.items()}
+            else:
+                self.format._pack_into(staging, items)
+            
+            self.__edit(target).sub_data(self.bid, target, written*struct_size, len(items)*struct_size, byref(staging))
+            if self.spatial is not None:
+                packed = (self.format.struct*len(items)).from_buffer(staging)
+                self.spatial.write(range(written, written+len(items)), token_components(packed, self.spatial.token, struct_size))
+            written += len(items)
+            
+        if trim and written != capacity:
+            self.__resize(written, written, target)
+            capacity = written
+            
+        if self.fieldstats is not None:
+            # The extra elements are zeroed
+            zeros = {t.name: field_stats(min=(0,)*t.size, max=(0,)*t.size, sum=(0,)*t.size, count=capacity-written)
+                     for t in self.format.tokens}
+            if stats is None:
+                stats = zeros
+            elif capacity != written:
+                stats = {name: combine_stats(value, zeros[name]) for name, value in stats.items()}
+            self.fieldstats = stats
+            
+        if self.spatial is not None:
+            self.spatial.refit()
+            
+        return written
+        
+    def __resize(self, length, keep, target=None):
+        """
+            Reallocate the buffer storage to hold "length" elements and keep the "keep"
+            first elements. The buffer keeps its name: the kept data is copied to a temporary 
+            buffer and back on the GPU or, if copies are not supported, read back and uploaded 
+            with the new storage.
+        """
+        target = target if target is not None else self.target
+        struct_size = sizeof(self.format.struct)
+        size, kept = struct_size*length, struct_size*keep
+        
+        if keep > 0 and capabilities().copy_buffer:
+            staging = Buffer.__alloc(Buffer, GL_COPY_READ_BUFFER, self.format, GL_STREAM_COPY)
+            staging.reserve(keep)
+            staging.__copy(self, 0, 0, kept)
+            self.__edit(target).data(self.bid, target, size, c_void_p(0), self._usage)
+            self.__copy(staging, 0, 0, kept)
+            del staging
+        elif keep > 0:
+            host = (c_char*size)()
+            ops = self.__edit(target)
+            ops.get_sub_data(self.bid, target, 0, kept, host)
+            ops.data(self.bid, target, size, host, self._usage)
+        else:
+            self.__edit(target).data(self.bid, target, size, c_void_p(0), self._usage)
+            
+        if self.diff is not None:
+            self.diff.data = None
+        if self.spatial is not None:
+            self.spatial.resize(length, keep)
+        if self.record is not None:
+            self.record.registry.resize(self, size)
+    
+    def sort_indices(self, name, direction=None, key_fn=None, reverse=False, element=None, previous=None):
+        """
+            Compute the order of the buffer elements sorted by a token. Ex: sorting 
+            particles by depth. Return the permutation as a list of indices. 
+            
+            The sort keys are computed in bulk from the buffer content. If the buffer is 
+            mapped or if diff uploads are enabled, the local data is used, otherwise the buffer
+            content is read back once. 
+            
+            The key of each element is computed from the token values:
+              - If direction is set, the key is the dot product of the token and direction
+              - If key_fn is set, the key is key_fn(token_value)
+              - Otherwise, the token must have a single component that is used as key
+              
+            To take advantage of the frame to frame coherence, the permutation returned
+            by the last call can be passed in previous: a copy of it is sorted, which
+            is faster when the order did not change much. previous is not modified.
+            
+            Parameters:
+                name: Name of the token used to compute the keys
+                direction: Optional sequence of weights, one per token component
+                key_fn: Optional function called with the token value of every element
+                reverse: If True, sort in descending order
+                element: Optional buffer that receives the permutation. Its format must have
+                         a single integer token of size 1 (ex: "(1I)[index]").
+                previous: Optional permutation returned by the last call
+        """
+        token = next((t for t in self.format.tokens if t.name == name), None)
+        if token is None:
+            raise KeyError('No token named "{}" in the buffer format'.format(name))
+            
+        if element is not None:
+            tokens = element.format.tokens
+            code = token_code(tokens[0])
+            if len(tokens) != 1 or tokens[0].size != 1 or code in 'fd':
+                raise ValueError('Element buffer format must have a single integer token of size 1')
+                
+            # Signed types (lowercase codes) lose a bit
+            limit = 1 << (8*sizeof(tokens[0].type._type_) - code.islower())
+            if len(self) > limit:
+                raise ValueError('Element buffer format "{}" cannot hold the indices of {} elements'.format(
+                                 element.format.format_str, len(self)))
+            
+        components = self.__components(token)
+        if direction is not None:
+            weights = tuple(direction)[:token.size]
+            keys = [sum(map(mul, value, weights)) for value in zip(*components)]
+        elif key_fn is not None:
+            keys = list(map(key_fn, zip(*components)))
+        elif token.size == 1:
+            keys = components[0]
+        else:
+            raise ValueError('A direction or a key function is required to sort by a token with many components')
+            
+        if previous is not None and len(previous) == len(keys):
+            order = sorted(previous, key=keys.__getitem__, reverse=reverse)
+        else:
+            order = sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse)
+            
+        if element is not None:
+            indices = array(code, order)
+            element.init((element.format.struct*len(order)).from_buffer(indices))
+            
+        return order
+        
+    def __components(self, token):
+        """
+            Return the values of every component of a token as lists. Use the local data
+            if the buffer is mapped or if diff uploads are enabled, otherwise read the buffer back once.
+        """
+        info, struct_size = self.mapinfo, sizeof(self.format.struct)
+        if info is not None:
+            if info.access == GL_WRITE_ONLY:
+                raise BufferError("Impossible to read to a buffer mapped with GL_WRITE_ONLY")
+            raw = (c_char*(info.size*struct_size)).from_address(addressof(info.ptr.contents))
+        elif self.diff is not None and self.diff.data is not None:
+            raw = self.diff.data
+        else:
+            raw = (self.format.struct*len(self))()
+            self.__edit().get_sub_data(self.bid, self.target, 0, sizeof(raw), byref(raw))
+            if self.profile is not None:
+                self.profile.record_read(sizeof(raw))
+            
+        return token_components(raw, token, struct_size)
     
     def __getitem_mapped(self, buffer, key):
         " Called by __getitem__ if the buffer content is mapped locally "
@@ -516,7 +1893,7 @@ class Buffer(object):
             start, stop, step = eval_slice(key, blen)
             return buffer.format.unpack(info.ptr[start:stop:step])
         
-    def __setitem_mapped(self, buffer, key, value):
+    def __setitem_mapped(self, buffer, key, value, stats):
         " Called by __setitem__ if the buffer content is mapped locally "
         info = buffer.mapinfo        
         if buffer.mapinfo.access == GL_READ_ONLY:
@@ -526,25 +1903,31 @@ class Buffer(object):
         
         if isinstance(key, int):
             key = eval_index(key, blen)
-            info.ptr[key] = buffer.format.pack((value,))[0]
+            info.ptr[key] = buffer.format.pack((value,), stats)[0]
         else: 
             start, stop, step = eval_slice(key, blen)
-            if step == -1:
-                value = list(reversed(value))
-                step = 1
+            if len(range(start, stop, abs(step))) != len(value):
+                raise ValueError("Buffer do not support resizing")
                 
-            # Ctypes pointers do not support slicing assignment
-            for count, i in enumerate(range(start, stop, step)):
-                info.ptr[i] = buffer.format.pack((value[count],))[0]
+            # Ctypes pointers do not support slicing assignment, but arrays do
+            struct = buffer.format.struct
+            address = addressof(info.ptr.contents) + start*sizeof(struct)
+            region = (struct*(stop-start)).from_address(address)
+            region[::step] = buffer.format.pack(value, stats)
     
     def __getitem__(self, key):
-        if not isinstance(key, int) and not isinstance(key, slice):
-            raise KeyError('Key must be an integer or a slice, got {}'.format(type(key).__qualname__))
+        key = eval_key(key)
+        if is_index_sequence(key):
+            if self.profile is not None and self.mapinfo is None:
+                self.profile.record_read(len(key)*sizeof(self.format.struct))
+            return self.__gather(eval_indices(key, len(self)))
 
         if self.mapinfo is not None:
             return self.__getitem_mapped(self, key)
+        elif self.profile is not None:
+            self.profile.record_read(self.__key_length(key)*sizeof(self.format.struct))
 
-        self.bind()            
+        ops = self.__edit()
         blen = len(self) 
        
         if isinstance(key, int):
@@ -552,7 +1935,7 @@ class Buffer(object):
             
             buf = self.format.struct()
             buf_size = sizeof(buf)
-            glGetBufferSubData(self.target, key*buf_size, buf_size, byref(buf))
+            ops.get_sub_data(self.bid, self.target, key*buf_size, buf_size, byref(buf))
             
             return self.format.unpack_single(buf)
         
@@ -563,42 +1946,168 @@ class Buffer(object):
             buf_size = sizeof(buf)
             buf_offset = start * sizeof(self.format.struct)
             
-            glGetBufferSubData(self.target, buf_offset, buf_size, byref(buf))
+            ops.get_sub_data(self.bid, self.target, buf_offset, buf_size, byref(buf))
             
             return self.format.unpack(buf[::step])
             
     def __setitem__(self, key, value):
-        if not isinstance(key, int) and not isinstance(key, slice):
-            raise KeyError('Key must be an integer or a slice, got {}'.format(type(key).__qualname__))
+        key = eval_key(key)
+        scatter = is_index_sequence(key)
 
-        if self.mapinfo is not None:
-            return self.__setitem_mapped(self, key, value)
+        if self.diff is not None:
+            if self.mapinfo is None and not scatter and key == slice(None) and len(value) == len(self):
+                return self.init(value)
+            self.diff.data = None
 
-        self.bind()
+        stats = {} if self.fieldstats is not None else None
+        if scatter:
+            self.__scatter(eval_indices(key, len(self)), value, stats)
+        elif self.mapinfo is not None:
+            self.__setitem_mapped(self, key, value, stats)
+        else:
+            self.__setitem_unmapped(key, value, stats)
+            
+        if stats is not None:
+            self.__write_stats(stats)
+            
+        if self.spatial is not None:
+            self.__write_spatial(key, value)
+            
+        if self.profile is not None and self.mapinfo is None:
+            count = self.__key_length(key)
+            self.profile.record_write(count*sizeof(self.format.struct), count == len(self))
+        
+    def __setitem_unmapped(self, key, value, stats):
+        " Called by __setitem__ if the buffer content is not mapped "
+        ops = self.__edit()
         blen = len(self)            
             
         if isinstance(key, int):
             key = eval_index(key, blen)
-            buf = self.format.pack((value,))
+            buf = self.format.pack((value,), stats)
             buf_size = sizeof(buf)
-            glBufferSubData(self.target, key*buf_size, buf_size, byref(buf))
+            ops.sub_data(self.bid, self.target, key*buf_size, buf_size, byref(buf))
             
         else:
-            if key.step is not None and key.step not in (1, -1):
-                raise NotImplementedError('Unmapped buffer write do not support steps different than 1.')
-            if key.step == -1:
-                value = list(reversed(value))                
-                
             start, stop, step = eval_slice(key, blen)
-            if stop-start != len(value):
+            if len(range(start, stop, abs(step))) != len(value):
                 raise ValueError("Buffer do not support resizing")
+            
+            if step == -1:
+                value = list(reversed(value))  
+            
+            if step in (1, -1):
+                buf = self.format.pack(value, stats)
+                buf_size = sizeof(self.format.struct) * (stop-start)
+                buf_offset = start * sizeof(self.format.struct)
+                ops.sub_data(self.bid, self.target, buf_offset, buf_size, byref(buf))
+            else:
+                self.__write_strided(start, stop, step, self.format.pack(value, stats))
                 
-            buf = self.format.pack(value)
-            buf_size = sizeof(self.format.struct) * (stop-start)
-            buf_offset = start * sizeof(self.format.struct)
-                
+    def __runs_cost(self, indices, runs, passes=1):
+        """
+            Return True if transferring every run of indices separately costs less than
+            transferring the range covering all the indices "passes" times.
+        """
+        struct_size = sizeof(self.format.struct)
+        cover_cost = passes * (SUBDATA_CALL_COST + (indices[-1]+1-indices[0])*struct_size)
+        runs_cost = len(runs)*SUBDATA_CALL_COST + len(indices)*struct_size
+        
+        return runs_cost < cover_cost
+        
+    def __gather(self, indices):
+        """
+            Called by __getitem__ to read the values at a sequence of indices. The values
+            are returned in the order of the indices. When the buffer is not mapped, either the 
+            range covering the indices is read back once or every run of contiguous indices is 
+            read separately, whichever costs less.
+        """
+        info = self.mapinfo
+        if info is not None:
+            if info.access == GL_WRITE_ONLY:
+                raise BufferError("Impossible to read to a buffer mapped with GL_WRITE_ONLY")
+            return self.format.unpack([info.ptr[i] for i in indices])
+        elif len(indices) == 0:
+            return ()
+            
+        ops = self.__edit()
+        struct, struct_size = self.format.struct, sizeof(self.format.struct)
+        order = sorted(set(indices))
+        runs = index_runs(order)
+        
+        if self.__runs_cost(order, runs):
+            buf = (struct*len(order))()
+            for start, stop in runs:
+                ops.get_sub_data(self.bid, self.target, order[start]*struct_size, (stop-start)*struct_size, byref(buf, start*struct_size))
+            position = {index: i for i, index in enumerate(order)}
+            return self.format.unpack([buf[position[i]] for i in indices])
+        else:
+            first = order[0]
+            buf = (struct*(order[-1]+1-first))()
+            ops.get_sub_data(self.bid, self.target, first*struct_size, sizeof(buf), byref(buf))
+            return self.format.unpack([buf[i-first] for i in indices])
             
-            glBufferSubData(self.target, buf_offset, buf_size, byref(buf))
+    def __scatter(self, indices, value, stats):
+        """
+            Called by __setitem__ to write values at a sequence of indices. The indices are 
+            sorted and merged into runs of contiguous indices. If an index is repeated, the 
+            last value is written. The values are packed once in the sorted order and every run is 
+            copied with a single memmove (mapped buffers) or glBufferSubData call. If the runs are too fragmented,
+            the covering range is read, modified and written back instead.
+        """
+        info = self.mapinfo
+        if info is not None and info.access == GL_READ_ONLY:
+            raise BufferError("Impossible to write to a buffer mapped with GL_READ_ONLY")
+        if len(indices) != len(value):
+            raise ValueError("Buffer do not support resizing")
+        elif len(indices) == 0:
+            return
+            
+        last = dict(zip(indices, range(len(indices))))
+        order = sorted(last)
+        buf = self.format.pack([value[last[i]] for i in order], stats)
+        
+        struct_size = sizeof(self.format.struct)
+        runs = index_runs(order)
+        
+        if info is not None:
+            base = addressof(info.ptr.contents)
+            for start, stop in runs:
+                memmove(base+order[start]*struct_size, addressof(buf)+start*struct_size, (stop-start)*struct_size)
+            return
+            
+        ops = self.__edit()
+        if self.__runs_cost(order, runs, passes=2):
+            for start, stop in runs:
+                ops.sub_data(self.bid, self.target, order[start]*struct_size, (stop-start)*struct_size, byref(buf, start*struct_size))
+        else:
+            first = order[0]
+            region = (self.format.struct*(order[-1]+1-first))()
+            ops.get_sub_data(self.bid, self.target, first*struct_size, sizeof(region), byref(region))
+            for start, stop in runs:
+                memmove(addressof(region)+(order[start]-first)*struct_size, addressof(buf)+start*struct_size, (stop-start)*struct_size)
+            ops.sub_data(self.bid, self.target, first*struct_size, sizeof(region), byref(region))
+            
+    def __write_strided(self, start, stop, step, buf):
+        """
+            Called by __setitem__ to write packed values every "step" elements of 
+            an unmapped buffer. Depending on the stride, either the covering range 
+            is read, modified and written back or every value is uploaded separately.
+        """
+        ops, struct_size = self.ops, sizeof(self.format.struct)
+        indices = range(start, stop)[::step]
+        
+        rmw_cost = 2 * (SUBDATA_CALL_COST + (stop-start)*struct_size)
+        split_cost = len(indices) * (SUBDATA_CALL_COST + struct_size)
+        
+        if rmw_cost <= split_cost:
+            region = (self.format.struct*(stop-start))()
+            ops.get_sub_data(self.bid, self.target, start*struct_size, sizeof(region), byref(region))
+            region[::step] = buf
+            ops.sub_data(self.bid, self.target, start*struct_size, sizeof(region), byref(region))
+        else:
+            for i, index in enumerate(indices):
+                ops.sub_data(self.bid, self.target, index*struct_size, struct_size, byref(buf, i*struct_size))
             
     def __repr__(self):
         return repr(self[::])
@@ -620,11 +2129,15 @@ class Buffer(object):
         return self.size//sizeof(self.format.struct)
         
     def __del__(self):
-        if getattr(self, 'owned', False) and self.valid():
-            if self.mapped == GL_TRUE:
-                self.unmap()
+        if getattr(self, 'record', None) is not None:
+            self.record.registry.untrack(self)
             
-            glDeleteBuffers(1, byref(self.bid))
+        # The buffer is deleted (and implicitly unmapped) by the next collect of its names pool.
+        # The construction of the buffer can fail before its name is generated
+        if getattr(self, 'bid', None) is None:
+            return
+        if getattr(self, 'owned', False) and getattr(self, 'names', None) is not None:
+            self.names.release(self.bid.value)
             
 
 def extension_loaded(extension_name):
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Content addressed cache of buffers.
+
+    Adds:
+        BufferCache: Reference counted cache of buffers keyed by format, target, usage and content
+"""
+
+from hashlib import blake2b
+from collections import OrderedDict
+from ctypes import sizeof
+from pyglet.gl import GL_STATIC_DRAW
+
+from pyglbuffers import Buffer, BufferFormat
+
+class BufferCache(object):
+    """
+        Content addressed cache of buffers. Buffers created with the same format,
+        target, usage and packed content are shared. Cached buffers are reference
+        counted: every buffer returned by the cache must be given back with release.
+        
+        Unreferenced buffers are kept in the cache and are freed, least recently
+        used first, when the size of the cache goes over its budget. 
+        
+        Cached buffers are shared, so their content must not be modified.
+        
+        Slots:
+            budget: Maximum size in bytes of the cache. Buffers still in use are never freed.
+            size: Size in bytes of all the cached buffers
+            hits: Number of requests that returned a cached buffer
+            misses: Number of requests that created a new buffer
+    """
+    
+    __slots__ = ['budget', 'size', 'hits', 'misses', 'entries', 'keys']
+    
+    def __init__(self, budget=64*1024*1024):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()    # key -> [buffer, refcount, size], in LRU order
+        self.keys = {}                  # id(buffer) -> key
+        
+    def array(self, format, data, usage=GL_STATIC_DRAW):
+        " Return a buffer that hold vertex data (GL_ARRAY_BUFFER) initialized with data "
+        return self.__get(Buffer.array, format, data, usage)
+        
+    def element(self, format, data, usage=GL_STATIC_DRAW):
+        " Return a buffer that hold vertex indices (GL_ELEMENT_ARRAY_BUFFER) initialized with data "
+        return self.__get(Buffer.element, format, data, usage)
+        
+    def __get(self, constructor, format, data, usage):
+        " Return the cached buffer matching the request or create a new one "
+        format = BufferFormat.new(format)
+        cdata = format.pack(data)
+        key = (constructor.__name__, format.format_str, usage, blake2b(cdata).digest())
+        
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            entry[1] += 1
+            self.hits += 1
+            return entry[0]
+            
+        buffer = constructor(format, usage)
+        buffer.init(cdata)
+        
+        self.entries[key] = [buffer, 1, sizeof(cdata)]
+        self.keys[id(buffer)] = key
+        self.size += sizeof(cdata)
+        self.misses += 1
+        self.collect()
+        
+        return buffer
+        
+    def release(self, buffer):
+        """
+            Give back a buffer returned by the cache. Once a buffer is not used anymore,
+            it can be freed if the cache goes over its budget.
+            
+            Parameters:
+                buffer: Buffer returned by the cache
+        """
+        key = self.keys.get(id(buffer))
+        if key is None:
+            raise ValueError('Buffer is not owned by the cache')
+            
+        entry = self.entries[key]
+        if entry[1] == 0:
+            raise ValueError('Buffer was already released')
+            
+        entry[1] -= 1
+        self.collect()
+        
+    def collect(self):
+        " Free the least recently used unreferenced buffers until the cache size is under its budget "
+        for key, (buffer, refcount, size) in tuple(self.entries.items()):
+            if self.size <= self.budget:
+                break
+            
+            if refcount == 0:
+                del self.entries[key]
+                del self.keys[id(buffer)]
+                self.size -= size
+        
+    def clear(self):
+        " Free every unreferenced buffer "
+        budget, self.budget = self.budget, 0
+        self.collect()
+        self.budget = budget
+        
+    def __len__(self):
+        return len(self.entries)
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.BufferCache = BufferCache
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Sets of buffers used in rotation (double/triple buffering).
+
+    Adds:
+        BufferSet: Set of identical buffers used in rotation with optional fences and copy forward
+"""
+
+from collections import deque
+from ctypes import sizeof
+from pyglet.gl import (glFenceSync, glClientWaitSync, glDeleteSync, GL_STREAM_DRAW,
+  GL_SYNC_GPU_COMMANDS_COMPLETE, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_EXPIRED, GL_WAIT_FAILED)
+
+from pyglbuffers import (Buffer, FENCE_TIMEOUT, capabilities, merge_ranges, eval_key, eval_index,
+  eval_slice, eval_indices, is_index_sequence)
+
+class BufferSet(object):
+    """
+        Set of identical buffers used in rotation (double/triple buffering). The CPU writes
+        in the current buffer while the GPU reads the buffers of the previous frames. 
+        
+        If fences are enabled, advance only blocks if the GPU is still using the next buffer. 
+        If copy_forward is enabled, the ranges written during the last frames are copied 
+        from the previous buffer when the set advances, so the current buffer is always up to date.
+        Writes made using the BufferSet slice syntax are tracked automatically, other writes 
+        (ex: mapped writes on the current buffer) must be declared with mark.
+        
+        Fences require OpenGL 3.2 (or GL_ARB_sync) and copy_forward requires OpenGL 3.1.
+        
+        Slots:
+            buffers: Buffers of the set
+            index: Index of the current buffer
+            fences: Fence of each buffer or None if fences are disabled
+            copy_forward: If the changed ranges are copied to the next buffer
+            history: Ranges written during the last frames
+            waits: Number of times advance had to wait for the GPU
+    """
+    
+    __slots__ = ['buffers', 'index', 'fences', 'copy_forward', 'history', 'waits']
+    
+    def __init__(self, format, length, count=3, usage=GL_STREAM_DRAW, fences=False, copy_forward=False):
+        if count < 2:
+            raise ValueError('A buffer set must have at least 2 buffers')
+        if fences and not capabilities().sync:
+            raise BufferError('Fences require OpenGL 3.2 or GL_ARB_sync')
+        if copy_forward and not capabilities().copy_buffer:
+            raise BufferError('Copy forward requires OpenGL 3.1 or GL_ARB_copy_buffer')
+            
+        self.buffers = tuple(Buffer.array(format, usage) for i in range(count))
+        for buffer in self.buffers:
+            buffer.reserve(length)
+            
+        self.index = 0
+        self.fences = [None]*count if fences else None
+        self.copy_forward = copy_forward
+        self.history = deque([[] for i in range(count)], maxlen=count)
+        self.waits = 0
+        
+    def current(self):
+        " Return the buffer that can be written for the current frame "
+        return self.buffers[self.index]
+        
+    def previous(self):
+        " Return the buffer written during the last frame "
+        return self.buffers[self.index-1]
+        
+    def mark(self, start, stop):
+        """
+            Declare that the elements in [start, stop) of the current buffer were written.
+            
+            Parameters:
+                start: Index of the first written element
+                stop: Index after the last written element
+        """
+        self.history[-1].append((start, stop))
+        
+    def advance(self):
+        """
+            Move to the next buffer of the set. If fences are enabled, a fence is 
+            inserted for the current buffer and the call blocks until the GPU is done
+            with the next buffer. If copy_forward is enabled, the ranges written
+            since the next buffer was last used are copied from the current buffer.
+            
+            Return the new current buffer.
+        """
+        count = len(self.buffers)
+        
+        if self.fences is not None:
+            self.fences[self.index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        
+        last, self.index = self.current(), (self.index+1) % count
+        
+        if self.fences is not None and self.fences[self.index] is not None:
+            self.__wait(self.index)
+            
+        if self.copy_forward:
+            # The next buffer was last written count frames ago
+            ranges = merge_ranges(r for frame in list(self.history)[1:] for r in frame)
+            self.__copy(last, self.current(), ranges)
+                
+        self.history.append([])
+        
+        return self.current()
+        
+    def __wait(self, index):
+        " Wait until the GPU is done with the buffer at index "
+        fence, self.fences[index] = self.fences[index], None
+        
+        status = glClientWaitSync(fence, 0, 0)
+        if status == GL_TIMEOUT_EXPIRED:
+            self.waits += 1
+            while status == GL_TIMEOUT_EXPIRED:
+                status = glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, FENCE_TIMEOUT)
+            
+        glDeleteSync(fence)
+        if status == GL_WAIT_FAILED:
+            raise BufferError('Failed to wait for the buffer fence')
+    
+    def __copy(self, src, dst, ranges):
+        " Copy ranges of elements from src to dst on the GPU "
+        struct_size = sizeof(src.format.struct)
+        for start, stop in ranges:
+            dst._Buffer__copy(src, start*struct_size, start*struct_size, (stop-start)*struct_size)
+            
+    def __getitem__(self, key):
+        return self.current()[key]
+        
+    def __setitem__(self, key, value):
+        key = eval_key(key)
+        buffer = self.current()
+        buffer[key] = value
+        
+        length = len(buffer)
+        if isinstance(key, int):
+            key = eval_index(key, length)
+            self.mark(key, key+1)
+        elif is_index_sequence(key):
+            for index in eval_indices(key, length):
+                self.mark(index, index+1)
+        else:
+            start, stop, step = eval_slice(key, length)
+            self.mark(start, stop)
+            
+    def __len__(self):
+        return len(self.buffers)
+        
+    def __del__(self):
+        # Finalizers can run on any thread, the fences are deleted with the buffers
+        for fence in getattr(self, 'fences', None) or ():
+            if fence is not None:
+                self.buffers[0].names.release_fence(fence)
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.BufferSet = BufferSet
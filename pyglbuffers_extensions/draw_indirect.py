@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Indirect draw commands (GL_ARB_draw_indirect).
+    
+    Adds:
+        Buffer.draw_indirect: Generate a buffer that hold draw commands (GL_DRAW_INDIRECT_BUFFER)
+        DRAW_ARRAYS_COMMAND: BufferFormat of a DrawArraysIndirectCommand
+        DRAW_ELEMENTS_COMMAND: BufferFormat of a DrawElementsIndirectCommand
+        DrawCommands: Array of draw commands packed in bulk from parallel sequences
+"""
+
+from ctypes import sizeof
+from pyglet.gl import (gl_info, GLuint, GLint, GL_INT, GL_DRAW_INDIRECT_BUFFER, 
+  GL_STATIC_DRAW)
+
+import pyglbuffers
+from pyglbuffers import Buffer, BufferFormat, merge_ranges
+
+DRAW_ARRAYS_COMMAND = BufferFormat.from_string('(1I)[count](1I)[instance_count](1I)[first](1I)[base_instance]')
+DRAW_ELEMENTS_COMMAND = BufferFormat.from_string('(1I)[count](1I)[instance_count](1I)[first_index](1i)[base_vertex](1I)[base_instance]')
+
+def draw_indirect(cls, format=DRAW_ELEMENTS_COMMAND, usage=GL_STATIC_DRAW):
+    " Generate a buffer that hold draw commands (GL_DRAW_INDIRECT_BUFFER) "
+    return Buffer._Buffer__alloc(cls, GL_DRAW_INDIRECT_BUFFER, format, usage)
+
+class DrawCommands(object):
+    """
+        Array of indirect draw commands. The commands are packed in bulk from
+        parallel sequences (one value per command) or from a single value used
+        for every command. If base_vertices is None, the commands are 
+        DrawArraysIndirectCommand, otherwise they are DrawElementsIndirectCommand.
+        
+        Single commands can be updated in place with set. The first call to upload writes
+        every command, the next calls only upload the updated commands.
+        
+        Slots:
+            format: Format of the commands (DRAW_ARRAYS_COMMAND or DRAW_ELEMENTS_COMMAND)
+            data: Packed commands. Can be passed to Buffer.init
+            dirty: Ranges of commands not uploaded since they were packed or updated
+    """
+    
+    __slots__ = ['format', 'data', 'dirty']
+    
+    def __init__(self, counts, firsts, instance_counts=1, base_vertices=None, base_instances=0):
+        if base_vertices is None:
+            self.format = DRAW_ARRAYS_COMMAND
+            columns = (counts, instance_counts, firsts, base_instances)
+        else:
+            self.format = DRAW_ELEMENTS_COMMAND
+            columns = (counts, instance_counts, firsts, base_vertices, base_instances)
+            
+        lengths = set(len(c) for c in columns if not isinstance(c, int))
+        if len(lengths) != 1:
+            raise ValueError('Commands values must be sequences of the same length')
+            
+        length, words = lengths.pop(), len(columns)
+        
+        # Fill every field with a strided slice assignment. Signed fields share the same memory
+        unsigned = (GLuint*(length*words))()
+        signed = (GLint*(length*words)).from_buffer(unsigned)
+        for index, (token, column) in enumerate(zip(self.format.tokens, columns)):
+            values = [column]*length if isinstance(column, int) else column
+            target = signed if token.gl_type == GL_INT else unsigned
+            target[index::words] = values
+        
+        self.data = (self.format.struct*length).from_buffer(unsigned)
+        self.dirty = [(0, length)]
+        
+    def set(self, index, **fields):
+        """
+            Update the fields of a single command.
+            
+            Example: commands.set(10, instance_count=0)
+            
+            Parameters:
+                index: Index of the command
+                fields: New values of the command fields
+        """
+        index = pyglbuffers.eval_index(index, len(self.data))
+        command = self.data[index]
+        for name, value in fields.items():
+            if name not in self.format.item._fields:
+                raise KeyError('No field named "{}" in a draw command'.format(name))
+            getattr(command, name)[0] = value
+            
+        self.dirty.append((index, index+1))
+        
+    def get(self, index):
+        " Return a command as a named tuple "
+        return self.format.unpack_single(self.data[pyglbuffers.eval_index(index, len(self.data))])
+        
+    def upload(self, buffer):
+        """
+            Upload the commands to a buffer. If the buffer length do not match,
+            the buffer is initialized with all the commands, otherwise only the
+            commands not uploaded yet (all of them for the first upload) are written.
+            
+            Parameters:
+                buffer: Buffer created with the same format (see Buffer.draw_indirect)
+        """
+        if len(buffer) != len(self.data):
+            buffer.init(self.data)
+        else:
+            struct = self.format.struct
+            for start, stop in merge_ranges(self.dirty):
+                buffer[start:stop] = (struct*(stop-start)).from_buffer(self.data, start*sizeof(struct))
+            
+        self.dirty = []
+        
+    def __len__(self):
+        return len(self.data)
+
+def supported():
+    "Requires OpenGL >= 4.0 or GL_ARB_draw_indirect"
+    return gl_info.have_version(4, 0) or gl_info.have_extension('GL_ARB_draw_indirect')
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.Buffer.draw_indirect = classmethod(draw_indirect)
+    pyglbuffers_module.DRAW_ARRAYS_COMMAND = DRAW_ARRAYS_COMMAND
+    pyglbuffers_module.DRAW_ELEMENTS_COMMAND = DRAW_ELEMENTS_COMMAND
+    pyglbuffers_module.DrawCommands = DrawCommands
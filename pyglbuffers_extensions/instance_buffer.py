@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Per instance data with stable handles.
+
+    Adds:
+        InstanceBuffer: Array buffer of per instance data with stable handles and swap-remove compaction
+"""
+
+from ctypes import sizeof, addressof, memmove
+from pyglet.gl import GL_DYNAMIC_DRAW
+
+from pyglbuffers import Buffer
+
+class InstanceBuffer(object):
+    """
+        Array buffer holding per instance data. Instances are identified by stable handles,
+        but the live records are always contiguous at the start of the buffer so that 
+        instanced draws can use "live_count" as the number of instances.
+        
+        When an instance is removed, the last record is moved in the hole and only that 
+        record is uploaded. A packed copy of the records is kept on the CPU, so reading or 
+        moving records never read the buffer back. The buffer grows automatically.
+        
+        Slots:
+            buffer: Underlying array buffer
+            data: Packed copy of the records
+            live_count: Number of live instances
+            slots: Record index of each handle (None if the handle is free)
+            handles: Handle of each record
+            free: Released handles
+    """
+    
+    __slots__ = ['buffer', 'data', 'live_count', 'slots', 'handles', 'free']
+    
+    def __init__(self, format, capacity=64, usage=GL_DYNAMIC_DRAW):
+        self.buffer = Buffer.array(format, usage)
+        self.data = (self.buffer.format.struct*capacity)()
+        self.buffer.init(self.data)
+        self.live_count = 0
+        self.slots = []
+        self.handles = []
+        self.free = []
+        
+    @property
+    def capacity(self):
+        " Number of records the buffer can hold before growing "
+        return len(self.data)
+        
+    def add(self, value):
+        """
+            Add an instance and return its handle.
+            
+            Parameters:
+                value: Instance data. Must match the buffer format.
+        """
+        if self.live_count == self.capacity:
+            self.__grow()
+        
+        slot = self.live_count
+        if len(self.free) > 0:
+            handle = self.free.pop()
+            self.slots[handle] = slot
+        else:
+            handle = len(self.slots)
+            self.slots.append(slot)
+            
+        self.handles.append(handle)
+        self.live_count += 1
+        self.__write(slot, value)
+        
+        return handle
+        
+    def remove(self, handle):
+        """
+            Remove an instance. The last record is moved in the hole.
+            
+            Parameters:
+                handle: Handle returned by add
+        """
+        slot, last = self.__slot(handle), self.live_count-1
+        
+        if slot != last:
+            struct_size = sizeof(self.buffer.format.struct)
+            memmove(addressof(self.data)+slot*struct_size, addressof(self.data)+last*struct_size, struct_size)
+            moved = self.handles[slot] = self.handles[last]
+            self.slots[moved] = slot
+            self.__upload(slot)
+        
+        self.handles.pop()
+        self.slots[handle] = None
+        self.free.append(handle)
+        self.live_count -= 1
+        
+    def __slot(self, handle):
+        " Return the record index of a handle "
+        slot = self.slots[handle] if 0 <= handle < len(self.slots) else None
+        if slot is None:
+            raise KeyError('Invalid instance handle "{}"'.format(handle))
+        return slot
+        
+    def __write(self, slot, value):
+        " Pack a value in the CPU copy and upload it "
+        self.data[slot] = self.buffer.format.pack_single(value)
+        self.__upload(slot)
+        
+    def __upload(self, slot):
+        " Upload a single record from the CPU copy "
+        struct = self.buffer.format.struct
+        self.buffer[slot:slot+1] = (struct*1).from_buffer(self.data, slot*sizeof(struct))
+        
+    def __grow(self):
+        " Double the capacity of the buffer "
+        data = (self.buffer.format.struct*(self.capacity*2))()
+        memmove(data, self.data, sizeof(self.data))
+        self.data = data
+        self.buffer.init(data)
+        
+    def __getitem__(self, handle):
+        return self.buffer.format.unpack_single(self.data[self.__slot(handle)])
+        
+    def __setitem__(self, handle, value):
+        self.__write(self.__slot(handle), value)
+        
+    def __contains__(self, handle):
+        return 0 <= handle < len(self.slots) and self.slots[handle] is not None
+        
+    def __len__(self):
+        return self.live_count
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.InstanceBuffer = InstanceBuffer
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Static meshes merged in shared vertex and element buffers.
+
+    Adds:
+        MeshBatcher: Meshes sharing a format packed in a single array buffer and a single element buffer
+"""
+
+from array import array
+from ctypes import sizeof, addressof, memmove
+from collections import namedtuple
+from collections.abc import Sequence
+from pyglet.gl import GL_STATIC_DRAW
+
+from pyglbuffers import Buffer, token_code, token_components
+
+mesh_range = namedtuple('MeshRange', ['first', 'count', 'base_vertex'])
+
+#Memoryview format of the index types accepted by the element buffers (GL_UNSIGNED_BYTE, GL_UNSIGNED_SHORT, GL_UNSIGNED_INT)
+INDEX_CODES = 'BHI'
+
+class MeshBatcher(object):
+    """
+        Merge static meshes sharing a format in a single array buffer and a single element
+        buffer, so that they can be drawn with a few draw calls (ex: glMultiDrawElementsBaseVertex 
+        or the draw_indirect extension). Each mesh is drawn with its draw range (MeshRange: first index,
+        index count, base vertex).
+        
+        Meshes are packed when they are added. If a position token is set, the mesh transforms 
+        (4x4 matrices) are applied to it when the meshes are packed. The buffers are built by build. 
+        Updating a mesh that still fits in its place in the buffers only uploads this mesh, other changes 
+        (adding meshes or growing a mesh) rebuild the buffers on the next call to build. 
+        Removed meshes leave a hole until the next rebuild.
+        
+        If rebase is True, the mesh indices are offset by the first vertex of the mesh, so the base
+        vertex of every draw range is 0 and all the meshes can be drawn with a single glDrawElements call.
+        Otherwise, the indices are kept as is and the draw ranges must be drawn with their base vertex,
+        which allows small index types for large batches. Indices must be unsigned (B, S or I formats).
+        
+        Slots:
+            vertices: Array buffer
+            indices: Element buffer
+            position: Format token transformed by the mesh transforms, or None
+            rebase: If the indices are offset by the first vertex of their mesh
+            meshes: Mesh of each handle, as [source vertices, packed vertices, indices, transform], or None if the mesh was removed
+            places: Place of each mesh in the buffers, as [first vertex, vertex capacity, first index, index capacity, index count]
+            dirty: If the buffers must be rebuilt by the next call to build
+            uploads: Number of meshes uploaded by partial rebuilds
+            rebuilds: Number of full rebuilds
+    """
+    
+    __slots__ = ['vertices', 'indices', 'position', 'rebase', 'meshes', 'places', 'dirty', 'uploads', 'rebuilds']
+    
+    def __init__(self, format, index_format='(1I)[index]', position=None, rebase=True, usage=GL_STATIC_DRAW):
+        self.vertices = Buffer.array(format, usage)
+        self.indices = Buffer.element(index_format, usage)
+        
+        tokens = self.indices.format.tokens
+        if len(tokens) != 1 or tokens[0].size != 1 or token_code(tokens[0]) not in INDEX_CODES:
+            raise ValueError('Element buffer format must have a single unsigned integer token (B, S or I) of size 1')
+            
+        self.position = None
+        if position is not None:
+            self.position = next((t for t in self.vertices.format.tokens if t.name == position), None)
+            if self.position is None:
+                raise KeyError('No token named "{}" in the buffer format'.format(position))
+            if token_code(self.position) not in 'fd':
+                raise ValueError('Position token "{}" must be a float or a double token'.format(position))
+                
+        self.rebase = rebase
+        self.meshes = []
+        self.places = []
+        self.dirty = True
+        self.uploads = 0
+        self.rebuilds = 0
+        
+    def add(self, vertices, indices, transform=None):
+        """
+            Add a mesh to the batch and return its handle. The buffers are rebuilt by the next call to build.
+            
+            Parameters:
+                vertices: Vertex data. Must match the batch format (or be already packed by it).
+                indices: Sequence of indices, relative to the first vertex of the mesh
+                transform: Optional 4x4 matrix (4 rows of 4 values, or 16 values in row order) applied to the position token
+        """
+        mesh = self.__pack(vertices, indices, transform)
+        self.meshes.append(mesh)
+        self.places.append(None)
+        self.dirty = True
+        
+        return len(self.meshes)-1
+        
+    def update(self, handle, vertices=None, indices=None, transform=None):
+        """
+            Replace the vertices, the indices or the transform of a mesh. Values left to None are kept.
+            If the buffers are built and the mesh still fits in its place, only this mesh is uploaded.
+            
+            Parameters:
+                handle: Handle returned by add
+                vertices, indices, transform: See add
+        """
+        source, packed, old_indices, old_transform = self.__mesh(handle)
+        mesh = self.__pack(vertices if vertices is not None else source, indices if indices is not None else old_indices,
+                           transform if transform is not None else old_transform)
+        self.meshes[handle] = mesh
+        
+        place = self.places[handle]
+        if self.dirty or place is None or len(mesh[1]) > place[1] or len(mesh[2]) > place[3]:
+            self.dirty = True
+            return
+            
+        first_vertex, first_index = place[0], place[2]
+        self.vertices[first_vertex:first_vertex+len(mesh[1])] = mesh[1]
+        
+        index_data = self.__indices(mesh[2], first_vertex)
+        self.indices[first_index:first_index+len(mesh[2])] = index_data
+        place[4] = len(mesh[2])
+        self.uploads += 1
+        
+    def remove(self, handle):
+        """
+            Remove a mesh from the batch. Its place in the buffers is freed by the next rebuild.
+            
+            Parameters:
+                handle: Handle returned by add
+        """
+        self.__mesh(handle)
+        self.meshes[handle] = None
+        self.places[handle] = None
+        
+    def build(self):
+        """
+            Rebuild the buffers if meshes were added or grew since the last build. 
+            Return the draw ranges of the meshes (see draw_ranges).
+        """
+        if not self.dirty:
+            return self.draw_ranges()
+            
+        struct = self.vertices.format.struct
+        live = [(h, mesh) for h, mesh in enumerate(self.meshes) if mesh is not None]
+        vertex_count = sum(len(mesh[1]) for h, mesh in live)
+        index_count = sum(len(mesh[2]) for h, mesh in live)
+        self.__check_range(vertex_count if self.rebase else max((len(mesh[1]) for h, mesh in live), default=0))
+        
+        vertex_data = (struct*vertex_count)()
+        index_data = (self.indices.format.struct*index_count)()
+        first_vertex = first_index = 0
+        for handle, mesh in live:
+            packed, indices = mesh[1], mesh[2]
+            memmove(addressof(vertex_data)+first_vertex*sizeof(struct), packed, sizeof(packed))
+            
+            data = self.__indices(indices, first_vertex)
+            memmove(addressof(index_data)+first_index*sizeof(data._type_), data, sizeof(data))
+            
+            self.places[handle] = [first_vertex, len(packed), first_index, len(indices), len(indices)]
+            first_vertex += len(packed)
+            first_index += len(indices)
+        
+        if vertex_count > 0:
+            self.vertices.init(vertex_data)
+            self.indices.init(index_data)
+        else:
+            self.vertices.reserve(0)
+            self.indices.reserve(0)
+            
+        self.dirty = False
+        self.rebuilds += 1
+        
+        return self.draw_ranges()
+        
+    def draw_range(self, handle):
+        """
+            Return the draw range (MeshRange: first index, index count, base vertex) of a mesh.
+            The buffers must be built.
+        """
+        self.__mesh(handle)
+        place = self.places[handle]
+        if self.dirty or place is None:
+            raise BufferError('Mesh batch must be built')
+            
+        return mesh_range(first=place[2], count=place[4], base_vertex=0 if self.rebase else place[0])
+        
+    def draw_ranges(self):
+        " Return the draw ranges of the meshes in handle order. The buffers must be built. "
+        return [self.draw_range(h) for h, mesh in enumerate(self.meshes) if mesh is not None]
+        
+    def __mesh(self, handle):
+        " Return the mesh of a handle "
+        mesh = self.meshes[handle] if 0 <= handle < len(self.meshes) else None
+        if mesh is None:
+            raise KeyError('Invalid mesh handle "{}"'.format(handle))
+        return mesh
+        
+    def __pack(self, vertices, indices, transform):
+        " Pack the vertices of a mesh and apply its transform "
+        format = self.vertices.format
+        source = format.pack(vertices)
+        indices = tuple(indices)
+        if len(indices) > 0 and (min(indices) < 0 or max(indices) >= len(source)):
+            raise IndexError('Mesh indices must be in [0, {})'.format(len(source)))
+            
+        packed = source
+        if transform is not None:
+            if self.position is None:
+                raise ValueError('Mesh transforms require a position token')
+            packed = (format.struct*len(source)).from_buffer_copy(source)
+            self.__transform(packed, transform)
+            
+        return [source, packed, indices, transform]
+        
+    def __transform(self, packed, transform):
+        """
+            Apply a 4x4 matrix to the position token of packed vertices. Missing components are 
+            counted as zeros and the w component as 1.
+        """
+        token, values = self.position, tuple(transform)
+        if len(values) == 16 and not any(isinstance(v, Sequence) for v in values):
+            rows = [values[i:i+4] for i in range(0, 16, 4)]
+        elif all(isinstance(v, Sequence) for v in values):
+            rows = [tuple(row) for row in values]
+        else:
+            rows = []
+        if len(rows) != 4 or any(len(row) != 4 for row in rows):
+            raise ValueError('Mesh transforms must be 4x4 matrices')
+            
+        code = token_code(token)
+        view = memoryview(packed).cast('B').cast(code)
+        offset, stride = token.offset//view.itemsize, sizeof(packed._type_)//view.itemsize
+        
+        components = token_components(packed, token, sizeof(packed._type_))
+        components.extend([[0]*len(packed)] * (3-len(components)))
+        if len(components) == 3:
+            components.append([1]*len(packed))
+            
+        for k in range(token.size):
+            m0, m1, m2, m3 = rows[k]
+            values = [m0*x + m1*y + m2*z + m3*w for x, y, z, w in zip(*components)]
+            view[offset+k::stride] = array(code, values)
+            
+    def __indices(self, indices, first_vertex):
+        " Return the packed indices of a mesh, offset by its first vertex if the indices are rebased "
+        code = token_code(self.indices.format.tokens[0])
+        if self.rebase and first_vertex > 0:
+            indices = [i+first_vertex for i in indices]
+            
+        data = array(code, indices)
+        return (self.indices.format.struct*len(data)).from_buffer(data)
+        
+    def __check_range(self, count):
+        " Raise a ValueError if indices up to count do not fit in the index type "
+        unit = sizeof(self.indices.format.tokens[0].type._type_)
+        if count > 2**(8*unit):
+            raise ValueError('{} vertices cannot be indexed by the index format'.format(count))
+            
+    def __len__(self):
+        return sum(1 for mesh in self.meshes if mesh is not None)
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.MeshBatcher = MeshBatcher
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Access profiling of the buffers, to check their usage hint, with optional usage migration.
+
+    Adds:
+        AccessProfile: Access pattern of a buffer
+        usage_report: Return the profiled buffers whose usage hint does not match their accesses
+        Buffer.enable_profile: Record the accesses of the buffer
+        Buffer.migrate_usage: Allocate the buffer storage again with another usage hint
+"""
+
+from time import monotonic
+from weakref import WeakValueDictionary
+from ctypes import c_char
+from pyglet.gl import (GL_STREAM_DRAW, GL_STREAM_READ, GL_STREAM_COPY, GL_STATIC_DRAW,
+  GL_STATIC_READ, GL_STATIC_COPY, GL_DYNAMIC_DRAW, GL_DYNAMIC_READ, GL_DYNAMIC_COPY,
+  GL_READ_ONLY, GL_WRITE_ONLY)
+
+from pyglbuffers import current_upload
+
+#Writes by second from which a buffer is considered as streamed (about once per frame)
+STREAM_WRITE_RATE = 10.0
+
+#Writes by second from which a buffer is considered as dynamic
+DYNAMIC_WRITE_RATE = 0.5
+
+#Number of writes, or seconds, observed before a usage is recommended
+PROFILE_MIN_WRITES = 8
+PROFILE_MIN_TIME = 2.0
+
+#Frequency and nature of the usage hints
+USAGE_HINTS = {GL_STREAM_DRAW: ('STREAM', 'DRAW'), GL_STREAM_READ: ('STREAM', 'READ'), GL_STREAM_COPY: ('STREAM', 'COPY'),
+               GL_STATIC_DRAW: ('STATIC', 'DRAW'), GL_STATIC_READ: ('STATIC', 'READ'), GL_STATIC_COPY: ('STATIC', 'COPY'),
+               GL_DYNAMIC_DRAW: ('DYNAMIC', 'DRAW'), GL_DYNAMIC_READ: ('DYNAMIC', 'READ'), GL_DYNAMIC_COPY: ('DYNAMIC', 'COPY')}
+USAGE_BY_HINTS = {hints: usage for usage, hints in USAGE_HINTS.items()}
+
+#Buffers with an access profile
+PROFILED_BUFFERS = WeakValueDictionary()
+
+class AccessProfile(object):
+    """
+        Access pattern of a buffer, used to check its usage hint. See Buffer.enable_profile.
+        Writes are counted by init, reserve, the item assignments and the mappings with a write
+        access. Read backs are counted by the item reads of unmapped buffers and the mappings
+        with a read access.
+
+        Slots:
+            start: Time (time.monotonic) when the profiling started
+            writes: Number of writes
+            written: Total number of bytes written
+            full_writes: Number of writes that replaced the whole buffer
+            reads: Number of read backs
+            read: Total number of bytes read back
+            maps: Number of mappings
+            auto_migrate: If the buffer is moved to its recommended usage at the next safe point
+            migrations: Number of times the buffer usage was changed by the profiler
+    """
+
+    __slots__ = ['start', 'writes', 'written', 'full_writes', 'reads', 'read', 'maps',
+                 'auto_migrate', 'migrations']
+
+    def __init__(self, auto_migrate=False):
+        self.auto_migrate = auto_migrate
+        self.migrations = 0
+        self.reset()
+
+    def reset(self):
+        " Restart the profiling "
+        self.start = monotonic()
+        self.writes = self.written = self.full_writes = 0
+        self.reads = self.read = self.maps = 0
+
+    def record_write(self, size, full):
+        self.writes += 1
+        self.written += size
+        self.full_writes += full
+
+    def record_read(self, size):
+        self.reads += 1
+        self.read += size
+
+    def record_map(self, access, size):
+        " Called by Buffer.map. The whole buffer is counted as read and/or written "
+        self.maps += 1
+        if access != GL_WRITE_ONLY:
+            self.record_read(size)
+        if access != GL_READ_ONLY:
+            self.record_write(size, True)
+
+    def recommended(self, usage):
+        """
+            Return the usage hint matching the recorded accesses, or None if not enough
+            accesses were recorded yet. The frequency (STREAM, DYNAMIC, STATIC) depends on the
+            rate of the writes (or of the read backs for READ buffers) and the nature becomes
+            READ if the buffer is read back more often than it is written.
+
+            Parameters:
+                usage: Current usage of the buffer
+        """
+        elapsed = monotonic()-self.start
+        if self.writes+self.reads < PROFILE_MIN_WRITES and elapsed < PROFILE_MIN_TIME:
+            return None
+
+        frequency, nature = USAGE_HINTS.get(usage, ('STATIC', 'DRAW'))
+        if self.reads > self.writes:
+            nature = 'READ'
+        elif nature == 'READ':
+            nature = 'DRAW'
+
+        # The first write only fills the buffer
+        events = self.reads if nature == 'READ' else self.writes
+        rate = max(events-1, 0) / max(elapsed, 1e-6)
+
+        if rate >= STREAM_WRITE_RATE and (nature == 'READ' or 2*self.full_writes >= self.writes):
+            frequency = 'STREAM'
+        elif rate >= DYNAMIC_WRITE_RATE:
+            frequency = 'DYNAMIC'
+        else:
+            frequency = 'STATIC'
+
+        return USAGE_BY_HINTS[(frequency, nature)]
+
+    def __repr__(self):
+        return 'AccessProfile(writes={}, written={}, reads={}, read={}, maps={})'.format(self.writes,
+                self.written, self.reads, self.read, self.maps)
+
+def usage_report():
+    """
+        Return the buffers whose usage hint does not match their recorded accesses (see
+        Buffer.enable_profile) as a list of (buffer, usage, recommended usage).
+    """
+    report = []
+    for buffer in list(PROFILED_BUFFERS.values()):
+        if buffer.profile is None:
+            continue
+        recommended = buffer.profile.recommended(buffer._usage)
+        if recommended is not None and recommended != buffer._usage:
+            report.append((buffer, buffer._usage, recommended))
+
+    return report
+
+def enable_profile(self, auto_migrate=False):
+    """
+        Record the accesses of the buffer (see AccessProfile) to check if its usage hint
+        matches the way it is used. Mismatched hints are listed by usage_report.
+
+        If auto_migrate is True, the buffer is moved to its recommended usage at the next
+        safe point: the next init (at no cost, the storage is allocated again anyway) or the next
+        call to collect (the storage is allocated again with migrate_usage).
+
+        To disable the profiling, call disable('profile'). Return the profile.
+    """
+    self.profile = AccessProfile(auto_migrate)
+    PROFILED_BUFFERS[id(self)] = self
+    return self.profile
+
+def migrate_usage(self, usage=None):
+    """
+        Allocate the buffer storage again with another usage hint. The data is kept.
+        Return True if the usage was changed.
+
+        Parameters:
+            usage: New usage. If None, use the usage recommended by the access profile.
+    """
+    if self.mapinfo is not None:
+        raise BufferError("Impossible to change the usage of a mapped buffer")
+
+    if usage is None:
+        if self.profile is None:
+            raise BufferError('Access profiling is not enabled for this buffer')
+        usage = self.profile.recommended(self._usage)
+    if usage is None or usage == self._usage:
+        return False
+
+    size = self.size
+    ops = self._Buffer__edit()
+    if self.diff is not None and self.diff.data is not None:
+        data = self.diff.data
+    else:
+        data = (c_char*size)()
+        ops.get_sub_data(self.bid, self.target, 0, size, data)
+
+    ops.data(self.bid, self.target, size, data, usage)
+    self._Buffer__retag(usage)
+    return True
+
+def migrate_buffers(names):
+    " Called by collect. Move the buffers of a context with an automatic migration to their recommended usage "
+    owner = current_upload()
+    for buffer in list(PROFILED_BUFFERS.values()):
+        profile = buffer.profile
+        if (profile is not None and profile.auto_migrate and buffer.names is names and buffer.owner is owner
+            and buffer.mapinfo is None):
+            migrate_usage(buffer)
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.Buffer.enable_profile = enable_profile
+    pyglbuffers_module.Buffer.migrate_usage = migrate_usage
+    pyglbuffers_module.BUFFER_HOOKS['collect'].append(migrate_buffers)
+    pyglbuffers_module.AccessProfile = AccessProfile
+    pyglbuffers_module.usage_report = usage_report
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Memory accounting and residency management of the buffers, by opengl context.
+
+    Adds:
+        buffer_registry: Return the buffer registry of an opengl context
+        BufferRegistry: Memory used by the buffers of a context and optional LRU residency manager
+        BufferRecord: Memory information of a buffer tracked by a registry
+        Buffer.evictable: If the buffer data can be moved to host memory by its registry
+"""
+
+from time import monotonic
+from weakref import WeakKeyDictionary, WeakValueDictionary
+from ctypes import c_char, c_void_p
+
+from pyglbuffers import current_context, current_upload
+
+class BufferRecord(object):
+    """
+        Memory information of a buffer tracked by a registry.
+
+        Slots:
+            registry: Registry tracking the buffer
+            key: Target and usage of the buffer
+            size: Size of the buffer storage in bytes
+            last_access: Time (time.monotonic) when the buffer was last bound
+            evictable: If the buffer data can be moved to host memory by the residency manager
+            host: Buffer data if it was moved to host memory, None otherwise
+    """
+
+    __slots__ = ['registry', 'key', 'size', 'last_access', 'evictable', 'host']
+
+    def __init__(self, registry, key):
+        self.registry = registry
+        self.key = key
+        self.size = 0
+        self.last_access = monotonic()
+        self.evictable = False
+        self.host = None
+
+class BufferRegistry(object):
+    """
+        Track the memory used by the buffers of an opengl context. Buffers are
+        registered when they are created and the registry is updated when their storage
+        is allocated (init, reserve) or freed. A buffer acquired from an upload context
+        moves to the registry of the render context.
+
+        If a budget is set, the registry also acts as a residency manager: when the
+        resident size goes over the budget, the least recently used evictable buffers
+        are moved to host memory. An evicted buffer is restored when it is next bound.
+
+        Slots:
+            buffers: Tracked buffers by id
+            sizes: Resident bytes by (target, usage)
+            peaks: High-water mark of the resident bytes by (target, usage)
+            total: Resident bytes of all the buffers
+            high_water: High-water mark of total
+            evicted: Bytes moved to host memory
+            budget: Resident bytes allowed before evicting buffers, or None
+            evictions: Number of buffers moved to host memory
+            restorations: Number of buffers restored from host memory
+    """
+
+    __slots__ = ['buffers', 'sizes', 'peaks', 'total', 'high_water', 'evicted', 'budget',
+                 'evictions', 'restorations']
+
+    def __init__(self, budget=None):
+        self.buffers = WeakValueDictionary()
+        self.sizes = {}
+        self.peaks = {}
+        self.total = 0
+        self.high_water = 0
+        self.evicted = 0
+        self.budget = budget
+        self.evictions = 0
+        self.restorations = 0
+
+    def track(self, buffer):
+        " Start tracking a buffer "
+        buffer.record = BufferRecord(self, (buffer.target, buffer._usage))
+        self.buffers[id(buffer)] = buffer
+
+    def untrack(self, buffer):
+        " Stop tracking a buffer. Called when the buffer is freed "
+        record = buffer.record
+        self.buffers.pop(id(buffer), None)
+        if record.host is not None:
+            self.evicted -= record.size
+        else:
+            self.__account(record.key, -record.size)
+
+    def adopt(self, buffer):
+        " Move a buffer, with its storage, from the registry tracking it to this registry "
+        record = buffer.record
+        record.registry.untrack(buffer)
+        record.registry = self
+        self.buffers[id(buffer)] = buffer
+        if record.host is not None:
+            self.evicted += record.size
+        else:
+            self.__account(record.key, record.size)
+
+    def resize(self, buffer, size):
+        " Update the size of a buffer storage. Called after glBufferData "
+        record = buffer.record
+        self.__account(record.key, size-record.size)
+        record.size = size
+
+        if self.budget is not None and self.total > self.budget:
+            self.collect(exclude=buffer)
+            buffer.ops.prepare(buffer.bid, buffer.target)
+
+    def retag(self, buffer, usage):
+        " Account the storage of a buffer under a new usage "
+        record = buffer.record
+        size = record.size
+        self.resize(buffer, 0)
+        record.key = (buffer.target, usage)
+        self.resize(buffer, size)
+
+    def touch(self, buffer):
+        " Update the last access time of a buffer and restore it if it was evicted. Called when the buffer is bound "
+        record = buffer.record
+        record.last_access = monotonic()
+
+        if record.host is not None:
+            ops = buffer.ops
+            ops.prepare(buffer.bid, buffer.target)
+            ops.data(buffer.bid, buffer.target, record.size, record.host, buffer._usage)
+            record.host = None
+            self.evicted -= record.size
+            self.restorations += 1
+            self.__account(record.key, record.size)
+
+            if self.budget is not None and self.total > self.budget:
+                self.collect(exclude=buffer)
+
+    def evict(self, buffer):
+        """
+            Move the data of a buffer to host memory and free its storage. Mapped buffers
+            and buffers already evicted are ignored.
+        """
+        record = buffer.record
+        if record.host is not None or record.size == 0 or buffer.mapinfo is not None:
+            return
+
+        host, ops = (c_char*record.size)(), buffer.ops
+        ops.prepare(buffer.bid, buffer.target)
+        ops.get_sub_data(buffer.bid, buffer.target, 0, record.size, host)
+        ops.data(buffer.bid, buffer.target, 0, c_void_p(0), buffer._usage)
+
+        record.host = host
+        self.evicted += record.size
+        self.evictions += 1
+        self.__account(record.key, -record.size)
+
+    def collect(self, exclude=None):
+        " Evict the least recently used evictable buffers until the resident size is under the budget "
+        if self.budget is None:
+            return
+
+        owner = current_upload()
+        candidates = [b for b in list(self.buffers.values()) if b is not exclude and b.record.evictable
+                      and b.record.host is None and b.record.size > 0 and b.owner is owner]
+        for buffer in sorted(candidates, key=lambda b: b.record.last_access):
+            if self.total <= self.budget:
+                break
+            self.evict(buffer)
+
+    def __account(self, key, delta):
+        " Update the resident sizes "
+        self.sizes[key] = size = self.sizes.get(key, 0) + delta
+        self.peaks[key] = max(self.peaks.get(key, 0), size)
+        self.total += delta
+        self.high_water = max(self.high_water, self.total)
+
+#Buffer registry of each opengl context
+CONTEXT_REGISTRIES = WeakKeyDictionary()
+DEFAULT_REGISTRY = BufferRegistry()
+
+def buffer_registry(context=None):
+    """
+        Return the buffer registry of an opengl context.
+
+        Arguments:
+            context: Pyglet context. If None, use the current context.
+    """
+    context = context if context is not None else current_context()
+    if context is None:
+        return DEFAULT_REGISTRY
+
+    registry = CONTEXT_REGISTRIES.get(context)
+    if registry is None:
+        registry = CONTEXT_REGISTRIES[context] = BufferRegistry()
+
+    return registry
+
+def track(buffer):
+    " Track a buffer created in the current context "
+    buffer_registry().track(buffer)
+
+def adopt(buffer):
+    " Move a buffer acquired from an upload context to the registry of the current context "
+    if buffer.record is not None:
+        buffer_registry().adopt(buffer)
+
+def get_evictable(buffer):
+    """
+        If the residency manager can move the buffer data to host memory when the
+        registry budget is exceeded (see BufferRegistry). Default to False.
+    """
+    return buffer.record is not None and buffer.record.evictable
+
+def set_evictable(buffer, value):
+    if buffer.record is None:
+        raise BufferError('Buffer is not tracked by a registry')
+    buffer.record.evictable = value
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.Buffer.evictable = property(get_evictable, set_evictable)
+    pyglbuffers_module.BUFFER_HOOKS['track'].append(track)
+    pyglbuffers_module.BUFFER_HOOKS['adopt'].append(adopt)
+    pyglbuffers_module.buffer_registry = buffer_registry
+    pyglbuffers_module.BufferRegistry = BufferRegistry
+    pyglbuffers_module.BufferRecord = BufferRecord
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+
+"""
+    CPU side spatial index over a position token, for picking and proximity queries
+    without reading the buffers back.
+
+    Adds:
+        SpatialIndex: Uniform grid over the positions of a buffer token
+        Buffer.enable_spatial_index: Build a spatial index over a position token of the buffer
+"""
+
+from array import array
+from math import floor
+
+from pyglbuffers import token_code
+
+class SpatialIndex(object):
+    """
+        CPU side uniform grid over the positions of a buffer token, used to answer picking
+        and proximity queries without reading the buffer back. Positions are hashed in cubic
+        cells of "cell_size"; the queries only look at the cells that can hold a result.
+        Missing components are counted as zeros, like when they are packed.
+
+        The positions are stored in arrays of the token type, so they have the same value as
+        in the buffer (ex: floats are rounded to 32 bits) whether they were written by init or
+        by an item assignment. Writes only move the elements whose cell changed.
+
+        If the cell size is computed, it is computed when the index is built and again when
+        the number of elements is halved or doubled, which rebuilds the grid.
+
+        Spatial indices are created with Buffer.enable_spatial_index.
+
+        Slots:
+            token: Indexed token
+            cell_size: Size of the grid cells
+            auto_size: If the cell size is computed from the bounds of the positions
+            sized: Number of elements when the cell size was computed, or 0
+            coords: Positions of the elements, as an array of values for each component
+            keys: Cell of each element
+            cells: Indices of the elements of each non empty cell
+            lower: Lowest cell coordinates
+            upper: Highest cell coordinates
+    """
+
+    __slots__ = ['token', 'cell_size', 'auto_size', 'sized', 'coords', 'keys', 'cells', 'lower', 'upper']
+
+    #Average number of elements by cell when the cell size is computed
+    CELL_OCCUPANCY = 2
+
+    def __init__(self, token, cell_size=None):
+        if cell_size is not None and cell_size <= 0:
+            raise ValueError('Cell size must be greater than 0')
+
+        self.token = token
+        self.cell_size = cell_size if cell_size is not None else 1.0
+        self.auto_size = cell_size is None
+        self.sized = 0
+        self.coords = [array(token_code(token)) for i in range(token.size)]
+        self.keys = []
+        self.cells = {}
+        self.lower = self.upper = None
+
+    def assign(self, components):
+        """
+            Set the position of every element from the values of each component of the
+            token (as returned by token_components). The number of elements can change.
+        """
+        count = len(components[0])
+        if len(self.keys) == 0 or not self.__sized(count):
+            code = self.coords[0].typecode
+            self.coords = [array(code, values) for values in components]
+            self.__fit()
+            self.__rebuild()
+        else:
+            self.resize(count, len(self.keys))
+            self.write(range(count), components)
+
+    def write(self, indices, components):
+        """
+            Move the elements at indices to the positions given by the values of each component.
+            The values must be of the token type (ex: unpacked from the buffer data).
+        """
+        coords, keys, cells = self.coords, self.keys, self.cells
+        if isinstance(indices, range) and indices.step == 1:
+            for axis, values in zip(coords, components):
+                axis[indices.start:indices.stop] = array(axis.typecode, values)
+        else:
+            for axis, values in zip(coords, components):
+                for index, value in zip(indices, values):
+                    axis[index] = value
+
+        axis_keys = self.__axis_keys(components)
+        for index, key in zip(indices, zip(*axis_keys)):
+            old = keys[index]
+            if old != key:
+                cell = cells[old]
+                cell.discard(index)
+                if len(cell) == 0:
+                    del cells[old]
+                cells.setdefault(key, set()).add(index)
+                keys[index] = key
+
+        self.__grow(axis_keys)
+
+    def update(self, indices, points):
+        """
+            Move the elements at indices to new positions. The positions are converted
+            to the token type, like when they are packed.
+        """
+        size, ctype = self.token.size, self.token.type._type_
+        flat = [c for point in points for c in tuple(point) + (0,)*(size-len(point))]
+        view = memoryview((ctype*len(flat))(*flat)).cast('B').cast(token_code(self.token))
+        self.write(indices, [view[k::size].tolist() for k in range(size)])
+
+    def resize(self, length, keep=None):
+        """
+            Set the number of elements. The elements from "keep" (default to the current
+            number of elements) are set at the origin, like zeroed buffer elements.
+        """
+        count, keys, cells = len(self.keys), self.keys, self.cells
+        keep = min(count if keep is None else keep, count, length)
+
+        if keep == 0:
+            cells.clear()
+            self.lower = self.upper = None
+        else:
+            for index in range(keep, count):
+                cell = cells[keys[index]]
+                cell.discard(index)
+                if len(cell) == 0:
+                    del cells[keys[index]]
+
+        del keys[keep:]
+        for axis in self.coords:
+            del axis[keep:]
+            axis.frombytes(bytes(axis.itemsize*(length-keep)))
+
+        if length > keep:
+            origin = self.__cell((0,)*self.token.size)
+            keys.extend([origin]*(length-keep))
+            cells.setdefault(origin, set()).update(range(keep, length))
+            self.__grow([[c] for c in origin])
+
+    def refit(self):
+        """
+            Compute the cell size again and rebuild the grid if the cell size is computed
+            and the number of elements was halved or doubled since it was last computed.
+            Return True if the grid was rebuilt.
+        """
+        if self.__sized(len(self.keys)):
+            return False
+
+        self.__fit()
+        self.__rebuild()
+        return True
+
+    def nearest(self, point, count=1, max_distance=None):
+        """
+            Return the indices of the "count" elements nearest to a point, sorted by distance.
+
+            Parameters:
+                point: Query position
+                count: Number of elements to return. Default to 1.
+                max_distance: Ignore the elements further than this distance.
+        """
+        if len(self.cells) == 0 or count < 1:
+            return []
+
+        point = self.__pad(point)
+        center = self.__cell(point)
+        limit = float('inf') if max_distance is None else max_distance*max_distance
+
+        # Number of rings of cells around the center cell that can hold an element
+        last_ring = max(max(abs(c-l), abs(c-u)) for c, l, u in zip(center, self.lower, self.upper))
+        if max_distance is not None:
+            last_ring = min(last_ring, int(max_distance/self.cell_size)+1)
+
+        first_ring = max(max(l-c, c-u, 0) for c, l, u in zip(center, self.lower, self.upper))
+
+        found = []
+        for ring in range(first_ring, last_ring+1):
+            for cell in self.__ring(center, ring):
+                for index in self.cells.get(cell, ()):
+                    distance = self.__distance(point, index)
+                    if distance <= limit:
+                        found.append((distance, index))
+
+            # Elements in the next rings are at least "ring" cells away
+            found.sort()
+            del found[count:]
+            bound = ring*self.cell_size
+            if len(found) == count and found[-1][0] <= bound*bound:
+                break
+
+        return [index for distance, index in found]
+
+    def radius(self, point, radius):
+        """
+            Return the indices of the elements within "radius" of a point, sorted by index.
+
+            Parameters:
+                point: Query position
+                radius: Query radius
+        """
+        if len(self.cells) == 0:
+            return []
+
+        point = self.__pad(point)
+        low = self.__cell([c-radius for c in point])
+        high = self.__cell([c+radius for c in point])
+        ranges = [range(max(l, bl), min(h, bu)+1) for l, h, bl, bu in zip(low, high, self.lower, self.upper)]
+
+        found, limit = [], radius*radius
+        for cell in self.__cells(ranges):
+            for index in self.cells.get(cell, ()):
+                if self.__distance(point, index) <= limit:
+                    found.append(index)
+
+        return sorted(found)
+
+    def ray(self, origin, direction, distance, max_length=None):
+        """
+            Return the indices of the elements within "distance" of a ray (ex: for mouse picking),
+            sorted by their position along the ray. The cells crossed by the ray are walked in
+            order (3D DDA) and, for each of them, only the cells overlapped by the part of the ray
+            inside it, grown by "distance", are checked.
+
+            Parameters:
+                origin: Origin of the ray
+                direction: Direction of the ray. Does not have to be normalized.
+                distance: Maximum distance between the ray and an element
+                max_length: Length of the ray. If None, the ray is infinite.
+        """
+        origin, direction = self.__pad(origin), self.__pad(direction)
+        norm = sum(d*d for d in direction) ** 0.5
+        if len(self.cells) == 0 or norm == 0:
+            return []
+
+        direction = [d/norm for d in direction]
+        size = self.cell_size
+
+        # Clip the ray to the grid bounds, grown by the query distance
+        end = float('inf') if max_length is None else max_length
+        enter, leave = 0.0, end
+        for o, d, l, u in zip(origin, direction, self.lower, self.upper):
+            low, high = l*size-distance, (u+1)*size+distance
+            if d == 0:
+                if o < low or o > high:
+                    return []
+            else:
+                t1, t2 = (low-o)/d, (high-o)/d
+                enter, leave = max(enter, min(t1, t2)), min(leave, max(t1, t2))
+
+        if enter > leave:
+            return []
+
+        # Ray parameter of the next cell boundary on each axis (Amanatides & Woo)
+        cell = self.__cell([o+d*enter for o, d in zip(origin, direction)])
+        deltas = [size/abs(d) if d != 0 else float('inf') for d in direction]
+        bounds = [((c+(d > 0))*size-o)/d if d != 0 else float('inf') for c, o, d in zip(cell, origin, direction)]
+
+        visited, found, limit = set(), {}, distance*distance
+        t = enter
+        while True:
+            t_next = min(min(bounds), leave)
+            a = [o+d*t for o, d in zip(origin, direction)]
+            b = [o+d*t_next for o, d in zip(origin, direction)]
+            low = self.__cell([min(x, y)-distance for x, y in zip(a, b)])
+            high = self.__cell([max(x, y)+distance for x, y in zip(a, b)])
+
+            for near in self.__cells([range(l, h+1) for l, h in zip(low, high)]):
+                if near in visited:
+                    continue
+                visited.add(near)
+                for index in self.cells.get(near, ()):
+                    p = [axis[index] for axis in self.coords]
+                    along = sum((x-o)*d for x, o, d in zip(p, origin, direction))
+                    along = min(max(along, 0.0), end)
+                    if sum((x-o-d*along)**2 for x, o, d in zip(p, origin, direction)) <= limit:
+                        found[index] = along
+
+            if t_next >= leave:
+                break
+
+            axis = bounds.index(t_next)
+            t = t_next
+            bounds[axis] += deltas[axis]
+
+        return sorted(found, key=lambda index: (found[index], index))
+
+    def __sized(self, count):
+        " Check if the cell size can be kept for a number of elements "
+        sized = self.sized
+        return not self.auto_size or count == 0 or (sized > 0 and sized//2 <= count <= sized*2)
+
+    def __fit(self):
+        " Compute the cell size from the bounds of the positions "
+        count = len(self.coords[0])
+        if not self.auto_size or count == 0:
+            return
+
+        extents = [max(axis)-min(axis) for axis in self.coords]
+        extents = [e for e in extents if e > 0]
+        if len(extents) == 0:
+            self.sized = 0
+            return
+
+        volume = 1.0
+        for e in extents:
+            volume *= e
+
+        self.cell_size = (volume*self.CELL_OCCUPANCY/count) ** (1/len(extents))
+        self.sized = count
+
+    def __rebuild(self):
+        " Hash every element again "
+        axis_keys = self.__axis_keys(self.coords)
+        self.keys = keys = list(zip(*axis_keys))
+        self.cells = cells = {}
+        for index, key in enumerate(keys):
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = {index}
+            else:
+                cell.add(index)
+
+        self.lower = self.upper = None
+        self.__grow(axis_keys)
+
+    def __axis_keys(self, components):
+        " Return the cell coordinates of values of each component "
+        size = self.cell_size
+        return [[floor(v/size) for v in values] for values in components]
+
+    def __grow(self, axis_keys):
+        " Grow the grid bounds to include cells given by their coordinates on each axis "
+        if len(axis_keys[0]) == 0:
+            return
+
+        lower, upper = tuple(min(k) for k in axis_keys), tuple(max(k) for k in axis_keys)
+        if self.lower is None:
+            self.lower, self.upper = lower, upper
+        else:
+            self.lower = tuple(map(min, self.lower, lower))
+            self.upper = tuple(map(max, self.upper, upper))
+
+    def __pad(self, point):
+        point = tuple(point)
+        return point + (0,)*(self.token.size-len(point))
+
+    def __cell(self, point):
+        size = self.cell_size
+        return tuple(floor(c/size) for c in point)
+
+    def __distance(self, point, index):
+        " Squared distance between a point and an element "
+        return sum((c-axis[index])**2 for c, axis in zip(point, self.coords))
+
+    @staticmethod
+    def __cells(ranges):
+        " Iterate over the cells of a block of cells "
+        cells = [()]
+        for r in ranges:
+            cells = [cell+(c,) for cell in cells for c in r]
+        return cells
+
+    def __ring(self, center, ring):
+        " Return the cells of the grid bounds at exactly 'ring' cells from the center (Chebyshev distance) "
+        if ring == 0:
+            return [center]
+
+        cells, lower, upper = [], self.lower, self.upper
+        for axis, c in enumerate(center):
+            for side in (c-ring, c+ring):
+                if side < lower[axis] or side > upper[axis]:
+                    continue
+
+                # The faces of the previous axes are excluded so that no cell is returned twice
+                ranges = []
+                for j, (cj, low, high) in enumerate(zip(center, lower, upper)):
+                    if j == axis:
+                        ranges.append((side,))
+                    else:
+                        inner = 1 if j < axis else 0
+                        ranges.append(range(max(cj-ring+inner, low), min(cj+ring-inner, high)+1))
+                cells.extend(self.__cells(ranges))
+
+        return cells
+
+    def __len__(self):
+        return len(self.keys)
+
+def enable_spatial_index(self, name, cell_size=None):
+    """
+        Build a spatial index (see SpatialIndex) over a position token of the buffer. The index
+        is kept in sync with the values written by init, reserve, init_stream and the item assignments,
+        so picking and proximity queries never read the buffer back. Values written directly
+        in the mapped memory (ex: with ctypes) are not seen by the index.
+
+        To disable the index, call disable('spatial_index'). Return the index.
+
+        Parameters:
+            name: Name of the position token
+            cell_size: Size of the grid cells. If None, the size is computed from the bounds of the positions.
+    """
+    tokens = {t.name: t for t in self.format.tokens}
+    if name not in tokens:
+        raise KeyError('No token named "{}" in the buffer format'.format(name))
+
+    self.spatial = SpatialIndex(tokens[name], cell_size)
+    if self.valid() and self.size > 0:
+        self.spatial.assign(self._Buffer__components(tokens[name]))
+
+    return self.spatial
+
+def supported():
+    "Always supported"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.Buffer.enable_spatial_index = enable_spatial_index
+    pyglbuffers_module.SpatialIndex = SpatialIndex
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Asynchronous texture streaming through a ring of pixel unpack buffers
+    (GL_ARB_pixel_buffer_object and GL_ARB_sync).
+
+    Adds:
+        TextureStream: Queue of texture uploads streamed through a ring of pixel unpack buffers
+        TextureUpload: Pending upload of a TextureStream
+"""
+
+from collections import deque
+from ctypes import addressof, cast, memmove, byref, c_char, c_char_p, c_void_p
+from pyglet.gl import (gl_info, GLint, glBindBuffer, glBindTexture, glTexSubImage2D,
+  glTextureSubImage2D, glPixelStorei, glGetIntegerv, glFenceSync, glClientWaitSync, glDeleteSync,
+  GL_PIXEL_UNPACK_BUFFER, GL_UNPACK_ALIGNMENT, GL_TEXTURE_2D, GL_RGBA, GL_UNSIGNED_BYTE,
+  GL_STREAM_DRAW, GL_WRITE_ONLY, GL_SYNC_GPU_COMMANDS_COMPLETE, GL_TIMEOUT_EXPIRED, GL_WAIT_FAILED)
+
+import pyglbuffers
+from pyglbuffers import Buffer
+
+#Alignment, in bytes, of the uploads offsets in a pixel unpack buffer
+UPLOAD_ALIGNMENT = 16
+
+class TextureUpload(object):
+    """
+        Pending upload of a TextureStream. Uploads are split in bands of rows
+        when they do not fit in a single pixel unpack buffer.
+
+        Slots:
+            texture: Name of the texture
+            target: Texture target (ex: GL_TEXTURE_2D)
+            level: Mipmap level
+            x, y: Offset of the uploaded rectangle in the texture
+            width, height: Size of the uploaded rectangle
+            format, type: Format and type of the pixels
+            data: Pixels (kept alive until the upload is done)
+            address: Address of the pixels
+            row_size: Size of a row of pixels in bytes
+            row: Next row to upload
+            callback: Function called when the last rows were uploaded, or None
+    """
+
+    __slots__ = ['texture', 'target', 'level', 'x', 'y', 'width', 'height', 'format', 'type',
+                 'data', 'address', 'row_size', 'row', 'callback']
+
+    def done(self):
+        " Return True if every row was uploaded "
+        return self.row == self.height
+
+class TextureStream(object):
+    """
+        Queue of texture uploads streamed through a small ring of pixel unpack buffers.
+
+        Each call to pump fills the next free buffer of the ring with the pixels of the
+        pending uploads, either by mapping it or with glBufferSubData directly from the
+        pixels memory, then issues the texture uploads from their offset in the buffer. A fence
+        is inserted after the uploads and the buffer is reused only when the GPU is done with it,
+        so pump never waits for the GPU. The number of bytes uploaded by a call to pump is limited
+        by the budget, which keeps large streams from causing frame time spikes.
+
+        Pixel rows must be tightly packed (GL_UNPACK_ALIGNMENT is set to 1 during the uploads).
+
+        Slots:
+            buffers: Ring of pixel unpack buffers
+            fences: Fence of each buffer, or None if the buffer is free
+            index: Index of the next buffer of the ring
+            queue: Pending uploads (TextureUpload)
+            budget: Maximum number of bytes uploaded by a call to pump
+            mapped: If the buffers are filled by mapping them (True) or with glBufferSubData (False)
+            uploaded: Total number of bytes uploaded
+            stalls: Number of times pump stopped early because the next buffer was still used by the GPU
+    """
+
+    __slots__ = ['buffers', 'fences', 'index', 'queue', 'budget', 'mapped', 'uploaded', 'stalls']
+
+    def __init__(self, count=3, size=4*1024*1024, budget=8*1024*1024, mapped=True, usage=GL_STREAM_DRAW):
+        self.buffers = []
+        for i in range(count):
+            buffer = Buffer.pixel_unpack('(1B)[byte]', usage)
+            buffer.reserve(size)
+            self.buffers.append(buffer)
+
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.fences = [None]*count
+        self.index = 0
+        self.queue = deque()
+        self.budget = budget
+        self.mapped = mapped
+        self.uploaded = 0
+        self.stalls = 0
+
+    @property
+    def buffer_size(self):
+        " Size of a pixel unpack buffer of the ring in bytes "
+        return len(self.buffers[0])
+
+    def upload(self, texture, width, height, data, format=GL_RGBA, type=GL_UNSIGNED_BYTE,
+               target=GL_TEXTURE_2D, level=0, x=0, y=0, callback=None):
+        """
+            Queue the upload of pixels in a texture (see glTexSubImage2D). The pixels are
+            uploaded by the next calls to pump. Return the queued upload.
+
+            Parameters:
+                texture: Name of the texture
+                width, height: Size of the uploaded rectangle
+                data: Pixels. Any object supporting the buffer protocol (ex: bytes, bytearray, ctypes arrays).
+                      The pixels are read directly from its memory, so it must not be modified until the upload is done.
+                format, type: Format and type of the pixels. Default to GL_RGBA and GL_UNSIGNED_BYTE.
+                target: Texture target. Default to GL_TEXTURE_2D.
+                level: Mipmap level. Default to 0.
+                x, y: Offset of the rectangle in the texture. Default to 0.
+                callback: Function called with the upload when its last rows were uploaded. Optional.
+        """
+        view = memoryview(data).cast('B')
+        if height <= 0 or len(view) % height != 0:
+            raise ValueError('Pixels size ({} bytes) do not match the texture height ({})'.format(len(view), height))
+
+        row_size = len(view) // height
+        if row_size > self.buffer_size:
+            raise ValueError('A row of pixels ({} bytes) do not fit in a pixel unpack buffer'.format(row_size))
+
+        if isinstance(data, bytes):
+            address = cast(c_char_p(data), c_void_p).value
+        elif view.readonly:
+            data = bytearray(view)
+            address = addressof(c_char.from_buffer(data))
+        else:
+            address = addressof(c_char.from_buffer(view))
+
+        upload = TextureUpload()
+        upload.texture, upload.target, upload.level = getattr(texture, 'value', texture), target, level
+        upload.x, upload.y, upload.width, upload.height = x, y, width, height
+        upload.format, upload.type = format, type
+        upload.data, upload.address, upload.row_size, upload.row = data, address, row_size, 0
+        upload.callback = callback
+
+        self.queue.append(upload)
+        return upload
+
+    def pump(self):
+        """
+            Upload the pending pixels until the budget is spent, the queue is empty or the next
+            buffer of the ring is still used by the GPU. Should be called once per frame.
+            Return the number of bytes uploaded.
+        """
+        spent = 0
+        alignment = GLint()
+        glGetIntegerv(GL_UNPACK_ALIGNMENT, byref(alignment))
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+
+        try:
+            while len(self.queue) > 0 and spent < self.budget:
+                if not self.__acquire(self.index):
+                    self.stalls += 1
+                    break
+
+                bands, size = self.__plan(self.budget-spent)
+                if len(bands) == 0:
+                    break
+
+                buffer = self.buffers[self.index]
+                self.__fill(buffer, bands)
+                self.__issue(buffer, bands)
+
+                self.fences[self.index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+                self.index = (self.index+1) % len(self.buffers)
+                spent += size
+        finally:
+            glPixelStorei(GL_UNPACK_ALIGNMENT, alignment.value)
+
+        self.uploaded += spent
+        return spent
+
+    def __acquire(self, index):
+        """
+            Return True if the buffer at index is not used by the GPU anymore. Raise
+            a BufferError if waiting for its fence failed.
+        """
+        fence = self.fences[index]
+        if fence is None:
+            return True
+
+        status = glClientWaitSync(fence, 0, 0)
+        if status == GL_TIMEOUT_EXPIRED:
+            return False
+
+        glDeleteSync(fence)
+        self.fences[index] = None
+        if status == GL_WAIT_FAILED:
+            raise BufferError('Failed to wait for the pixel unpack buffer fence')
+
+        return True
+
+    def __plan(self, budget):
+        """
+            Split the pending uploads in bands of rows that fit in a buffer and in the budget.
+            Return the bands as (upload, first row, rows, offset) and the used size.
+        """
+        bands, offset, size = [], 0, self.buffer_size
+        for upload in self.queue:
+            rows_left = upload.height - upload.row
+            rows = min(rows_left, (size-offset)//upload.row_size, max(budget-offset, 0)//upload.row_size)
+
+            # A single row is always uploaded so that a budget smaller than a row do not stall the queue
+            if rows == 0 and offset == 0:
+                rows = 1
+            if rows == 0:
+                break
+
+            bands.append((upload, upload.row, rows, offset))
+            offset += rows*upload.row_size
+            offset += -offset % UPLOAD_ALIGNMENT
+            if rows != rows_left or offset >= size:
+                break
+
+        return bands, min(offset, size)
+
+    def __fill(self, buffer, bands):
+        " Copy the pixels of the bands in a buffer "
+        if self.mapped:
+            buffer.map(GL_WRITE_ONLY)
+            base = addressof(buffer.mapinfo.ptr.contents)
+            for upload, row, rows, offset in bands:
+                memmove(base+offset, upload.address+row*upload.row_size, rows*upload.row_size)
+            buffer.unmap()
+        else:
+            ops = buffer._Buffer__edit()
+            for upload, row, rows, offset in bands:
+                ops.sub_data(buffer.bid, buffer.target, offset, rows*upload.row_size,
+                             c_void_p(upload.address+row*upload.row_size))
+
+    def __issue(self, buffer, bands):
+        " Upload the bands from the buffer to their textures "
+        named = pyglbuffers.capabilities().named
+        buffer.bind(GL_PIXEL_UNPACK_BUFFER)
+
+        for upload, row, rows, offset in bands:
+            if named:
+                glTextureSubImage2D(upload.texture, upload.level, upload.x, upload.y+row, upload.width,
+                                    rows, upload.format, upload.type, c_void_p(offset))
+            else:
+                glBindTexture(upload.target, upload.texture)
+                glTexSubImage2D(upload.target, upload.level, upload.x, upload.y+row, upload.width,
+                                rows, upload.format, upload.type, c_void_p(offset))
+
+            upload.row = row+rows
+            if upload.done():
+                self.queue.popleft()
+                upload.data = None
+                if upload.callback is not None:
+                    upload.callback(upload)
+
+        glBindBuffer(GL_PIXEL_UNPACK_BUFFER, 0)
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __del__(self):
+        # Finalizers can run on any thread, the fences are deleted with the buffers
+        for fence in getattr(self, 'fences', ()):
+            if fence is not None:
+                self.buffers[0].names.release_fence(fence)
+
+def supported():
+    "Requires OpenGL >= 3.2 (or GL_ARB_pixel_buffer_object and GL_ARB_sync)"
+    return gl_info.have_version(3, 2) or (gl_info.have_extension('GL_ARB_pixel_buffer_object') and
+                                          gl_info.have_extension('GL_ARB_sync'))
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.TextureStream = TextureStream
+    pyglbuffers_module.TextureUpload = TextureUpload
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Buffers created and filled by a loader thread on a shared context (GL_ARB_sync).
+
+    Adds:
+        UploadContext: Secondary opengl context whose buffers are handed to the render context with a fence
+"""
+
+from collections import deque
+from threading import current_thread
+from pyglet.gl import (glBindBuffer, glFenceSync, glClientWaitSync, glDeleteSync, glFlush,
+  GL_SYNC_GPU_COMMANDS_COMPLETE, GL_TIMEOUT_EXPIRED, GL_WAIT_FAILED)
+
+from pyglbuffers import (THREAD_STATE, IN_TRANSIT, BUFFER_HOOKS, FENCE_TIMEOUT, current_upload,
+  capabilities, buffer_names, buffer_ops)
+
+class UploadContext(object):
+    """
+        Secondary opengl context used by a loader thread to create and fill buffers without
+        blocking the render thread. The pyglet context must share its objects with the render 
+        context (ex: config.create_context(share=window.context)). Requires OpenGL 3.2 (or GL_ARB_sync).
+        
+        While the upload context is current on a thread (with statement), the buffers created on
+        this thread are owned by the upload context and are filled with the usual api
+        (ex: Buffer.array(format).init(data)). The loader thread hands them to the render context
+        with release, which inserts a fence. The render thread calls acquire, which returns the released
+        buffers once their fence is signaled, when their data is guaranteed to be visible in the render context.
+        A buffer can only be used by the context that owns it, using it from another context raises a BufferError.
+        
+        By default, headless (EGL) contexts are made current directly on the loader thread. Other pyglet
+        contexts require a make_current function that makes the context current with the platform api
+        (ex: wglMakeCurrent, glXMakeCurrent) on the calling thread, and releases it when called with None.
+        Context.set_current cannot be used, because it also changes the pyglet current context, which is shared by every thread.
+        
+        Slots:
+            context: Pyglet context of the upload context
+            make_current: Function called with the context to make it current on the calling thread and with None to release it, or None
+            thread: Thread on which the upload context is current, or None
+            targets: Targets bound in the upload context since the last release
+            handoffs: Released buffers waiting for their fence, as (fence, buffers)
+            released: Number of buffers released
+            acquired: Number of buffers acquired
+            names: Names pool of the context that created the upload context, deletes the fences left when it is collected
+    """
+    
+    __slots__ = ['context', 'make_current', 'thread', 'targets', 'handoffs', 'released', 'acquired', 'names']
+    
+    def __init__(self, context, make_current=None):
+        if not capabilities().sync:
+            raise BufferError('Upload contexts require OpenGL 3.2 or GL_ARB_sync')
+        if make_current is None and not hasattr(context, 'egl_context'):
+            raise ValueError('Upload contexts that are not headless (EGL) contexts require a make_current function')
+            
+        self.context = context
+        self.make_current = make_current
+        self.thread = None
+        self.targets = set()
+        self.handoffs = deque()
+        self.released = 0
+        self.acquired = 0
+        self.names = buffer_names()
+        
+    def release(self, *buffers):
+        """
+            Hand buffers to the render context. Must be called on the thread of the upload context.
+            The buffers cannot be used until they are returned by acquire.
+        """
+        if current_upload() is not self:
+            raise BufferError('Buffers must be released on the thread of their upload context')
+            
+        for buffer in buffers:
+            if buffer.owner is not self:
+                raise BufferError('Buffer is not owned by this upload context')
+            if buffer.mapinfo is not None:
+                raise BufferError('Impossible to release a mapped buffer')
+        
+        # Bindings are per context, the released buffers must not stay bound in the upload context
+        for target in self.targets:
+            glBindBuffer(target, 0)
+        self.targets.clear()
+            
+        for buffer in buffers:
+            buffer.owner = IN_TRANSIT
+            
+        fence = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        glFlush()
+        self.handoffs.append((fence, buffers))
+        self.released += len(buffers)
+        
+    def acquire(self, wait=False):
+        """
+            Return the released buffers whose fence is signaled, in the order they were released.
+            The buffers are then owned by the context current on the calling thread.
+            
+            Arguments:
+                wait: If True, wait until all the buffers released so far are ready. Default to False.
+        """
+        buffers, owner = [], current_upload()
+        names, ops = buffer_names(), buffer_ops()
+        
+        while len(self.handoffs) > 0:
+            fence, released = self.handoffs[0]
+            status = glClientWaitSync(fence, 0, 0)
+            while wait and status == GL_TIMEOUT_EXPIRED:
+                status = glClientWaitSync(fence, 0, FENCE_TIMEOUT)
+                
+            if status == GL_TIMEOUT_EXPIRED:
+                break
+                
+            self.handoffs.popleft()
+            glDeleteSync(fence)
+            if status == GL_WAIT_FAILED:
+                raise BufferError('Failed to wait for the upload fence')
+                
+            for buffer in released:
+                buffer.owner, buffer.names, buffer.ops = owner, names, ops
+                
+                # The buffer is bound again so that the changes made by the upload context are visible
+                glBindBuffer(buffer.target, buffer.bid)
+                if owner is not None:
+                    owner.targets.add(buffer.target)
+                    
+                for adopt in BUFFER_HOOKS['adopt']:
+                    adopt(buffer)
+                    
+            buffers.extend(released)
+            
+        self.acquired += len(buffers)
+        return buffers
+        
+    def __switch(self, current):
+        " Make the context current on the calling thread or release it. The pyglet current context is not changed. "
+        context = self.context
+        if self.make_current is not None:
+            self.make_current(context if current else None)
+        else:
+            from pyglet.libs.egl import egl
+            surface = getattr(context, 'egl_surface', None)
+            if not egl.eglMakeCurrent(context.display_connection, surface, surface, context.egl_context if current else None):
+                raise BufferError('Failed to make the upload context current')
+            
+    def __enter__(self):
+        if self.thread is not None:
+            raise BufferError('Upload context is already current on another thread')
+        if current_upload() is not None:
+            raise BufferError('Another upload context is current on this thread')
+            
+        self.__switch(True)
+        self.thread = current_thread()
+        THREAD_STATE.upload = self
+        return self
+        
+    def __exit__(self, *args):
+        glFlush()
+        THREAD_STATE.upload = None
+        self.thread = None
+        self.__switch(False)
+        
+    def __len__(self):
+        return sum(len(buffers) for fence, buffers in self.handoffs)
+        
+    def __del__(self):
+        # Finalizers can run on any thread, the fences are deleted by the context that created the upload context
+        for fence, buffers in getattr(self, 'handoffs', ()):
+            self.names.release_fence(fence)
+
+def supported():
+    "Always supported. Upload contexts check for OpenGL 3.2 or GL_ARB_sync when they are created"
+    return True
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.UploadContext = UploadContext
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Vertex array objects built from the buffers attribute layouts (GL_ARB_vertex_array_object).
+    
+    Adds:
+        VertexArrayCache: Cache of vertex array objects keyed by buffers and attribute locations
+"""
+
+from ctypes import byref, c_void_p
+from weakref import ref
+from pyglet.gl import (gl_info, GLuint, glGenVertexArrays, glBindVertexArray,
+  glDeleteVertexArrays, glEnableVertexAttribArray, glVertexAttribPointer, glVertexAttribIPointer,
+  GL_ARRAY_BUFFER, GL_ELEMENT_ARRAY_BUFFER, GL_TRUE, GL_FALSE, GL_FLOAT, GL_DOUBLE)
+
+#Types of the attributes that are not converted to floats
+FLOAT_TYPES = (GL_FLOAT, GL_DOUBLE)
+
+class VertexArrayCache(object):
+    """
+        Cache of vertex array objects. A vertex array is built from the attribute layouts
+        (see Buffer.attribute_layout) the first time a set of buffers is used with a set of 
+        attribute locations. After that, binding the geometry for a draw costs a single 
+        glBindVertexArray.
+        
+        Integer attributes that are not normalized are declared with glVertexAttribIPointer,
+        so they must be read by integer inputs in the shaders (ex: ivec4, uint).
+        
+        Vertex arrays are keyed by the buffers (identity and name), the element buffer and the 
+        attribute locations. The vertex arrays of collected buffers, or of buffers that were given 
+        a new name, are deleted by collect.
+        
+        Slots:
+            arrays: Vertex array name, weak references to its buffers and their names by key
+            builds: Number of vertex arrays built
+    """
+    
+    __slots__ = ['arrays', 'builds']
+    
+    def __init__(self):
+        self.arrays = {}
+        self.builds = 0
+        
+    def get(self, buffers, locations, element=None, normalized=()):
+        """
+            Return the name of the vertex array of a set of buffers, building it if needed.
+            
+            Parameters:
+                buffers: Array buffers holding the vertex attributes
+                locations: Dictionary of attribute locations by token name (ex: the attribute locations of a program)
+                element: Element buffer bound to the vertex array. Optional.
+                normalized: Names of the tokens whose values are normalized.
+        """
+        buffers = tuple(buffers)
+        key = self.__key(buffers, element, locations, normalized)
+        entry = self.arrays.get(key)
+        if entry is not None:
+            if self.__valid(entry):
+                return entry[0]
+            self.__delete(key)
+            
+        vao = GLuint()
+        glGenVertexArrays(1, byref(vao))
+        glBindVertexArray(vao)
+        try:
+            used = set()
+            for buffer in buffers:
+                buffer.bind(GL_ARRAY_BUFFER)
+                for attribute in buffer.attribute_layout(locations, normalized):
+                    if attribute.location in used:
+                        raise ValueError('Attribute location {} is defined by more than one buffer'.format(attribute.location))
+                    used.add(attribute.location)
+                    glEnableVertexAttribArray(attribute.location)
+                    if attribute.gl_type in FLOAT_TYPES or attribute.normalized:
+                        glVertexAttribPointer(attribute.location, attribute.size, attribute.gl_type, 
+                                              GL_TRUE if attribute.normalized else GL_FALSE, attribute.stride, 
+                                              c_void_p(attribute.offset))
+                    else:
+                        glVertexAttribIPointer(attribute.location, attribute.size, attribute.gl_type, 
+                                               attribute.stride, c_void_p(attribute.offset))
+                    
+            if element is not None:
+                element.bind(GL_ELEMENT_ARRAY_BUFFER)
+        except Exception:
+            glBindVertexArray(0)
+            glDeleteVertexArrays(1, byref(vao))
+            raise
+            
+        glBindVertexArray(0)
+        used_buffers = buffers + ((element,) if element is not None else ())
+        self.arrays[key] = (vao, tuple(ref(b) for b in used_buffers), tuple(b.bid.value for b in used_buffers))
+        self.builds += 1
+        
+        return vao
+        
+    def bind(self, buffers, locations, element=None, normalized=()):
+        """
+            Bind the vertex array of a set of buffers. See get. The buffers are not bound one by one,
+            so they are touched in their registry (registry extension), which restores the evicted buffers.
+        """
+        buffers = tuple(buffers)
+        for buffer in buffers + ((element,) if element is not None else ()):
+            if buffer.record is not None:
+                buffer.record.registry.touch(buffer)
+                
+        glBindVertexArray(self.get(buffers, locations, element, normalized))
+        
+    @staticmethod
+    def unbind():
+        " Unbind the current vertex array "
+        glBindVertexArray(0)
+        
+    def collect(self):
+        """
+            Delete the vertex arrays whose buffers were collected or renamed. 
+            Return the number of deleted vertex arrays.
+        """
+        stale = [key for key, entry in self.arrays.items() if not self.__valid(entry)]
+        for key in stale:
+            self.__delete(key)
+            
+        return len(stale)
+        
+    def clear(self):
+        " Delete every vertex array "
+        for key in list(self.arrays):
+            self.__delete(key)
+            
+    def __key(self, buffers, element, locations, normalized):
+        element_key = (id(element), element.bid.value) if element is not None else None
+        return (tuple((id(b), b.bid.value) for b in buffers), element_key,
+                tuple(sorted(locations.items())), tuple(sorted(normalized)))
+                
+    @staticmethod
+    def __valid(entry):
+        " Check if the buffers of a vertex array are alive and still have the same names "
+        vao, refs, names = entry
+        for r, name in zip(refs, names):
+            buffer = r()
+            if buffer is None or buffer.bid.value != name:
+                return False
+        return True
+                
+    def __delete(self, key):
+        vao = self.arrays.pop(key)[0]
+        glDeleteVertexArrays(1, byref(vao))
+        
+    def __len__(self):
+        return len(self.arrays)
+
+def supported():
+    "Requires OpenGL >= 3.0 or GL_ARB_vertex_array_object"
+    return gl_info.have_version(3, 0) or gl_info.have_extension('GL_ARB_vertex_array_object')
+
+def load(pyglbuffers_module):
+    pyglbuffers_module.VertexArrayCache = VertexArrayCache
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Worker processes of BufferFormat.pack_parallel. This module only imports the standard
+    library (not pyglet), so the worker processes do not need an opengl context or a display,
+    whatever the multiprocessing start method is.
+"""
+
+import re
+from ctypes import (Structure, sizeof, c_float, c_double, c_byte, c_ubyte, c_int, c_uint,
+  c_short, c_ushort)
+from collections.abc import Sequence
+from multiprocessing import shared_memory
+
+#Same types as the GL types used by BufferFormat, so the structures have the same layout
+FORMAT_TYPES = {'f': c_float, 'd': c_double, 'b': c_byte, 'B': c_ubyte,
+                'i': c_int, 'I': c_uint, 's': c_short, 'S': c_ushort}
+
+pattern = re.compile(r'\((\d)+([fdbBsSiI])\)\[(\w+)\]')
+
+#Format, shared memory name and data of the worker. Set by init_worker.
+WORKER = {}
+
+def build_struct(format_str):
+    " Build the c struct of a format string that was validated by BufferFormat.from_string "
+    fields = []
+    for match in pattern.finditer(format_str):
+        size, char, name = match.groups()
+        fields.append((name, FORMAT_TYPES[char]*int(size)))
+
+    return type('BufferStruct', (Structure,), {'_fields_': fields})
+
+def init_worker(format_str, shm_name, data):
+    """
+        Initialize a worker process. With the fork start method, the arguments are inherited
+        by the worker and data is not pickled.
+    """
+    WORKER['struct'] = build_struct(format_str)
+    WORKER['shm_name'] = shm_name
+    WORKER['data'] = data
+
+def pack_range(start, stop):
+    " Pack the values [start, stop) of the worker data "
+    pack_shared(WORKER['struct'], WORKER['shm_name'], start, WORKER['data'][start:stop])
+
+def pack_chunk(format_str, shm_name, start, data):
+    " Pack a chunk of data sent to the worker. Used when the workers are not forked "
+    pack_shared(build_struct(format_str), shm_name, start, data)
+
+def pack_shared(struct, shm_name, start, data):
+    " Pack data directly into a shared memory block, from the value at index start "
+    shm = shared_memory.SharedMemory(name=shm_name)
+    buffers = (struct*len(data)).from_buffer(shm.buf, start*sizeof(struct))
+    error = pack_into(struct, buffers, data)
+    
+    # The shared memory cannot be closed while the array exists
+    del buffers
+    shm.close()
+    
+    if error is not None:
+        raise ValueError(error)
+
+def pack_into(struct, buffers, data):
+    """
+        Pack python sequence into an array of c struct. Same rules as BufferFormat.pack.
+        Return an error message if a value do not match the format, None otherwise.
+    """
+    fields = struct._fields_
+
+    # Allow single tuple when there is only one token
+    if len(fields) > 1 or isinstance(data[0][0], Sequence):
+        iter_data = iter(data)
+    else:
+        iter_data = ((d,) for d in data)
+
+    for value, buffer in zip(iter_data, buffers):
+        for subdata, (name, _type) in zip(value, fields):
+            try:
+                setattr(buffer, name, _type(*subdata))
+            except TypeError:
+                char = next(k for k, v in FORMAT_TYPES.items() if v is _type._type_)
+                return 'Expected Sequence with format "{}{}", found "{}"'.format(_type._length_, char, subdata)
+                
+    return None
@@ -27,5 +27,5 @@ setup(name='pyglbuffers',
       license='MIT',
       url='https://github.com/gabdube/pyglbuffers',
       download_url='https://github.com/gabdube/pyglbuffers',
-      py_modules=['pyglbuffers']+extensions,
+      py_modules=['pyglbuffers', 'pyglbuffers_pack']+extensions,
      )
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
-import unittest, gc
-from ctypes import byref
+import unittest, gc, sys
+from ctypes import byref, c_ubyte, sizeof as ctypes_sizeof
+from multiprocessing import cpu_count, Pipe, Process
+from array import array
 
 import pyglet
 from pyglet.gl import (glIsBuffer, glGenBuffers, GLuint, GL_TRUE, GL_FALSE,
@@ -9,7 +11,7 @@ from pyglet.gl import (glIsBuffer, glGenBuffers, GLuint, GL_TRUE, GL_FALSE,
 
 import pyglbuffers
 from pyglbuffers import (Buffer, BufferFormat, BufferFormatError, GL_READ_WRITE,
-  GL_STATIC_DRAW, GL_DYNAMIC_COPY, GL_DYNAMIC_DRAW, GL_READ_ONLY, GL_WRITE_ONLY,
+  GL_STREAM_READ, GL_STREAM_DRAW, GL_STATIC_DRAW, GL_DYNAMIC_COPY, GL_DYNAMIC_DRAW, GL_READ_ONLY, GL_WRITE_ONLY,
   eval_index, eval_slice, load_extension, check_extension, PyGlBuffersExtensionError,
   extension_loaded)
 
@@ -19,6 +21,27 @@ def create_raw_buffer():
     glBindBuffer(GL_ARRAY_BUFFER, buf)
     return buf.value
     
+def benchmark_pack_parallel(length=1000000):
+    " Print the time taken by pack and pack_parallel to pack a large dataset "
+    from time import perf_counter
+    f1 = BufferFormat.from_string('(3f)[vertex](4B)[color]')
+    data1 = [((x, x+1.0, x+2.0), (x%255, 1, 2, 3)) for x in range(length)]
+    
+    start = perf_counter()
+    f1.pack(data1)
+    serial = perf_counter()-start
+    
+    start = perf_counter()
+    f1.pack_parallel(data1)
+    parallel = perf_counter()-start
+    
+    print('pack: {:.3f}s, pack_parallel ({} cpus): {:.3f}s'.format(serial, cpu_count(), parallel))
+    
+def send_packed_data(connection):
+    " Send packed data from another process "
+    packed = pyglbuffers.PackedData('(3f)[position](4B)[color]', [((x, x, x), (x,)*4) for x in range(1000)])
+    pyglbuffers.send_packed(connection, [packed, packed])
+    connection.close()
     
 class TestIndexEvaluator(unittest.TestCase):
     
@@ -140,6 +163,23 @@ class TestBuffersFormat(unittest.TestCase):
         self.assertEqual('Format string is not valid', str(cm4.exception), 'Exception do not match')
         self.assertEqual('"23d" is not a valid variable name', str(cm5.exception), 'Exception do not match')
         
+    def test_attribute_layout(self):
+        " Test the vertex attributes of a format "
+        f1 = BufferFormat.from_string('(3f)[position](4B)[color](2f)[uv]')
+        
+        layout = f1.attribute_layout()
+        self.assertIsInstance(layout, tuple)
+        self.assertEqual((0, 3, pyglbuffers.GL_FLOAT, False, 24, 0), tuple(layout[0]))
+        self.assertEqual((1, 4, pyglbuffers.GL_UNSIGNED_BYTE, False, 24, 12), tuple(layout[1]))
+        self.assertEqual((2, 2, pyglbuffers.GL_FLOAT, False, 24, 16), tuple(layout[2]))
+        self.assertIs(layout, f1.attribute_layout())
+        
+        layout = f1.attribute_layout({'uv': 0, 'color': 3, 'position': -1}, normalized=('color',))
+        self.assertEqual([(3, True, 12), (0, False, 16)], [(a.location, a.normalized, a.offset) for a in layout])
+        
+        buf1 = Buffer.array(f1)
+        self.assertIs(layout, buf1.attribute_layout({'uv': 0, 'color': 3, 'position': -1}, normalized=['color']))
+        
     def test_pack_single(self):
         " Test packing data into a struct " 
         f1 = BufferFormat.from_string('(3f)[foo]')
@@ -185,6 +225,71 @@ class TestBuffersFormat(unittest.TestCase):
         for index, d3 in enumerate(f3pd):
             self.assertEqual(data3[index], tuple(d3.boo))
             
+    def test_pack_parallel(self):
+        " Test packing data into struct with multiple processes "
+        f1 = BufferFormat.from_string('(3f)[vertex](4B)[color]')
+        
+        data1 = [((x, x+1.0, x+2.0), (x%255, 1, 2, 3)) for x in range(1000)]
+        f1pd = f1.pack_parallel(data1, workers=3, threshold=0)
+        
+        self.assertIsInstance(f1pd[0], f1.struct)
+        self.assertEqual(1000, len(f1pd))
+        self.assertTrue(hasattr(f1pd, '_shm'))
+        self.assertEqual(f1.unpack(f1.pack(data1)), f1.unpack(f1pd))
+        
+        # Small inputs are packed without worker processes
+        self.assertFalse(hasattr(f1.pack_parallel(data1, workers=3), '_shm'))
+        
+        # Without shared memory, every input is packed without worker processes
+        shared, pyglbuffers.shared_memory = pyglbuffers.shared_memory, None
+        try:
+            f1sp = f1.pack_parallel(data1, workers=3, threshold=0)
+        finally:
+            pyglbuffers.shared_memory = shared
+        self.assertFalse(hasattr(f1sp, '_shm'))
+        self.assertEqual(bytes(f1pd), bytes(f1sp))
+        
+        # Chunks sent to workers that are not forked
+        import pyglbuffers_pack
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=len(f1pd)*ctypes_sizeof(f1.struct))
+        try:
+            pyglbuffers_pack.pack_chunk(f1.format_str, shm.name, 500, data1[500:])
+            self.assertEqual(bytes(f1pd)[500*16:], bytes(shm.buf[500*16:]))
+        finally:
+            shm.close()
+            shm.unlink()
+        
+        with self.assertRaises(ValueError) as cm1:
+            f1.pack_parallel(())
+        with self.assertRaises(ValueError):
+            f1.pack_parallel([((1, 2, 3), (1, 2, 3, 4)), ((1, 2, 3), None)], threshold=0)
+            
+        self.assertEqual('No data to pack', str(cm1.exception), 'Exceptions do not match')
+        
+    def test_pack_stats(self):
+        " Test statistics computed while packing "
+        f1 = BufferFormat.from_string('(3f)[vertex](1I)[index]')
+        
+        stats = {}
+        f1.pack([((1.0, -2.0, 3.0), (4,)), ((-1.0, 5.0), (2,)), ((0.5, 0.5, 9.0), (7,))], stats)
+        
+        self.assertEqual(((-1.0, -2.0, 0), (1.0, 5.0, 9.0), (0.5, 3.5, 12.0), 3), tuple(stats['vertex']))
+        self.assertEqual(((2,), (7,), (13,), 3), tuple(stats['index']))
+        
+        # The statistics are the values held by the packed data
+        f2 = BufferFormat.from_string('(1B)[byte](1f)[value]')
+        f2.pack([((300,), (0.1,)), ((7,), (2.0,))], stats)
+        self.assertEqual(((7,), (44,), (51,), 2), tuple(stats['byte']))
+        self.assertEqual(GLfloat(0.1).value, stats['value'].min[0])
+        
+        # Packed data is copied, its statistics are computed from the packed values
+        packed = f1.pack([((1.0, 2.0, 3.0), (4,))])
+        copy = f1.pack(packed, stats)
+        self.assertIsNot(packed, copy)
+        self.assertEqual((4,), tuple(copy[0].index))
+        self.assertEqual(((4,), (4,), (4,), 1), tuple(stats['index']))
+        
     def test_partial_pack(self):
         " Test pack with incomplete data"
         f1 = BufferFormat.from_string('(3f)[foo]')
@@ -273,6 +378,38 @@ class TestBuffersFormat(unittest.TestCase):
         self.assertEqual('No data to pack', str(cm3.exception), 'Exceptions do not match')
         self.assertEqual('Expected Sequence with format "3f", found "20.0"', str(cm4.exception), 'Exceptions do not match')
         
+    def test_converter(self):
+        " Test conversion between formats "
+        src = BufferFormat.from_string('(3d)[position](3f)[normal](1i)[id]')
+        dst = BufferFormat.from_string('(3f)[normal](4f)[pos](4B)[color](1I)[id]')
+        
+        data = [((x, x+0.5, -x), (0, 1, x), (x,)) for x in range(10)]
+        converter = BufferFormat.converter(src, dst, {'pos': 'position', 'color': (255, 128)})
+        converted = dst.unpack(converter(src.pack(data)))
+        
+        self.assertEqual(10, len(converted))
+        for x, value in enumerate(converted):
+            self.assertEqual((0, 1, x), value.normal)
+            self.assertEqual((x, x+0.5, -x, 0), value.pos)
+            self.assertEqual((255, 128, 0, 0), value.color)
+            self.assertEqual((x,), value.id)
+            
+        back = BufferFormat.converter(dst, '(1i)[id](3f)[normal]')
+        back_data = back(converter(data))
+        self.assertEqual((9,), tuple(back_data[9].id))
+        self.assertEqual((0, 1, 9), tuple(back_data[9].normal))
+        self.assertFalse(converter.identity())
+        self.assertTrue(BufferFormat.converter(src, src).identity())
+        
+        with self.assertRaises(KeyError):
+            BufferFormat.converter(src, dst, {'pos': 'foo'})
+            
+        # Out of range values are converted like C casts on the GPU
+        narrow = BufferFormat.converter('(3f)[value](1i)[id](1d)[big]', '(3B)[value](1b)[id](1f)[big](1S)[fill]', {'fill': 70000})
+        value = narrow([((300.0, -1.0, 7.9), (200,), (1e300,)), ((float('nan'), 255.5, -7.9), (-129,), (-1e300,))])
+        self.assertEqual(((255, 0, 7), (-56,), (float('inf'),), (4464,)), tuple(tuple(v) for v in narrow.dst.unpack_single(value[0])))
+        self.assertEqual(((0, 255, 0), (127,), (float('-inf'),), (4464,)), tuple(tuple(v) for v in narrow.dst.unpack_single(value[1])))
+            
     def test_fromstring_cache(self):
         " Returned format should be cached "
         f1 = BufferFormat.from_string("(3f)[foo]")
@@ -318,6 +455,167 @@ class TestBuffers(unittest.TestCase):
         self.assertEqual(200, len(buf1))
         self.assertEqual(3200, buf1.size)
         
+    def test_init_packed(self):
+        ' Test init with data that was already packed '
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf1.init(buf1.format.pack_parallel([(x,)*4 for x in range(100)], workers=2, threshold=0))
+        
+        self.assertEqual(100, len(buf1))
+        self.assertEqual((42,)*4, buf1[42].foo)
+        
+    def test_init_stream(self):
+        ' Test streamed init '
+        buf1 = Buffer.array('(2f)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf1.enable_stats()
+        
+        name = buf1.bid.value
+        written = buf1.init_stream(((x, -x) for x in range(1000)), chunk=64, trim=True)
+        self.assertEqual(1000, written)
+        self.assertEqual(1000, len(buf1))
+        self.assertEqual(name, buf1.bid.value)
+        self.assertEqual((999, -999), buf1[999].foo)
+        self.assertEqual((500, -500), buf1[500].foo)
+        self.assertEqual(((0, -999), (999, 0), (499500, -499500), 1000), tuple(buf1.stats('foo')))
+        
+        written = buf1.init_stream(((x, x) for x in range(100)), count=100, chunk=30)
+        self.assertEqual(100, len(buf1))
+        self.assertEqual((99, 99), buf1[99].foo)
+        
+        # Without trim, the storage keeps its capacity and the extra elements are zeroed
+        self.assertEqual(100, buf1.init_stream(((x+1, 1) for x in range(100)), chunk=64))
+        self.assertEqual(128, len(buf1))
+        self.assertEqual(((100, 1), (0, 0)), (buf1[99].foo, buf1[100].foo))
+        self.assertEqual(((0, 0), (100, 1), (5050, 100), 128), tuple(buf1.stats('foo')))
+        
+        self.assertEqual(0, buf1.init_stream(iter(()), trim=True))
+        self.assertEqual(0, len(buf1))
+        
+        # Buffers wrapping a name keep it
+        raw = create_raw_buffer()
+        buf2 = Buffer(raw, '(1I)[foo]')
+        buf2.target = GL_ARRAY_BUFFER
+        self.assertEqual(200, buf2.init_stream(((x,) for x in range(200)), chunk=16, trim=True))
+        self.assertEqual((raw, False, 200), (buf2.bid.value, buf2.owned, len(buf2)))
+        self.assertEqual((199,), buf2[199].foo)
+        glDeleteBuffers(1, byref(GLuint(raw)))
+        
+    def test_init_diff(self):
+        ' Test diff uploads '
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf1.enable_diff(chunk_size=160)
+        
+        data = [(x,)*4 for x in range(100)]
+        buf1.init(data)
+        self.assertEqual((1600, 0), (buf1.diff.sent, buf1.diff.skipped))
+        
+        data[15] = (-1,)*4
+        data[99] = (-2,)*4
+        buf1.init(data)
+        self.assertEqual((1920, 1280), (buf1.diff.sent, buf1.diff.skipped))
+        
+        buf1[::] = data
+        self.assertEqual((1920, 2880), (buf1.diff.sent, buf1.diff.skipped))
+        
+        buf1[0] = (-3,)*4
+        buf1.init(data)
+        self.assertEqual((3520, 2880), (buf1.diff.sent, buf1.diff.skipped))
+        
+        self.assertEqual((-1,)*4, buf1[15].foo)
+        self.assertEqual((-2,)*4, buf1[99].foo)
+        self.assertEqual((0,)*4, buf1[0].foo)
+        self.assertEqual(100, len(buf1))
+        
+    def test_stats(self):
+        ' Test buffer statistics '
+        buf1 = Buffer.array('(2f)[position](1B)[flag]', usage=GL_DYNAMIC_DRAW)
+        
+        with self.assertRaises(BufferError):
+            buf1.stats('position')
+            
+        buf1.enable_stats()
+        self.assertIsNone(buf1.stats('position'))
+        
+        buf1.reserve(10)
+        self.assertEqual(((0, 0), (0, 0), (0, 0), 10), tuple(buf1.stats('position')))
+        
+        buf1.init([((x, -x), (1,)) for x in range(10)])
+        self.assertEqual(((0, -9), (9, 0), (45, -45), 10), tuple(buf1.stats('position')))
+        
+        buf1[3] = ((20, 1), (2,))
+        self.assertEqual(((0, -9), (20, 1), None, 10), tuple(buf1.stats('position')))
+        
+        with buf1:
+            buf1[2:4] = (((-5, 0), (3,)), ((0, 0), (3,)))
+        self.assertEqual(((-5, -9), (20, 1), None, 10), tuple(buf1.stats('position')))
+        self.assertEqual(((1,), (3,), None, 10), tuple(buf1.stats('flag')))
+        
+        buf1[::] = [((1, 1), (1,))]*10
+        self.assertEqual(((1, 1), (1, 1), (10, 10), 10), tuple(buf1.stats('position')))
+        
+        buf1.init(buf1.format.pack([((x, 2), (x,)) for x in range(4)]))
+        self.assertEqual(((0,), (3,), (6,), 4), tuple(buf1.stats('flag')))
+        
+        with self.assertRaises(KeyError):
+            buf1.stats('foo')
+            
+        buf1.disable('stats')
+        self.assertIsNone(buf1.fieldstats)
+        with self.assertRaises(BufferError):
+            buf1.stats('position')
+            
+        with self.assertRaises(ValueError):
+            buf1.disable('foo')
+            
+    def test_convert_buffer(self):
+        ' Test buffer conversion '
+        buf1 = Buffer.array('(2f)[position](1f)[size]', usage=GL_DYNAMIC_DRAW)
+        buf1.init([((x, x), (x*2,)) for x in range(10)])
+        
+        buf2 = BufferFormat.converter(buf1.format, '(2f)[pos](1f)[radius]', {'pos': 'position', 'radius': 'size'}).convert_buffer(buf1)
+        buf3 = BufferFormat.converter(buf1.format, '(1d)[size](2S)[position]').convert_buffer(buf1)
+        
+        self.assertEqual(GL_DYNAMIC_DRAW, buf2.usage)
+        self.assertEqual(10, len(buf2))
+        self.assertEqual(((4, 4), (8,)), tuple(buf2[4]))
+        self.assertEqual(((8,), (4, 4)), tuple(buf3[4]))
+        
+    def test_sort_indices(self):
+        ' Test buffer sorting '
+        buf1 = Buffer.array('(3f)[position](1f)[size]', usage=GL_DYNAMIC_DRAW)
+        buf1.init([((x % 7, 0, -x), (x % 3,)) for x in range(20)])
+        elements = Buffer.element('(1I)[index]')
+        
+        order = buf1.sort_indices('position', direction=(0, 0, 1), element=elements)
+        self.assertEqual(list(range(19, -1, -1)), order)
+        self.assertEqual(20, len(elements))
+        self.assertEqual([(x,) for x in order], [v.index for v in elements[::]])
+        
+        previous = order
+        order = buf1.sort_indices('position', direction=(0, 0, 1), reverse=True, previous=previous)
+        self.assertEqual(list(range(20)), order)
+        self.assertEqual(list(range(19, -1, -1)), previous)
+        
+        with buf1:
+            order = buf1.sort_indices('size')
+        self.assertEqual([0, 3, 6, 9, 12, 15, 18, 1, 4, 7, 10, 13, 16, 19, 2, 5, 8, 11, 14, 17], order)
+        
+        order = buf1.sort_indices('position', key_fn=lambda p: (p[0], -p[2]))
+        self.assertEqual([0, 7, 14, 1, 8, 15], order[:6])
+        
+        with self.assertRaises(ValueError):
+            buf1.sort_indices('position')
+            
+        buf2 = Buffer.array('(1f)[depth]', usage=GL_DYNAMIC_DRAW)
+        buf2.reserve(300)
+        with self.assertRaises(ValueError):
+            buf2.sort_indices('depth', element=Buffer.element('(1B)[index]'))
+        self.assertEqual(300, len(buf2.sort_indices('depth', element=Buffer.element('(1S)[index]'))))
+        
+        buf2.map(GL_WRITE_ONLY)
+        with self.assertRaises(BufferError):
+            buf2.sort_indices('depth')
+        buf2.unmap()
+        
     def test_get_set(self):
         " Test Get/Set on unmapped buffers"
         buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
@@ -383,6 +681,365 @@ class TestBuffers(unittest.TestCase):
             self.assertEqual(j, i.foo)
             
     
+    def test_set_strided(self):
+        " Test strided writes on mapped and unmapped buffers "
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf1.init([(0,)*4 for x in range(3000)])
+        
+        buf1[0:10:3] = ((1,)*4, (2,)*4, (3,)*4, (4,)*4)
+        buf1[10:2000:999] = ((5,)*4, (6,)*4)
+        buf1[26:20:-3] = ((7,)*4, (8,)*4)
+        
+        with buf1:
+            buf1[30:35:2] = ((10,)*4, (11,)*4, (12,)*4)
+            buf1[45:40:-2] = ((13,)*4, (14,)*4, (15,)*4)
+        
+        expected = {0:1, 3:2, 6:3, 9:4, 10:5, 1009:6, 25:7, 22:8, 
+                    30:10, 32:11, 34:12, 44:13, 42:14, 40:15}
+        data = buf1[0:2000]
+        for i in range(2000):
+            self.assertEqual((expected.get(i, 0),)*4, data[i].foo)
+    
+    def test_gather_scatter(self):
+        " Test reading and writing with sequences of indices "
+        buf1 = Buffer.array('(1I)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf1.init([(x,) for x in range(3000)])
+        
+        self.assertEqual(((5,), (1,), (5,), (2999,)), tuple(v.foo for v in buf1[[5, 1, 5, -1]]))
+        self.assertEqual(((0,), (2000,)), tuple(v.foo for v in buf1[array('i', [0, 2000])]))
+        self.assertEqual(((10,), (11,), (12,)), tuple(v.foo for v in buf1[range(10, 13)]))
+        self.assertEqual((), buf1[[]])
+        
+        buf1[[7, 3, 4, 2999, 3]] = ((1,), (2,), (3,), (4,), (5,))
+        buf1[range(100, 2000, 2)] = [(0,)]*950
+        
+        with buf1:
+            buf1[array('I', [20, 21, 25])] = ((6,), (7,), (8,))
+            self.assertEqual(((8,), (6,)), tuple(v.foo for v in buf1[[25, 20]]))
+            
+        expected = {7: 1, 3: 5, 4: 3, 2999: 4, 20: 6, 21: 7, 25: 8}
+        expected.update({i: 0 for i in range(100, 2000, 2)})
+        data = buf1[::]
+        for i in range(3000):
+            self.assertEqual((expected.get(i, i),), data[i].foo)
+            
+        with self.assertRaises(ValueError):
+            buf1[[1, 2]] = ((1,),)
+        with self.assertRaises(IndexError):
+            buf1[[1, 3000]]
+        with self.assertRaises(KeyError):
+            buf1[[1.0]]
+        with self.assertRaises(KeyError):
+            buf1[[True, 2]]
+
+        # Integer scalars (ex: NumPy integers) are converted, 0-d arrays are not sequences
+        class Scalar(object):
+            ndim = 0
+            def __init__(self, value): self.value = value
+            def __index__(self): return self.value
+            def __array__(self): return None
+
+        self.assertEqual((4,), buf1[Scalar(2999)].foo)
+        self.assertEqual(((5,), (6,)), tuple(v.foo for v in buf1[[Scalar(5), Scalar(20)]]))
+        buf1[Scalar(0)] = (42,)
+        self.assertEqual((42,), buf1[0].foo)
+
+    def test_spatial_index(self):
+        " Test the spatial index of a position token "
+        if not extension_loaded('spatial_index'):
+            load_extension('spatial_index')
+            
+        buf1 = Buffer.array('(3f)[position](1f)[radius]', usage=GL_DYNAMIC_DRAW)
+        buf1.init([((x, y, 0), (1,)) for x in range(20) for y in range(20)])
+        
+        index = buf1.enable_spatial_index('position')
+        self.assertIs(index, buf1.spatial)
+        self.assertEqual(400, len(index))
+        
+        self.assertEqual([21], index.nearest((1.1, 0.9, 0)))
+        self.assertEqual([0, 1, 20], index.nearest((-1, -1, 0), count=3))
+        self.assertEqual([], index.nearest((100, 100, 0), max_distance=5))
+        self.assertEqual([22, 42], index.radius((1.5, 1.6, 0.2), 0.8))
+        self.assertEqual([0, 21, 42], index.ray((-5, -5, 0), (1, 1, 0), 0.1, max_length=10))
+        
+        buf1[0] = ((100, 100, 0), (1,))
+        buf1[[1, 2]] = (((200, 200, 0), (1,)), ((-7, 3, 0), (1,)))
+        buf1[3:5] = (((5.5, 5.5, 5.0), (1,)), ((5.5, 5.5, -5.0), (1,)))
+        self.assertEqual([0], index.nearest((99, 99, 0)))
+        self.assertEqual([1], index.nearest((300, 300, 0)))
+        self.assertEqual([2], index.radius((-7, 3, 0), 1))
+        self.assertEqual([4, 3], index.ray((5.5, 5.5, -10), (0, 0, 1), 0.1))
+        
+        # Written positions are stored like packed positions
+        buf1[5] = ((1.1, 2.2, 3.3), (1,))
+        self.assertEqual(tuple(buf1[5].position), tuple(axis[5] for axis in index.coords))
+        
+        # Writes of the same number of elements only move the elements that changed cell
+        cell_size = index.cell_size
+        buf1.init([((x, y, 1), (1,)) for x in range(20) for y in range(20)])
+        self.assertEqual(cell_size, index.cell_size)
+        self.assertEqual([21], index.nearest((1.1, 0.9, 1)))
+        self.assertEqual(sorted(range(400)), sorted(i for cell in index.cells.values() for i in cell))
+        
+        buf1.init([((x, 0, 0), (1,)) for x in range(10)])
+        self.assertEqual(10, len(index))
+        self.assertEqual([9], index.nearest((50, 0, 0)))
+        
+        # Streamed values are indexed by chunks
+        buf1.init_stream((((x, x, x), (1,)) for x in range(100)), chunk=16)
+        self.assertEqual(128, len(index))
+        self.assertEqual([1, 2], index.ray((0.5, 0.5, 0.5), (1, 1, 1), 0.1, max_length=3))
+        self.assertEqual([99], index.nearest((120, 120, 120)))
+        self.assertEqual(29, len(index.radius((0, 0, 0), 0.5)))
+        buf1.init_stream((((x, x, x), (1,)) for x in range(100)), chunk=16, trim=True)
+        self.assertEqual(1, len(index.radius((0, 0, 0), 0.5)))
+        
+        with self.assertRaises(KeyError):
+            buf1.enable_spatial_index('foo')
+    
+    def test_ops_path(self):
+        " Test the capability probing and the buffer operations path "
+        from pyglet.gl import glGetIntegerv, GLint, GL_ARRAY_BUFFER_BINDING
+        
+        caps = pyglbuffers.capabilities()
+        self.assertIs(caps, pyglbuffers.capabilities())
+        
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
+        buf2 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
+        self.assertIs(pyglbuffers.buffer_ops(), buf1.ops)
+        self.assertEqual('named' if caps.named else 'bound', buf1.ops.path)
+        
+        buf2.ops = pyglbuffers.BOUND_OPS
+        for buf in (buf1, buf2):
+            bound = GLint()
+            glBindBuffer(GL_ARRAY_BUFFER, 0)
+            buf.init([(x,)*4 for x in range(10)])
+            buf[2:4] = ((9,)*4, (8,)*4)
+            with buf:
+                buf[5] = (7,)*4
+            glGetIntegerv(GL_ARRAY_BUFFER_BINDING, byref(bound))
+            
+            self.assertEqual(0 if buf.ops.path == 'named' else buf.bid.value, bound.value)
+            self.assertEqual((1, 9, 8, 4, 7), tuple(v.foo[0] for v in buf[1:6]))
+            self.assertEqual(160, buf.size)
+            
+        # A name that was never bound do not have a buffer object yet
+        name = GLuint()
+        glGenBuffers(1, byref(name))
+        buf3 = Buffer(name, '(4f)[foo]')
+        buf3.target = GL_ARRAY_BUFFER
+        self.assertIs(pyglbuffers.BOUND_OPS, buf3.ops)
+        buf3.init([(x,)*4 for x in range(3)])
+        self.assertEqual((2,)*4, buf3[2].foo)
+        glDeleteBuffers(1, byref(name))
+            
+    def test_packed_data(self):
+        " Test pickling buffer formats and packed data "
+        import pickle
+        from ctypes import addressof
+        from pyglbuffers import PackedData
+        
+        format = BufferFormat.from_string('(3f)[position](4B)[color]')
+        self.assertIs(format, pickle.loads(pickle.dumps(format)))
+        self.assertIs(format, pickle.loads(pickle.dumps(BufferFormat.new(format))))
+        
+        packed = PackedData('(3f)[position](4B)[color]', [((x, x, x), (x,)*4) for x in range(16)])
+        buffers = []
+        data = pickle.dumps(packed, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual(1, len(buffers))
+        self.assertLess(len(data), 128)
+        
+        received = pickle.loads(data, buffers=buffers)
+        self.assertEqual(addressof(packed.data), addressof(received.data))
+        self.assertIs(format, received.format)
+        
+        for protocol in (4, 5):
+            received = pickle.loads(pickle.dumps(packed, protocol=protocol))
+            self.assertEqual(bytes(packed.data), bytes(received.data))
+        
+        buf1 = Buffer.array('(3f)[position](4B)[color]')
+        buf1.init(received)
+        self.assertEqual((15, 15, 15), tuple(buf1[15].position))
+        
+        with self.assertRaises(BufferFormatError):
+            Buffer.array('(3f)[position]').init(received)
+            
+        # Packed data sent over a pipe is read directly into its memory
+        receiver, sender = Pipe(duplex=False)
+        process = Process(target=send_packed_data, args=(sender,))
+        process.start()
+        sender.close()
+        received = pyglbuffers.recv_packed(receiver)
+        process.join()
+        
+        self.assertEqual(2, len(received))
+        self.assertIs(format, received[0].format)
+        self.assertEqual(1000, len(received[1]))
+        
+        buf1 = Buffer.array('(3f)[position](4B)[color]')
+        buf1.init(received[1])
+        self.assertEqual(((999,)*3, (231,)*4), (tuple(buf1[999].position), tuple(buf1[999].color)))
+            
+    def test_mesh_batcher(self):
+        " Test static mesh batching "
+        if not extension_loaded('mesh_batcher'):
+            load_extension('mesh_batcher')
+        MeshBatcher = pyglbuffers.MeshBatcher
+        
+        translate = ((1,0,0,10), (0,1,0,0), (0,0,1,0), (0,0,0,1))
+        triangle = [((x, x, 0), (255,)*4) for x in range(3)]
+        quad = [((x, -x, 1), (0,)*4) for x in range(4)]
+        
+        batch = MeshBatcher('(3f)[position](4B)[color]', position='position')
+        self.assertEqual(0, batch.add(triangle, (0, 1, 2)))
+        self.assertEqual(1, batch.add(quad, (0, 1, 2, 2, 3, 0), transform=translate))
+        
+        self.assertEqual([(0, 3, 0), (3, 6, 0)], batch.build())
+        self.assertEqual((0, 1, 2, 3, 4, 5, 5, 6, 3), tuple(v.index[0] for v in batch.indices[::]))
+        self.assertEqual((0, 1, 2, 10, 11, 12, 13), tuple(v.position[0] for v in batch.vertices[::]))
+        self.assertEqual((13, -3, 1), tuple(batch.vertices[6].position))
+        
+        batch.update(0, vertices=[((x, x, 5), (0,)*4) for x in range(3)], indices=(2, 1))
+        self.assertEqual((1, 1), (batch.rebuilds, batch.uploads))
+        self.assertEqual((0, 2, 0), batch.draw_range(0))
+        self.assertEqual((2, 1), tuple(v.index[0] for v in batch.indices[0:2]))
+        self.assertEqual((5,)*3, tuple(v.position[2] for v in batch.vertices[0:3]))
+        
+        batch.update(1, transform=((1,0,0,0), (0,1,0,0), (0,0,1,0), (0,0,0,1)))
+        self.assertEqual((0, 1, 2, 3), tuple(v.position[0] for v in batch.vertices[3:7]))
+        
+        batch.update(1, transform=[v for row in translate for v in row])
+        self.assertEqual((10, 11, 12, 13), tuple(v.position[0] for v in batch.vertices[3:7]))
+        with self.assertRaises(ValueError):
+            batch.update(1, transform=range(4))
+        
+        batch.update(1, vertices=quad+quad, indices=range(8))
+        with self.assertRaises(BufferError):
+            batch.draw_range(1)
+        self.assertEqual([(0, 2, 0), (2, 8, 0)], batch.build())
+        self.assertEqual(2, batch.rebuilds)
+        
+        batch.remove(0)
+        self.assertEqual([(2, 8, 0)], batch.build())
+        self.assertEqual((1, 2), (len(batch), batch.rebuilds))
+        
+        batch2 = MeshBatcher('(2f)[position]', '(1B)[index]', rebase=False)
+        for i in range(3):
+            batch2.add([(i, i)]*200, range(200))
+        self.assertEqual([(0, 200, 0), (200, 200, 200), (400, 200, 400)], batch2.build())
+        self.assertEqual(199, batch2.indices[599].index[0])
+        
+        with self.assertRaises(ValueError):
+            batch2.add([(0, 0)], (0,), transform=translate)
+        with self.assertRaises(IndexError):
+            batch2.add([(0, 0)], (1,))
+        with self.assertRaises(KeyError):
+            batch2.update(5, indices=(0,))
+        with self.assertRaises(ValueError):
+            MeshBatcher('(2f)[position]', '(2I)[index]')
+        with self.assertRaises(ValueError):
+            MeshBatcher('(2f)[position]', '(1b)[index]')
+            
+        batch3 = MeshBatcher('(2f)[position]', '(1B)[index]')
+        for i in range(2):
+            batch3.add([(i, i)]*200, range(200))
+        with self.assertRaises(ValueError):
+            batch3.build()
+            
+    def test_upload_context(self):
+        " Test buffers uploaded by a shared context on a loader thread "
+        from threading import Thread
+        
+        for name in ('registry', 'upload_context'):
+            if not extension_loaded(name):
+                load_extension(name)
+            
+        render = pyglet.gl.current_context
+        if not hasattr(render, 'egl_context'):
+            self.skipTest('Loader threads without a make_current function require a headless (EGL) context')
+            
+        upload = pyglbuffers.UploadContext(render.config.create_context(render))
+        buf1 = Buffer.array('(4f)[foo]')
+        buf1.init([(1,)*4])
+        result = {}
+        
+        def load():
+            with upload:
+                result['context'] = pyglbuffers.current_context()
+                buf2 = Buffer.array('(4f)[foo]')
+                buf2.init([(x,)*4 for x in range(64)])
+                buf3 = Buffer.element('(1S)[index]')
+                buf3.init([(x,) for x in range(64)])
+                result['registry'] = pyglbuffers.buffer_registry()
+                
+                try:
+                    buf1[0]
+                except BufferError as e:
+                    result['error'] = str(e)
+                    
+                upload.release(buf2, buf3)
+                
+                try:
+                    buf2[0]
+                except BufferError as e:
+                    result['released'] = str(e)
+                    
+            result['buffers'] = (buf2, buf3)
+            
+        thread = Thread(target=load)
+        thread.start()
+        thread.join()
+        
+        buf2, buf3 = result['buffers']
+        self.assertIs(upload.context, result['context'])
+        self.assertIs(render, pyglbuffers.current_context())
+        self.assertEqual('Buffer is owned by another context', result['error'])
+        self.assertEqual('Buffer was released by its upload context and was not acquired', result['released'])
+        self.assertEqual(2, len(upload))
+        
+        with self.assertRaises(BufferError):
+            buf2[0]
+            
+        # Each context has its own registry, acquired buffers move to the render context registry
+        registry = pyglbuffers.buffer_registry()
+        self.assertIs(result['registry'], pyglbuffers.buffer_registry(upload.context))
+        self.assertIsNot(registry, result['registry'])
+        self.assertIs(result['registry'], buf2.record.registry)
+        self.assertEqual(1024+128, result['registry'].total)
+        total = registry.total
+        
+        self.assertEqual([buf2, buf3], upload.acquire(wait=True))
+        self.assertIs(registry, buf2.record.registry)
+        self.assertEqual((0, total+1024+128), (result['registry'].total, registry.total))
+        self.assertEqual(0, len(upload))
+        self.assertEqual((2, 2), (upload.released, upload.acquired))
+        self.assertIsNone(buf2.owner)
+        self.assertIs(pyglbuffers.buffer_names(), buf2.names)
+        self.assertEqual(tuple(range(64)), tuple(v.foo[0] for v in buf2[::]))
+        self.assertEqual(tuple(range(64)), tuple(v.index[0] for v in buf3[::]))
+        self.assertEqual([], upload.acquire())
+        
+        with self.assertRaises(BufferError):
+            upload.release(buf2)
+            
+    def test_upload_context_make_current(self):
+        " Test upload contexts made current by a make_current function "
+        if not extension_loaded('upload_context'):
+            load_extension('upload_context')
+            
+        # Contexts that are not headless need a make_current function, the pyglet current context never changes
+        render = pyglet.gl.current_context
+        with self.assertRaises(ValueError):
+            pyglbuffers.UploadContext(object())
+            
+        calls = []
+        upload2 = pyglbuffers.UploadContext(object(), calls.append)
+        with upload2:
+            pass
+            
+        self.assertEqual([upload2.context, None], calls)
+        self.assertIs(render, pyglet.gl.current_context)
+    
     def test_get_set_fail(self):
         " Test Get/Set with bad values"
         buf1 = Buffer.array('(4f)[foo]', usage=GL_DYNAMIC_DRAW)
@@ -396,19 +1053,22 @@ class TestBuffers(unittest.TestCase):
         with self.assertRaises(ValueError) as err2:
             buf1[0:2] = ((12,)*4, (13,)*4, (14,)*4)
             
-        with self.assertRaises(NotImplementedError) as err3:
-            buf1[0:2:2] = (1,1,1,1)
+        with self.assertRaises(ValueError) as err3:
+            buf1[0:3:2] = ((1,1,1,1),)
             
         with self.assertRaises(IndexError) as err4:
             buf2[0:3] = [1,2] 
             
-        self.assertEqual('\'Key must be an integer or a slice, got NoneType\'', str(err1.exception))
+        self.assertEqual('\'Key must be an integer, a slice or a sequence of integers, got NoneType\'', str(err1.exception))
         self.assertEqual('Buffer do not support resizing', str(err2.exception))
-        self.assertEqual('Unmapped buffer write do not support steps different than 1.', str(err3.exception))
+        self.assertEqual('Buffer do not support resizing', str(err3.exception))
         self.assertEqual('Slices indexes "0:3" out of bound, buffer has a length of "0"', str(err4.exception))
         
     def test_freeing(self):
         " Test freeing buffer "
+        gc.collect()
+        pyglbuffers.collect()
+        
         buf1 = Buffer.array('(4f)[foo]')  
         bid1 = buf1.bid
         
@@ -419,11 +1079,290 @@ class TestBuffers(unittest.TestCase):
         del buf2
         gc.collect()
         
+        self.assertEqual(GL_TRUE, glIsBuffer(bid1), 'Buffer deletion was not deferred')
+        self.assertEqual(1, pyglbuffers.collect())
         self.assertEqual(GL_FALSE, glIsBuffer(bid1), 'Buffer is still valid')
         self.assertEqual(GL_TRUE, glIsBuffer(bid2), 'Buffer is not valid')
+        
+        # Without collect, the next buffer created or bound deletes the freed buffers
+        buf3, buf4 = Buffer.array('(4f)[foo]'), Buffer.array('(4f)[foo]')
+        bid3, bid4 = buf3.bid, buf4.bid
+        del buf3
+        gc.collect()
+        buf5 = Buffer.array('(4f)[foo]')
+        self.assertEqual(GL_FALSE, glIsBuffer(bid3), 'Buffer was not deleted by the next buffer creation')
+        del buf4
+        gc.collect()
+        buf5.bind()
+        self.assertEqual(GL_FALSE, glIsBuffer(bid4), 'Buffer was not deleted by the next bind')
+        self.assertEqual(0, pyglbuffers.collect())
 
         glDeleteBuffers(1, byref(bid2))
         
+    def test_names_pool(self):
+        " Test buffer names generation "
+        names = pyglbuffers.buffer_names()
+        self.assertIs(names, pyglbuffers.buffer_names())
+        
+        buf1 = Buffer.array('(4f)[foo]')
+        free = len(names.free)
+        buffers = [Buffer.array('(4f)[foo]') for _ in range(free)]
+        self.assertEqual(0, len(names.free))
+        
+        gc.collect()
+        pyglbuffers.collect()
+        
+        ids = [buf.bid.value for buf in buffers]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertNotIn(buf1.bid.value, ids)
+        
+        del buffers
+        gc.collect()
+        self.assertEqual(len(ids), pyglbuffers.collect())
+        self.assertEqual(0, pyglbuffers.collect())
+        for bid in ids:
+            self.assertEqual(GL_FALSE, glIsBuffer(bid))
+        
+class TestRegistry(unittest.TestCase):
+    
+    def setUp(self):
+        for name in ('registry', 'profiling'):
+            if not extension_loaded(name):
+                load_extension(name)
+    
+    def test_accounting(self):
+        " Test buffer memory accounting "
+        registry = pyglbuffers.buffer_registry()
+        key = (pyglbuffers.GL_ARRAY_BUFFER, GL_STREAM_READ)
+        before, total = registry.sizes.get(key, 0), registry.total
+        
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_STREAM_READ)
+        buf1.reserve(100)
+        self.assertEqual(before+1600, registry.sizes[key])
+        self.assertEqual(total+1600, registry.total)
+        
+        buf1.init([(1,)*4]*10)
+        self.assertEqual(before+160, registry.sizes[key])
+        self.assertGreaterEqual(registry.peaks[key], before+1600)
+        self.assertGreaterEqual(registry.high_water, total+1600)
+        
+        del buf1
+        gc.collect()
+        self.assertEqual(before, registry.sizes[key])
+        self.assertEqual(total, registry.total)
+        
+    def test_residency(self):
+        " Test buffer eviction "
+        registry = pyglbuffers.buffer_registry()
+        buffers = [Buffer.array('(4f)[foo]') for x in range(3)]
+        for x, buf in enumerate(buffers):
+            buf.init([(x,)*4]*100)
+            buf.evictable = True
+        
+        evicted = registry.evicted
+        try:
+            registry.budget = registry.total - 3000
+            buffers[1].bind()
+            buffers[2].bind()
+            registry.collect()
+            self.assertEqual(evicted+3200, registry.evicted)
+            self.assertIsNotNone(buffers[0].record.host)
+            self.assertIsNotNone(buffers[1].record.host)
+            
+            self.assertEqual((0,)*4, buffers[0][50].foo)
+            self.assertEqual(100, len(buffers[0]))
+            self.assertIsNone(buffers[0].record.host)
+            self.assertIsNotNone(buffers[1].record.host)
+            self.assertIsNotNone(buffers[2].record.host)
+        finally:
+            registry.budget = None
+            
+        self.assertEqual((1,)*4, buffers[1][99].foo)
+        self.assertEqual((2,)*4, buffers[2][0].foo)
+        self.assertEqual(evicted, registry.evicted)
+
+    def test_profile(self):
+        " Test usage recommendations and migrations "
+        buf1 = Buffer.array('(4f)[foo]', usage=GL_STATIC_DRAW)
+        buf2 = Buffer.array('(4f)[foo]', usage=GL_STREAM_DRAW)
+        buf3 = Buffer.array('(4f)[foo]', usage=GL_STATIC_DRAW)
+        profile1, profile2 = buf1.enable_profile(), buf2.enable_profile()
+        profile3 = buf3.enable_profile(auto_migrate=True)
+        
+        for i in range(20):
+            buf1.init([(i,)*4]*10)
+            buf3.reserve(10)
+            buf3[i%10] = (i,)*4
+        buf2.init([(1,)*4]*10)
+        buf2[0:10]
+        
+        profile1.start -= 1.0
+        profile2.start -= 10.0
+        profile3.start -= 1.0
+        
+        self.assertEqual(GL_STREAM_DRAW, profile1.recommended(GL_STATIC_DRAW))
+        self.assertEqual(GL_STATIC_DRAW, profile2.recommended(GL_STREAM_DRAW))
+        self.assertEqual((20, 3200, 20), (profile1.writes, profile1.written, profile1.full_writes))
+        self.assertEqual((1, 160), (profile2.reads, profile2.read))
+        
+        report = {id(b): (usage, recommended) for b, usage, recommended in pyglbuffers.usage_report()}
+        self.assertEqual((GL_STATIC_DRAW, GL_STREAM_DRAW), report[id(buf1)])
+        self.assertEqual((GL_STREAM_DRAW, GL_STATIC_DRAW), report[id(buf2)])
+        
+        # Partial writes at a high rate
+        profile3.full_writes = 0
+        self.assertEqual(GL_DYNAMIC_DRAW, profile3.recommended(GL_STATIC_DRAW))
+        pyglbuffers.collect()
+        self.assertEqual(GL_DYNAMIC_DRAW, buf3.usage)
+        self.assertEqual((1, 0), (profile3.migrations, profile3.writes))
+        self.assertEqual((19,)*4, buf3[9].foo)
+        
+        self.assertTrue(buf1.migrate_usage())
+        self.assertEqual(GL_STREAM_DRAW, buf1.usage)
+        self.assertEqual((19,)*4, buf1[0].foo)
+        self.assertFalse(buf1.migrate_usage(GL_STREAM_DRAW))
+        
+        profile2.reset()
+        with buf2:
+            pass
+        self.assertEqual((1, 1, 1), (profile2.maps, profile2.reads, profile2.writes))
+        
+        # Migrations by init with diff uploads
+        buf4 = Buffer.array('(4f)[foo]', usage=GL_STATIC_DRAW)
+        buf4.enable_diff()
+        profile4 = buf4.enable_profile(auto_migrate=True)
+        for i in range(9):
+            buf4.init([(1,)*4]*10)
+        self.assertEqual(1, profile4.migrations)
+        self.assertEqual((GL_STREAM_DRAW, GL_STREAM_DRAW), (buf4._usage, buf4.usage))
+        self.assertEqual((1,)*4, buf4[9].foo)
+        
+class TestBufferCache(unittest.TestCase):
+    
+    def setUp(self):
+        if not extension_loaded('buffer_cache'):
+            load_extension('buffer_cache')
+    
+    def test_cache(self):
+        " Test buffer deduplication "
+        cache = pyglbuffers.BufferCache(budget=256)
+        data1 = [(x,)*4 for x in range(10)]
+        data2 = [(x,)*4 for x in range(12)]
+        
+        buf1 = cache.array('(4f)[foo]', data1)
+        buf2 = cache.array('(4f)[foo]', list(data1))
+        buf3 = cache.element('(4f)[foo]', data1)
+        buf4 = cache.array('(4i)[foo]', data1)
+        
+        self.assertIs(buf1, buf2)
+        self.assertIsNot(buf1, buf3)
+        self.assertIsNot(buf1, buf4)
+        self.assertEqual((1, 3), (cache.hits, cache.misses))
+        self.assertEqual(480, cache.size)
+        self.assertEqual((9,)*4, buf2[9].foo)
+        
+        cache.release(buf1)
+        cache.release(buf3)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(320, cache.size)
+        
+        cache.release(buf2)
+        self.assertEqual(1, len(cache))
+        self.assertEqual(160, cache.size)
+        
+        buf5 = cache.array('(4f)[foo]', data2)
+        self.assertEqual(2, len(cache))
+        
+        with self.assertRaises(ValueError) as cm1:
+            cache.release(buf1)
+            
+        self.assertEqual('Buffer is not owned by the cache', str(cm1.exception))
+        
+        cache.release(buf4)
+        cache.release(buf5)
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+class TestBufferSet(unittest.TestCase):
+    
+    def setUp(self):
+        if not extension_loaded('buffer_set'):
+            load_extension('buffer_set')
+    
+    def test_rotation(self):
+        " Test buffer set rotation "
+        bset = pyglbuffers.BufferSet('(1f)[foo]', 10, count=3, fences=True, copy_forward=True)
+        first = bset.current()
+        
+        self.assertEqual(3, len(bset))
+        self.assertEqual(10, len(first))
+        
+        bset[0] = (1,)
+        bset[5:7] = ((2,), (3,))
+        self.assertIs(bset.buffers[1], bset.advance())
+        self.assertIs(first, bset.previous())
+        
+        bset[9] = (4,)
+        bset.advance()
+        bset[0] = (5,)
+        self.assertIs(first, bset.advance())
+        
+        expected = (5, 0, 0, 0, 0, 2, 3, 0, 0, 4)
+        self.assertEqual(expected, tuple(v.foo[0] for v in bset.current()[::]))
+        
+        for i in range(3):
+            bset.advance()
+            self.assertEqual(expected, tuple(v.foo[0] for v in bset.current()[::]))
+        
+        with self.assertRaises(ValueError):
+            pyglbuffers.BufferSet('(1f)[foo]', 10, count=1)
+            
+        # GPU copies discard the local data of diff uploads
+        bset = pyglbuffers.BufferSet('(1f)[foo]', 4, count=2, copy_forward=True)
+        target = bset.buffers[1]
+        target.enable_diff()
+        target.init([(0,)]*4)
+        bset[1] = (7,)
+        bset.advance()
+        self.assertEqual((7,), target[1].foo)
+        self.assertIsNone(target.diff.data)
+        target.init([(0,)]*4)
+        self.assertEqual((0,), target[1].foo)
+
+class TestInstanceBuffer(unittest.TestCase):
+    
+    def setUp(self):
+        if not extension_loaded('instance_buffer'):
+            load_extension('instance_buffer')
+    
+    def test_add_remove(self):
+        " Test instance buffer compaction "
+        instances = pyglbuffers.InstanceBuffer('(2f)[offset]', capacity=2)
+        
+        handles = [instances.add((x, -x)) for x in range(5)]
+        self.assertEqual(5, instances.live_count)
+        self.assertEqual(8, instances.capacity)
+        self.assertEqual(8, len(instances.buffer))
+        
+        instances.remove(handles[1])
+        instances.remove(handles[4])
+        instances[handles[3]] = (30, -30)
+        
+        self.assertNotIn(handles[1], instances)
+        self.assertEqual(3, len(instances))
+        self.assertEqual((2, -2), instances[handles[2]].offset)
+        self.assertEqual((30, -30), instances[handles[3]].offset)
+        
+        gpu = [v.offset for v in instances.buffer[0:3]]
+        self.assertEqual([(0, 0), (30, -30), (2, -2)], gpu)
+        
+        handle = instances.add((7, 7))
+        self.assertEqual(handles[4], handle)
+        self.assertEqual((7, 7), instances.buffer[3].offset)
+        
+        with self.assertRaises(KeyError):
+            instances.remove(handles[1])
+
 class TestExtensions(unittest.TestCase):
      
     def test_load(self):
@@ -448,7 +1387,144 @@ class TestExtensions(unittest.TestCase):
         " Test extension support "
         self.assertFalse(check_extension('create_mmo'))        
         
+    def test_draw_indirect(self):
+        " Test the draw_indirect extension "
+        if not extension_loaded('draw_indirect'):
+            load_extension('draw_indirect')
+            
+        commands = pyglbuffers.DrawCommands(counts=[3, 6, 9], firsts=range(0, 30, 10), base_vertices=[0, -4, 8])
+        arrays = pyglbuffers.DrawCommands(counts=[3, 6], firsts=[0, 3], instance_counts=[2, 4])
+        
+        self.assertEqual(3, len(commands))
+        self.assertEqual((6, 1, 10, -4, 0), tuple(v[0] for v in commands.get(1)))
+        self.assertEqual((6, 4, 3, 0), tuple(v[0] for v in arrays.get(1)))
+        
+        buf1 = Buffer.draw_indirect(pyglbuffers.DRAW_ELEMENTS_COMMAND, usage=GL_DYNAMIC_DRAW)
+        commands.upload(buf1)
+        commands.set(2, instance_count=0, base_vertex=-1)
+        commands.set(0, count=12)
+        commands.upload(buf1)
+        
+        self.assertEqual(3, len(buf1))
+        self.assertEqual((12, 1, 0, 0, 0), tuple(v[0] for v in buf1[0]))
+        self.assertEqual((6, 1, 10, -4, 0), tuple(v[0] for v in buf1[1]))
+        self.assertEqual((9, 0, 20, -1, 0), tuple(v[0] for v in buf1[2]))
+        
+        # New commands of the same length replace every command of the buffer
+        buf2 = Buffer.draw_indirect(pyglbuffers.DRAW_ARRAYS_COMMAND, usage=GL_DYNAMIC_DRAW)
+        arrays.upload(buf2)
+        pyglbuffers.DrawCommands(counts=[6, 9], firsts=[0, 6]).upload(buf2)
+        self.assertEqual([6, 9], [v.count[0] for v in buf2[::]])
+        
+        with self.assertRaises(ValueError):
+            pyglbuffers.DrawCommands(counts=[3, 6], firsts=[1])
+        
+    def test_vertex_array(self):
+        " Test the vertex_array extension "
+        for name in ('vertex_array', 'registry'):
+            if not extension_loaded(name):
+                load_extension(name)
+            
+        from pyglet.gl import (glGetVertexAttribiv, glBindVertexArray, GLint, GL_VERTEX_ATTRIB_ARRAY_SIZE, 
+          GL_VERTEX_ATTRIB_ARRAY_STRIDE, GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING, GL_VERTEX_ATTRIB_ARRAY_NORMALIZED, GL_VERTEX_ATTRIB_ARRAY_INTEGER)
+            
+        cache = pyglbuffers.VertexArrayCache()
+        buf1 = Buffer.array('(3f)[position](4B)[color]')
+        buf2 = Buffer.array('(2f)[uv](1I)[material]')
+        buf3 = Buffer.element('(1S)[index]')
+        for b in (buf1, buf2, buf3): b.reserve(4)
+        locations = {'position': 0, 'color': 1, 'uv': 2, 'material': 3}
+        
+        vao = cache.get((buf1, buf2), locations, element=buf3, normalized=('color',))
+        self.assertEqual(vao.value, cache.get((buf1, buf2), locations, element=buf3, normalized=('color',)).value)
+        self.assertEqual(1, cache.builds)
+        
+        # Buffers drawn through a vertex array are restored when it is bound
+        registry = buf1.record.registry
+        buf1.evictable = True
+        registry.evict(buf1)
+        self.assertIsNotNone(buf1.record.host)
+        
+        cache.bind((buf1, buf2), locations, element=buf3, normalized=('color',))
+        self.assertIsNone(buf1.record.host)
+        value = GLint()
+        def attrib(location, pname):
+            glGetVertexAttribiv(location, pname, value)
+            return value.value
+        self.assertEqual((4, 16, 1, buf1.bid.value), tuple(attrib(1, p) for p in (GL_VERTEX_ATTRIB_ARRAY_SIZE, 
+                         GL_VERTEX_ATTRIB_ARRAY_STRIDE, GL_VERTEX_ATTRIB_ARRAY_NORMALIZED, GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING)))
+        self.assertEqual(buf2.bid.value, attrib(2, GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING))
+        self.assertEqual((0, 0, 1), tuple(attrib(l, GL_VERTEX_ATTRIB_ARRAY_INTEGER) for l in (1, 2, 3)))
+        cache.unbind()
+        
+        cache.get((buf1,), locations)
+        self.assertEqual(2, len(cache))
+        
+        with self.assertRaises(ValueError):
+            cache.get((buf1, buf1), locations)
+        self.assertEqual(2, len(cache))
+            
+        del buf2
+        gc.collect()
+        self.assertEqual(1, cache.collect())
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        
+    def test_texture_stream(self):
+        " Test the texture_stream extension "
+        if not extension_loaded('texture_stream'):
+            load_extension('texture_stream')
+            
+        from pyglet.gl import (glGenTextures, glDeleteTextures, glBindTexture, glTexImage2D, glGetTexImage, glFinish,
+          GLuint, GL_TEXTURE_2D, GL_RGBA, GL_RGBA8, GL_UNSIGNED_BYTE)
+            
+        texture = GLuint()
+        glGenTextures(1, texture)
+        glBindTexture(GL_TEXTURE_2D, texture)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA8, 16, 16, 0, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        
+        pixels = bytes(i%251 for i in range(16*16*4))
+        patch = bytearray(b'\xff'*4*4*4)
+        done = []
+        
+        for mapped in (True, False):
+            stream = pyglbuffers.TextureStream(count=2, size=512, budget=256, mapped=mapped)
+            stream.upload(texture, 16, 16, pixels)
+            stream.upload(texture, 4, 4, patch, x=2, y=3, callback=done.append)
+            self.assertEqual(2, len(stream))
+            
+            pumps = 0
+            while len(stream) > 0:
+                self.assertLessEqual(stream.pump(), 256)
+                glFinish()
+                pumps += 1
+            self.assertEqual(5, pumps)
+            self.assertEqual(16*16*4+4*4*4, stream.uploaded)
+            
+            expected = bytearray(pixels)
+            for row in range(4):
+                offset = ((3+row)*16+2)*4
+                expected[offset:offset+16] = b'\xff'*16
+            
+            result = (c_ubyte*len(pixels))()
+            glBindTexture(GL_TEXTURE_2D, texture)
+            glGetTexImage(GL_TEXTURE_2D, 0, GL_RGBA, GL_UNSIGNED_BYTE, result)
+            self.assertEqual(bytes(expected), bytes(result))
+        
+        self.assertEqual(2, len(done))
+        self.assertIsNone(done[0].data)
+        
+        with self.assertRaises(ValueError):
+            stream.upload(texture, 16, 3, pixels)
+        with self.assertRaises(ValueError):
+            pyglbuffers.TextureStream(size=16).upload(texture, 16, 16, pixels)
+            
+        glDeleteTextures(1, texture)
+        
 if __name__ == '__main__':
-    #Create an opengl context for our tests
-    window = pyglet.window.Window(visible=False)
-    unittest.main()
\ No newline at end of file
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_pack_parallel()
+    else:
+        #Create an opengl context for our tests
+        window = pyglet.window.Window(visible=False)
+        unittest.main()
\ No newline at end of file